@@ -0,0 +1,285 @@
+"""
+End-to-end benchmark of the RuuviGate publish pipeline.
+
+Drives publish_ruuvi_data with synthetic readings of 10 to 10,000 virtual RuuviTags
+against an in-process publisher and reports cycles per second, per-cycle latency
+percentiles, the peak of memory allocated during a cycle and the peak RSS. Results are
+stored as JSON and can be compared against an earlier run to catch regressions.
+
+    > poetry run python benchmarks/bench_pipeline.py
+    > poetry run python benchmarks/bench_pipeline.py --publisher azure --compare benchmarks/baseline.json
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import atexit
+import argparse
+import platform
+import resource
+import tempfile
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ruuvigate.__main__ import RuuviTags, publish_ruuvi_data  # noqa: E402
+from ruuvigate.clients.azure_iotc import AzureIOTC  # noqa: E402
+from ruuvigate.clients.diskqueue import DiskQueue  # noqa: E402
+from ruuvigate.scanner import RuuviScanner  # noqa: E402
+from ruuvigate.simulation import Simulator, virtual_macs  # noqa: E402
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+class FakePublisher:
+    '''
+    DataPublisher that serializes every cycle like a real client but sends nowhere
+    '''
+
+    def __init__(self) -> None:
+        self._databuf: Dict[str, Any] = {}
+        self.sent_bytes = 0
+
+    async def connect(self, _) -> None:
+        pass
+
+    def register_method_handler(self, *_) -> None:
+        pass
+
+    async def execute_method_dispatcher(self) -> None:
+        pass
+
+    async def buffer_data(self, data: Dict[str, Any]) -> None:
+        self._databuf.update(data)
+
+    async def publish_data(self, data: Dict[str, Any] = {}) -> None:
+        self._databuf.update(data)
+        self.sent_bytes += len(json.dumps(self._databuf))
+        self._databuf.clear()
+
+    async def publish_batch(self, batch) -> None:
+        self.sent_bytes += len(batch.to_json())
+
+
+class FakeDeviceClient:
+    '''
+    Stand-in for IoTHubDeviceClient that accepts every message immediately
+    '''
+
+    async def send_message(self, msg) -> None:
+        await asyncio.sleep(0)
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class FakeScanner(RuuviScanner):
+    '''
+    Serves pregenerated readings in place of RuuviScanner and times each cycle
+    from taking the snapshot until the publisher returns
+    '''
+    Batches = 4
+
+    def __init__(self, macs: List[str], cycles: int, publisher) -> None:
+        super().__init__()
+        simulator = Simulator(seed=1)
+        self._batches = [simulator.readings(macs) for _ in range(self.Batches)]
+        self._cycles = cycles
+        self._publisher = publisher
+        self._started = 0.0
+        self._traced = 0
+        self.started: Optional[float] = None
+        self.finished = 0.0
+        self.latencies: List[float] = []
+        self.alloc_peaks: List[int] = []
+        self.task: Optional[asyncio.Task] = None
+        publish_data = publisher.publish_data
+        publish_batch = getattr(publisher, "publish_batch", None)
+
+        async def timed_publish_batch(batch):
+            await publish_batch(batch)
+            await cycle_published()
+
+        async def timed_publish_data(data={}):
+            await publish_data(data)
+            await cycle_published()
+
+        async def cycle_published():
+            self.finished = time.perf_counter()
+            self.latencies.append(self.finished - self._started)
+            if tracemalloc.is_tracing():
+                self.alloc_peaks.append(tracemalloc.get_traced_memory()[1] -
+                                        self._traced)
+            if len(self.latencies) >= self._cycles and self.task is not None:
+                self.task.cancel()
+            # Overrunning cycles never suspend otherwise, yield to let background
+            # tasks run and the cancellation through
+            await asyncio.sleep(0)
+
+        publisher.publish_data = timed_publish_data
+        if publish_batch is not None:
+            publisher.publish_batch = timed_publish_batch
+
+    def snapshot(self, macs, clear: bool = True) -> Dict[str, Any]:
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            self._traced = tracemalloc.get_traced_memory()[0]
+        self._started = time.perf_counter()
+        if self.started is None:
+            self.started = self._started
+        return self._batches[len(self.latencies) % self.Batches]
+
+
+def create_publisher(kind: str, workdir: str):
+    if kind == "fake":
+        return FakePublisher()
+    azure = AzureIOTC()
+    azure._client = FakeDeviceClient()
+    azure._queue = DiskQueue(os.path.join(workdir, "queue"))
+    return azure
+
+
+async def run_cycles(kind: str, tags: int, cycles: int,
+                     workdir: str) -> FakeScanner:
+    path = os.path.join(workdir, "ruuvitags-{}.txt".format(tags))
+    with open(path, "w") as stream:
+        stream.write("\n".join(virtual_macs(tags)))
+    ruuvitags = RuuviTags(path)
+    publisher = create_publisher(kind, workdir)
+    scanner = FakeScanner(await ruuvitags.get_normalized_macs(), cycles,
+                          publisher)
+    args = argparse.Namespace(interval=1e-6,
+                              adapters=None,
+                              sequence_stats=False,
+                              align=False,
+                              schema="slots")
+    scanner.task = asyncio.create_task(
+        publish_ruuvi_data(args, publisher, ruuvitags, scanner))
+    await scanner.task
+    if kind == "azure":
+        await publisher.disconnect()
+        atexit.unregister(publisher.disconnect)
+    return scanner
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def benchmark(kind: str, tags: int, cycles: int) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory() as workdir:
+        scanner = asyncio.run(run_cycles(kind, tags, cycles, workdir))
+        latencies = scanner.latencies
+        elapsed = scanner.finished - (scanner.started or 0.0)
+
+        # Tracing slows the cycles down, so the allocations are measured apart
+        tracemalloc.start()
+        alloc_peaks = asyncio.run(
+            run_cycles(kind, tags, max(1, cycles // 10), workdir)).alloc_peaks
+        tracemalloc.stop()
+
+    return {
+        "tags": tags,
+        "cycles": len(latencies),
+        "cycles_per_second": len(latencies) / elapsed,
+        "latency_p50_ms": percentile(latencies, 0.50) * 1000,
+        "latency_p90_ms": percentile(latencies, 0.90) * 1000,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+        "alloc_peak_kib": max(alloc_peaks) / 1024,
+        # Linux reports kibibytes
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+
+def compare(results: List[Dict[str, Any]], baseline_path: str,
+            tolerance: float) -> bool:
+    with open(baseline_path, "r") as stream:
+        baseline = {
+            result["tags"]: result
+            for result in json.load(stream)["results"]
+        }
+    ok = True
+    for result in results:
+        previous = baseline.get(result["tags"])
+        if previous is None:
+            continue
+        for key in ("latency_p50_ms", "latency_p99_ms", "alloc_peak_kib"):
+            ratio = result[key] / previous[key] if previous[key] else 1.0
+            regressed = ratio > 1 + tolerance
+            ok = ok and not regressed
+            print("{:>6} tags {:<16} {:10.3f} -> {:10.3f} ({:+.0%}){}".format(
+                result["tags"], key, previous[key], result[key], ratio - 1,
+                "  REGRESSION" if regressed else ""))
+    return ok
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--tags',
+                        type=int,
+                        nargs='+',
+                        default=[10, 100, 1000, 10000],
+                        help='RuuviTag counts (default: %(default)s)')
+    parser.add_argument('--cycles',
+                        type=int,
+                        default=200,
+                        help='Publish cycles per RuuviTag count, fewer for '
+                        'large counts (default: %(default)s)')
+    parser.add_argument('--publisher',
+                        choices=['fake', 'azure'],
+                        default='fake',
+                        help='In-process publisher, or AzureIOTC with a '
+                        'stand-in device client (default: %(default)s)')
+    parser.add_argument('--output',
+                        default=None,
+                        help='Results file (default: benchmarks/results/'
+                        '<publisher>-<time>.json)')
+    parser.add_argument('--compare',
+                        default=None,
+                        help='Earlier results file to compare against')
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.2,
+        help='Allowed relative slowdown (default: %(default)s)')
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    results = []
+    for tags in args.tags:
+        cycles = max(10, min(args.cycles, args.cycles * 100 // tags))
+        result = benchmark(args.publisher, tags, cycles)
+        results.append(result)
+        print("{tags:>6} tags {cycles_per_second:10.1f} cycles/s  "
+              "p50 {latency_p50_ms:8.3f} ms  p90 {latency_p90_ms:8.3f} ms  "
+              "p99 {latency_p99_ms:8.3f} ms  alloc {alloc_peak_kib:9.1f} KiB  "
+              "rss {peak_rss_kib} KiB".format(**result))
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, "{}-{}.json".format(args.publisher,
+                                         time.strftime("%Y%m%dT%H%M%S")))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as stream:
+        json.dump(
+            {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "publisher": args.publisher,
+                "results": results
+            },
+            stream,
+            indent=2)
+    print("Results written to " + output)
+
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,226 @@
+"""
+Soak benchmark of the RuuviGate publish pipeline.
+
+Drives publish_ruuvi_data with simulated RuuviTags through a day of virtual time,
+one publish cycle per interval as fast as the pipeline allows, and samples the
+memory traced by tracemalloc and the RSS every simulated hour. After the warm-up
+the memory should stay flat: the growth is fitted per hour and a growth above
+--max-growth fails with a non-zero exit status.
+
+    > poetry run python benchmarks/bench_soak.py
+    > poetry run python benchmarks/bench_soak.py --tags 1000 --publisher azure
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import atexit
+import argparse
+import platform
+import resource
+import tempfile
+import tracemalloc
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from bench_pipeline import RESULTS_DIR, create_publisher  # noqa: E402
+from ruuvigate.__main__ import RuuviTags, publish_ruuvi_data  # noqa: E402
+from ruuvigate.scanner import RuuviScanner  # noqa: E402
+from ruuvigate.simulation import Simulator, virtual_macs  # noqa: E402
+
+Hour = 60 * 60
+
+
+class SoakScanner(RuuviScanner):
+    '''
+    Serves simulated readings in place of RuuviScanner, advancing the virtual clock
+    of the simulator by an interval per cycle, and samples the memory every
+    simulated hour
+    '''
+
+    def __init__(self, interval: float, hours: int,
+                 packet_loss: float) -> None:
+        super().__init__()
+        self.now = 0.0
+        self._interval = interval
+        self._end = hours * Hour
+        self._simulator = Simulator(seed=1,
+                                    packet_loss=packet_loss,
+                                    clock=lambda: self.now)
+        self.samples: List[Tuple[float, int, int]] = []
+        self.task: Optional[asyncio.Task] = None
+
+    def snapshot(self, macs, clear: bool = True) -> Dict[str, Any]:
+        if self.now % Hour < self._interval:
+            self.samples.append(
+                (self.now / Hour, tracemalloc.get_traced_memory()[0], rss()))
+        if self.now >= self._end and self.task is not None:
+            self.task.cancel()
+        self.now += self._interval
+        return self._simulator.readings(macs)
+
+
+def rss() -> int:
+    """
+    Returns:
+        int: Current resident set size in bytes, the peak where not available
+    """
+    try:
+        with open("/proc/self/statm", "r") as stream:
+            return int(stream.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Linux reports kibibytes, macOS bytes
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def slope(points: List[Tuple[float, float]]) -> float:
+    """
+    Returns:
+        float: Least squares slope of the points, 0 if there are fewer than two
+    """
+    if len(points) < 2:
+        return 0.0
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    variance = sum((x - mean_x)**2 for x, _ in points)
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+
+
+async def soak(kind: str, tags: int, interval: float, hours: int,
+               packet_loss: float, workdir: str) -> SoakScanner:
+    path = os.path.join(workdir, "ruuvitags.txt")
+    with open(path, "w") as stream:
+        stream.write("\n".join(virtual_macs(tags)))
+    ruuvitags = RuuviTags(path)
+    publisher = create_publisher(kind, workdir)
+    scanner = SoakScanner(interval, hours, packet_loss)
+    publish_batch = publisher.publish_batch
+
+    async def yielding_publish_batch(batch):
+        await publish_batch(batch)
+        # Overrunning cycles never suspend otherwise, yield to let background
+        # tasks run and the cancellation through
+        await asyncio.sleep(0)
+
+    publisher.publish_batch = yielding_publish_batch
+    args = argparse.Namespace(interval=1e-6,
+                              adapters=None,
+                              sequence_stats=False,
+                              align=False,
+                              schema="slots")
+    scanner.task = asyncio.create_task(
+        publish_ruuvi_data(args, publisher, ruuvitags, scanner))
+    await scanner.task
+    if kind == "azure":
+        await publisher.disconnect()
+        atexit.unregister(publisher.disconnect)
+    return scanner
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--tags',
+                        type=int,
+                        default=1000,
+                        help='Number of RuuviTags (default: %(default)s)')
+    parser.add_argument('--publisher',
+                        choices=['fake', 'azure'],
+                        default='fake',
+                        help='In-process publisher, or AzureIOTC with a '
+                        'stand-in device client (default: %(default)s)')
+    parser.add_argument(
+        '--interval',
+        type=float,
+        default=60.0,
+        help='Simulated publish interval in seconds (default: %(default)s)')
+    parser.add_argument('--hours',
+                        type=int,
+                        default=24,
+                        help='Simulated hours (default: %(default)s)')
+    parser.add_argument(
+        '--warmup',
+        type=int,
+        default=1,
+        help='Simulated hours left out of the growth (default: %(default)s)')
+    parser.add_argument('--packet-loss',
+                        type=float,
+                        default=0.0,
+                        help='Probability of a reading being lost '
+                        '(default: %(default)s)')
+    parser.add_argument(
+        '--max-growth',
+        type=float,
+        default=16.0,
+        help='Allowed growth of the traced memory in KiB per simulated hour '
+        '(default: %(default)s)')
+    parser.add_argument('--output',
+                        default=None,
+                        help='Results file (default: benchmarks/results/'
+                        'soak-<publisher>-<time>.json)')
+    args = parser.parse_args()
+    if args.interval <= 0 or args.hours <= args.warmup:
+        parser.error("Interval must be positive and hours exceed the warm-up")
+    logging.disable(logging.CRITICAL)
+
+    started = time.perf_counter()
+    tracemalloc.start()
+    with tempfile.TemporaryDirectory() as workdir:
+        samples = asyncio.run(
+            soak(args.publisher, args.tags, args.interval, args.hours,
+                 args.packet_loss, workdir)).samples
+    tracemalloc.stop()
+    elapsed = time.perf_counter() - started
+
+    for hour, traced, resident in samples:
+        print("{:>5.1f} h  traced {:10.1f} KiB  rss {:10.1f} KiB".format(
+            hour, traced / 1024, resident / 1024))
+    settled = [sample for sample in samples if sample[0] >= args.warmup]
+    traced_growth = slope([(hour, traced / 1024)
+                           for hour, traced, _ in settled])
+    rss_growth = slope([(hour, resident / 1024)
+                        for hour, _, resident in settled])
+    result = {
+        "tags": args.tags,
+        "interval": args.interval,
+        "hours": args.hours,
+        "cycles": int(args.hours * Hour / args.interval),
+        "elapsed_s": elapsed,
+        "traced_growth_kib_per_hour": traced_growth,
+        "rss_growth_kib_per_hour": rss_growth,
+        "samples": samples
+    }
+    print("{tags} tags, {cycles} cycles in {elapsed_s:.1f} s: traced memory "
+          "{traced_growth_kib_per_hour:+.2f} KiB/h, RSS "
+          "{rss_growth_kib_per_hour:+.2f} KiB/h after the warm-up".format(
+              **result))
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, "soak-{}-{}.json".format(args.publisher,
+                                              time.strftime("%Y%m%dT%H%M%S")))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as stream:
+        json.dump(
+            {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "publisher": args.publisher,
+                "result": result
+            },
+            stream,
+            indent=2)
+    print("Results written to " + output)
+
+    if result["traced_growth_kib_per_hour"] > args.max_growth:
+        print("Traced memory grew by more than {} KiB/h".format(
+            args.max_growth))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+"""
+Startup benchmark of RuuviGate publishers.
+
+Starts fresh interpreters that import RuuviGate and create a publisher the way
+`python -m ruuvigate --mode <publisher>` does, and reports the median wall time of
+the process, the time spent importing and creating the publisher, the memory
+allocated by the imports, the peak RSS and the number of modules loaded. With
+`--eager` every built-in publisher is imported up front too, like RuuviGate did
+before the publishers were loaded lazily, to show the difference.
+
+    > poetry run python benchmarks/bench_startup.py
+    > poetry run python benchmarks/bench_startup.py --publisher stdout --eager
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+from typing import Any, Dict, List
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+CHILD = """
+import sys
+import time
+import json
+import resource
+import tracemalloc
+tracemalloc.start()
+started = time.perf_counter()
+from ruuvigate.__main__ import available_factories
+factories = available_factories()
+if {eager}:
+    for factory in factories.values():
+        factory.load()
+publisher = factories[{publisher!r}]()
+elapsed = time.perf_counter() - started
+print(json.dumps({{
+    "import_ms": elapsed * 1000,
+    "alloc_kib": tracemalloc.get_traced_memory()[1] / 1024,
+    "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "modules": len(sys.modules),
+    "azure_loaded": "azure.iot.device" in sys.modules,
+}}))
+"""
+
+
+def start(publisher: str, eager: bool) -> Dict[str, Any]:
+    started = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c",
+         CHILD.format(publisher=publisher, eager=eager)],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        text=True).stdout
+    result = json.loads(output)
+    result["process_ms"] = (time.perf_counter() - started) * 1000
+    return result
+
+
+def benchmark(publisher: str, eager: bool, runs: int) -> Dict[str, Any]:
+    samples = [start(publisher, eager) for _ in range(runs)]
+    return {
+        "publisher": publisher,
+        "eager": eager,
+        "runs": runs,
+        "process_ms": statistics.median(s["process_ms"] for s in samples),
+        "import_ms": statistics.median(s["import_ms"] for s in samples),
+        "alloc_kib": statistics.median(s["alloc_kib"] for s in samples),
+        # Linux reports kibibytes
+        "peak_rss_kib": statistics.median(s["peak_rss_kib"] for s in samples),
+        "modules": samples[-1]["modules"],
+        "azure_loaded": samples[-1]["azure_loaded"]
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--publisher',
+                        nargs='+',
+                        default=['stdout', 'azure'],
+                        help='Publishers to start (default: %(default)s)')
+    parser.add_argument('--runs',
+                        type=int,
+                        default=10,
+                        help='Processes started per publisher, the median is '
+                        'reported (default: %(default)s)')
+    parser.add_argument('--eager',
+                        action='store_true',
+                        help='Also start with every built-in publisher '
+                        'imported up front')
+    parser.add_argument('--output',
+                        default=None,
+                        help='Results file (default: benchmarks/results/'
+                        'startup-<time>.json)')
+    args = parser.parse_args()
+
+    results: List[Dict[str, Any]] = []
+    for publisher in args.publisher:
+        for eager in ([False, True] if args.eager else [False]):
+            result = benchmark(publisher, eager, args.runs)
+            results.append(result)
+            print("{publisher:>8} {loading:<5} process {process_ms:8.1f} ms  "
+                  "import {import_ms:8.1f} ms  alloc {alloc_kib:9.1f} KiB  "
+                  "rss {peak_rss_kib:8.0f} KiB  modules {modules:5}".format(
+                      loading="eager" if eager else "lazy", **result))
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, "startup-{}.json".format(time.strftime("%Y%m%dT%H%M%S")))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as stream:
+        json.dump(
+            {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "results": results
+            },
+            stream,
+            indent=2)
+    print("Results written to " + output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
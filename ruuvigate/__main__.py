@@ -6,20 +6,84 @@ import asyncio
 import re
 import signal
 import functools
-from random import randint
-from typing import List
+import heapq
+import time
+import datetime
+import json
+from typing import (TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Set,
+                    Tuple, cast)
 
 from ruuvitag_sensor.ruuvi import RuuviTagSensor  # type: ignore
 
-from ruuvigate.clients.client import FACTORIES, DataPublisher
+from ruuvigate import metrics
+from ruuvigate.batch import MeasurementBatch
+from ruuvigate.clients.client import (CONFIGLESS, DataPublisher,
+                                      available_factories, publish_batch)
+from ruuvigate.clients.fanout import FanOut, Sink
+from ruuvigate.sequence import SequenceTracker
+from ruuvigate.scanner import (RuuviScanner, ble_advertisements,
+                               merge_readings, merge_sources)
+from ruuvigate.recording import (AdvertisementRecorder, decoded_advertisements,
+                                 raw_ble_advertisements,
+                                 replayed_advertisements)
+from ruuvigate.scheduler import TagScheduler
+from ruuvigate.deadband import DeadbandFilter
+from ruuvigate.aggregate import TagWindow
+from ruuvigate.simulation import Simulator
+from ruuvigate.watch import FileWatcher
+from ruuvigate.model import SCHEMAS
+from ruuvigate.diagnostics import Diagnostics
+
+if TYPE_CHECKING:
+    from ruuvigate.clients.localstore import LocalStore
+
+# RuuviTag measurements, aggregates and sequence statistics in the order of
+# RuuviTags.Telemetry
+MEASUREMENTS = (("temperature", "humidity", "pressure", "battery",
+                 "measurement_sequence_number", TagWindow.SamplesKey) +
+                tuple(key for keys in TagWindow.Keys for key in keys) +
+                (SequenceTracker.LossKey, SequenceTracker.DuplicatesKey))
+# Seconds a periodic scan lasts at least, or the shortest publish interval, so that
+# the RuuviTags advertising about once a second are heard even when the tick is
+# already due
+MIN_SCAN_DURATION = 2.0
 
 
 class RuuviTags:
-    lock = asyncio.Lock()
+    """
+    Registry of the RuuviTags in use. Every RuuviTag has a stable slot that numbers
+    its telemetry fields. A removed RuuviTag frees its slot without renumbering the
+    others, and the RuuviTags file keeps the slots by line (empty line = free slot).
+    A RuuviTag can have its own publish interval in seconds after its MAC on its
+    line, e.g. "12:34:56:78:90:AB 10". Changes are written to the file off the
+    event loop, atomically and coalesced over PersistDelay seconds.
+    """
+    PersistDelay = 0.5
+    Telemetry = (
+        ("Temperature", "Humidity", "Pressure", "Battery", "Sequence",
+         "Samples") +
+        tuple(metric + aggregate
+              for metric in ("Temperature", "Humidity", "Pressure", "Battery")
+              for aggregate in ("Min", "Max", "Mean")) +
+        ("PacketLoss", "Duplicates"))
 
     def __init__(self, path: str):
         self._macs_file: str = path
-        self._macs: List[str] = []
+        self._slots: List[Optional[str]] = []
+        self._index: Dict[str, int] = {}
+        self._free: List[int] = []
+        self._macs: Optional[List[str]] = None
+        # Own publish intervals by normalized MAC
+        self._intervals: Dict[str, int] = {}
+        self._schedule: Optional[Dict[str, Optional[int]]] = None
+        self.lock = asyncio.Lock()
+        self._dirty = False
+        # Content of the RuuviTags file as last read or written, and the lock held
+        # while reading or writing it
+        self._content: Optional[str] = None
+        self._file_lock = asyncio.Lock()
+        self._persist_timer: Optional[asyncio.TimerHandle] = None
+        self._persist_task: Optional[asyncio.Task] = None
 
         if not os.path.exists(self._macs_file):
             open(self._macs_file, "x")
@@ -27,43 +91,378 @@ class RuuviTags:
             self.__parse_ruuvitag_file()
 
     async def add_mac(self, mac: str) -> bool:
-        async with self.lock:
-            if self._macs.count(mac) != 0:
-                return False
-            if not self.is_legal_mac(mac):
-                raise ValueError("Malformed MAC: {}".format(mac))
-            self._macs.append(mac)
-        await self.__write_macs_to_ruuvitag_file()
-        return True
+        return bool(await self.add_macs([mac]))
 
     async def remove_mac(self, mac: str) -> bool:
+        if not self.is_legal_mac(mac):
+            return False
+        return bool(await self.remove_macs([mac]))
+
+    async def add_macs(self, macs: List[str]) -> List[str]:
+        """
+        Adds RuuviTags in one transaction: if any MAC is malformed none is added.
+
+        Args:
+            macs (List[str]): MACs of the RuuviTags
+
+        Returns:
+            List[str]: The MACs added, i.e. those not already in use
+        """
         async with self.lock:
-            if self._macs.count(mac) == 0:
-                return False
-            self._macs.remove(mac)
-        await self.__write_macs_to_ruuvitag_file()
-        return True
+            for mac in macs:
+                if not self.is_legal_mac(mac):
+                    raise ValueError("Malformed MAC: {}".format(mac))
+            added = []
+            for mac in macs:
+                if self.normalize_mac(mac) not in self._index:
+                    self.__assign_slot(mac)
+                    added.append(mac)
+            if added:
+                self.__persist()
+            return added
+
+    async def remove_macs(self, macs: List[str]) -> List[str]:
+        """
+        Removes RuuviTags in one transaction: if any MAC is malformed none is
+        removed.
+
+        Args:
+            macs (List[str]): MACs of the RuuviTags
+
+        Returns:
+            List[str]: The MACs removed, i.e. those that were in use
+        """
+        async with self.lock:
+            for mac in macs:
+                if not self.is_legal_mac(mac):
+                    raise ValueError("Malformed MAC: {}".format(mac))
+            removed = []
+            for mac in macs:
+                slot = self._index.pop(self.normalize_mac(mac), None)
+                if slot is not None:
+                    self._slots[slot] = None
+                    self._intervals.pop(self.normalize_mac(mac), None)
+                    heapq.heappush(self._free, slot)
+                    removed.append(mac)
+            if removed:
+                self._macs = None
+                self._schedule = None
+                self.__persist()
+            return removed
+
+    async def flush(self) -> None:
+        """
+        Writes the pending changes to the RuuviTags file without delay. A write in
+        flight is waited for, and the pending write is started as if its delay had
+        passed, so that the file has a single writer.
+        """
+        if self._persist_task is not None:
+            # Schedules another write when finished if changed meanwhile
+            await self._persist_task
+        if self._persist_timer is not None:
+            self._persist_timer.cancel()
+            self.__start_write()
+            assert self._persist_task is not None
+            await self._persist_task
+
+    @property
+    def path(self) -> str:
+        return self._macs_file
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, mac: str) -> bool:
+        return self.slot_number(mac) is not None
 
     async def get_macs(self) -> List[str]:
         async with self.lock:
+            if self._macs is None:
+                self._macs = [mac for mac in self._slots if mac is not None]
             return self._macs
 
+    async def get_normalized_macs(self) -> List[str]:
+        async with self.lock:
+            return list(self._index)
+
+    async def get_intervals(self) -> Dict[str, Optional[int]]:
+        """
+        Returns:
+            Dict[str, Optional[int]]: Own publish interval of every RuuviTag in use
+                by normalized MAC, None if it has none. The same dict is returned
+                until the RuuviTags or their intervals change.
+        """
+        async with self.lock:
+            if self._schedule is None:
+                self._schedule = {
+                    mac: self._intervals.get(mac)
+                    for mac in self._index
+                }
+            return self._schedule
+
+    def get_interval(self, mac: str) -> Optional[int]:
+        """
+        Args:
+            mac (str): MAC of the RuuviTag
+
+        Returns:
+            Optional[int]: Own publish interval of the RuuviTag in seconds, None if
+                it has none
+        """
+        return self._intervals.get(self.normalize_mac(mac))
+
+    async def set_interval(self, mac: str, interval: Optional[int]) -> bool:
+        """
+        Args:
+            mac (str): MAC of the RuuviTag
+            interval (Optional[int]): Own publish interval in seconds, None for the
+                default interval
+
+        Returns:
+            bool: True if set, False if the RuuviTag is not in use
+
+        Raises:
+            ValueError: If the interval is less than a second
+        """
+        if interval is not None and interval < 1:
+            raise ValueError("Interval must be greater than zero")
+        async with self.lock:
+            normalized = self.normalize_mac(mac)
+            if normalized not in self._index:
+                return False
+            if self._intervals.get(normalized) != interval:
+                if interval is None:
+                    del self._intervals[normalized]
+                else:
+                    self._intervals[normalized] = interval
+                self._schedule = None
+                self.__persist()
+            return True
+
+    def slot_number(self, mac: str) -> Optional[int]:
+        """
+        Args:
+            mac (str): MAC of the RuuviTag
+
+        Returns:
+            Optional[int]: Number of the telemetry fields of the RuuviTag, e.g. 1 of
+                "Temperature1", None if the RuuviTag is not in use
+        """
+        slot = self._index.get(mac)
+        if slot is None:
+            slot = self._index.get(self.normalize_mac(mac))
+            if slot is None:
+                return None
+        return slot + 1
+
+    def slot_mac(self, number: int) -> Optional[str]:
+        """
+        Args:
+            number (int): Number of telemetry fields, e.g. 1 of "Temperature1"
+
+        Returns:
+            Optional[str]: Normalized MAC of the RuuviTag the fields belong to, None
+                if the slot is free
+        """
+        if not 0 < number <= len(self._slots):
+            return None
+        mac = self._slots[number - 1]
+        return self.normalize_mac(mac) if mac is not None else None
+
+    def __assign_slot(self, mac: str, preferred: Optional[int] = None) -> None:
+        if preferred is not None:
+            while len(self._slots) <= preferred:
+                heapq.heappush(self._free, self.__new_slot())
+            if preferred in self._free:
+                self._free.remove(preferred)
+                heapq.heapify(self._free)
+            else:
+                preferred = None
+        slot = preferred
+        if slot is None:
+            slot = heapq.heappop(
+                self._free) if self._free else self.__new_slot()
+        self._slots[slot] = mac
+        self._index[self.normalize_mac(mac)] = slot
+        self._macs = None
+        self._schedule = None
+
+    def __new_slot(self) -> int:
+        slot = len(self._slots)
+        self._slots.append(None)
+        return slot
+
+    async def reload(self) -> Tuple[List[str], List[str]]:
+        """
+        Applies the changes made by others to the RuuviTags file since it was last
+        read or written. Changes made meanwhile to the registry and not written yet
+        are kept. Added RuuviTags take the slot of their line if it is free, and the
+        registry is left as it is if the file has a malformed line. The file is
+        written back only if a RuuviTag's slot differs from its line, so that the
+        slots survive a restart.
+
+        Returns:
+            Tuple[List[str], List[str]]: The MACs added and removed
+        """
+        async with self._file_lock:
+            return await self.__reload()
+
+    async def __reload(self) -> Tuple[List[str], List[str]]:
+        try:
+            with open(self._macs_file, "r") as f:
+                content = f.read()
+            theirs = self.__entries(self.__parse_lines(content))
+        except (OSError, ValueError) as ex:
+            logging.error("Not reloading RuuviTags file: {} {}".format(
+                type(ex).__name__, ex.args))
+            return [], []
+        async with self.lock:
+            if content == self._content:
+                return [], []
+            base = self.__entries(self.__parse_lines(self._content or ""))
+            self._content = content
+            removed = []
+            for normalized in base:
+                slot = self._index.get(normalized)
+                if normalized not in theirs and slot is not None:
+                    removed.append(self._slots[slot] or normalized)
+                    del self._index[normalized]
+                    self._slots[slot] = None
+                    self._intervals.pop(normalized, None)
+                    heapq.heappush(self._free, slot)
+                    self._macs = None
+                    self._schedule = None
+            added = []
+            for normalized, (line, mac, interval) in theirs.items():
+                if normalized not in base and normalized not in self._index:
+                    self.__assign_slot(mac, line)
+                    added.append(mac)
+                previous = base.get(normalized)
+                if normalized in self._index and (previous is None
+                                                  or previous[2] != interval):
+                    if interval is None:
+                        self._intervals.pop(normalized, None)
+                    else:
+                        self._intervals[normalized] = interval
+                    self._schedule = None
+            if any(
+                    self._index.get(normalized, line) != line
+                    for normalized, (line, _, _) in theirs.items()):
+                self.__persist()
+        if added or removed:
+            logging.info(
+                "Reloaded RuuviTags file, added {} and removed {}".format(
+                    added, removed))
+        return added, removed
+
+    @classmethod
+    def __entries(
+        cls, lines: List[Tuple[str, Optional[int]]]
+    ) -> Dict[str, Tuple[int, str, Optional[int]]]:
+        """
+        Returns:
+            Dict[str, Tuple[int, str, Optional[int]]]: Line, MAC and own publish
+                interval of every RuuviTag by normalized MAC, the first line of a
+                duplicate
+        """
+        entries: Dict[str, Tuple[int, str, Optional[int]]] = {}
+        for line, (mac, interval) in enumerate(lines):
+            if mac and cls.normalize_mac(mac) not in entries:
+                entries[cls.normalize_mac(mac)] = (line, mac, interval)
+        return entries
+
     def __parse_ruuvitag_file(self) -> None:
         with open(self._macs_file, "r") as f:
-            lines = f.read().splitlines()
+            self._content = f.read()
+        for mac, interval in self.__parse_lines(self._content):
+            if mac and self.normalize_mac(mac) in self._index:
+                logging.warning(
+                    "Ignoring duplicate RuuviTag {} in RuuviTags file".format(
+                        mac))
+                mac = ""
+            # Every line reserves a slot to keep the numbering
+            slot = self.__new_slot()
+            if mac:
+                self._slots[slot] = mac
+                self._index[self.normalize_mac(mac)] = slot
+                if interval is not None:
+                    self._intervals[self.normalize_mac(mac)] = interval
+            else:
+                heapq.heappush(self._free, slot)
+
+    @classmethod
+    def __parse_lines(cls, content: str) -> List[Tuple[str, Optional[int]]]:
+        """
+        Returns:
+            List[Tuple[str, Optional[int]]]: MAC and own publish interval of every
+                line, an empty MAC for an empty line
+
+        Raises:
+            ValueError: If a line is malformed
+        """
+        lines = content.splitlines()
+        while lines and not lines[-1]:
+            lines.pop()
+        parsed: List[Tuple[str, Optional[int]]] = []
         for line in lines:
-            if not line:
-                continue
-            if not self.is_legal_mac(line):
+            mac, _, interval = line.partition(" ")
+            if line and not (cls.is_legal_mac(mac) and
+                             (not interval or interval.strip().isdigit()
+                              and int(interval) > 0)):
                 raise ValueError(
                     "Malformed line in RuuviTags file: {}".format(line))
-            self._macs.append(line)
+            parsed.append((mac, int(interval) if interval else None))
+        return parsed
+
+    def __render(self) -> str:
+        slots = list(self._slots)
+        while slots and slots[-1] is None:
+            slots.pop()
+        return "".join(self.__render_line(mac) + "\n" for mac in slots)
+
+    def __render_line(self, mac: Optional[str]) -> str:
+        if mac is None:
+            return ""
+        interval = self._intervals.get(self.normalize_mac(mac))
+        return mac if interval is None else "{} {}".format(mac, interval)
+
+    def __persist(self) -> None:
+        # Coalesce the changes of a burst into a single write
+        self._dirty = True
+        if self._persist_timer is None and self._persist_task is None:
+            self._persist_timer = asyncio.get_running_loop().call_later(
+                self.PersistDelay, self.__start_write)
+
+    def __start_write(self) -> None:
+        self._persist_timer = None
+        self._persist_task = asyncio.create_task(
+            self.__write_macs_to_ruuvitag_file())
 
     async def __write_macs_to_ruuvitag_file(self) -> None:
-        async with self.lock:
-            with open(self._macs_file, "w") as stream:
-                for mac in self._macs:
-                    stream.write(mac + '\n')
+        try:
+            async with self._file_lock:
+                self._dirty = False
+                content = self.__render()
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.__write_atomically, self._macs_file, content)
+                self._content = content
+        except OSError as ex:
+            logging.error("Writing RuuviTags file failed: {} {}".format(
+                type(ex).__name__, ex.args))
+            self._dirty = True
+        finally:
+            self._persist_task = None
+        if self._dirty:
+            # Changed while writing
+            self.__persist()
+
+    @staticmethod
+    def __write_atomically(path: str, content: str) -> None:
+        with open(path + ".tmp", "w") as stream:
+            stream.write(content)
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.replace(path + ".tmp", path)
 
     @staticmethod
     def is_legal_mac(mac: str) -> bool:
@@ -72,6 +471,18 @@ class RuuviTags:
             re.match("[0-9a-f]{2}([-:]?)[0-9a-f]{2}(\\1[0-9a-f]{2}){4}$",
                      mac.lower()))
 
+    @staticmethod
+    def normalize_mac(mac: str) -> str:
+        """
+        Args:
+            mac (str): A legal MAC in any accepted notation
+
+        Returns:
+            str: The MAC in upper case and colon separated, as reported by RuuviTags
+        """
+        digits = mac.upper().replace(":", "").replace("-", "")
+        return ":".join(digits[i:i + 2] for i in range(0, 12, 2))
+
 
 async def add_ruuvitag(mac, ruuvitags):
     if mac is None:
@@ -88,7 +499,25 @@ async def add_ruuvitag(mac, ruuvitags):
         return {"result": False, "data": "RuuviTag " + mac + " already exists"}
 
 
-async def remove_ruuvitag(mac, ruuvitags):
+def forget_ruuvitag(mac: str,
+                    tracker: Optional[SequenceTracker] = None,
+                    deadband: Optional[DeadbandFilter] = None) -> None:
+    """
+    Drops the state kept of a removed RuuviTag, so that it starts over if added
+    again
+    """
+    normalized = RuuviTags.normalize_mac(mac)
+    metrics.tag_removed(normalized)
+    if tracker is not None:
+        tracker.remove(normalized)
+    if deadband is not None:
+        deadband.remove(normalized)
+
+
+async def remove_ruuvitag(mac,
+                          ruuvitags,
+                          tracker: Optional[SequenceTracker] = None,
+                          deadband: Optional[DeadbandFilter] = None):
     if mac is None:
         return {"result": False, "data": "Cannot add empty MAC"}
 
@@ -98,73 +527,349 @@ async def remove_ruuvitag(mac, ruuvitags):
     logging.info("Removing RuuviTag " + mac)
     ret = await ruuvitags.remove_mac(mac)
     if ret:
+        forget_ruuvitag(mac, tracker, deadband)
         return {"result": True, "data": "RuuviTag " + mac + " removed"}
     else:
         return {"result": False, "data": "RuuviTag " + mac + " doesn't exist"}
 
 
+def parse_mac_list(payload) -> Optional[List[str]]:
+    """
+    Args:
+        payload: List of MACs, or a string of MACs separated by commas or spaces
+
+    Returns:
+        Optional[List[str]]: The MACs, None if the payload is neither
+    """
+    if isinstance(payload, str):
+        return payload.replace(",", " ").split()
+    if isinstance(payload, list) and all(
+            isinstance(mac, str) for mac in payload):
+        return payload
+    return None
+
+
+async def add_ruuvitags(payload, ruuvitags):
+    macs = parse_mac_list(payload)
+    if not macs:
+        return {"result": False, "data": "Cannot add empty list of MACs"}
+    try:
+        added = await ruuvitags.add_macs(macs)
+    except ValueError as ex:
+        logging.warning("Got illegal RuuviTag MACs: {}".format(ex))
+        return {"result": False, "data": "Not valid MAC addresses: " + str(ex)}
+    logging.info("Added RuuviTags {}".format(added))
+    return {
+        "result": True,
+        "data": {
+            "Added": added,
+            "Existing": [mac for mac in macs if mac not in added]
+        }
+    }
+
+
+async def remove_ruuvitags(payload,
+                           ruuvitags,
+                           tracker: Optional[SequenceTracker] = None,
+                           deadband: Optional[DeadbandFilter] = None):
+    macs = parse_mac_list(payload)
+    if not macs:
+        return {"result": False, "data": "Cannot remove empty list of MACs"}
+    try:
+        removed = await ruuvitags.remove_macs(macs)
+    except ValueError as ex:
+        logging.warning("Got illegal RuuviTag MACs: {}".format(ex))
+        return {"result": False, "data": "Not valid MAC addresses: " + str(ex)}
+    logging.info("Removed RuuviTags {}".format(removed))
+    for mac in removed:
+        forget_ruuvitag(mac, tracker, deadband)
+    return {
+        "result": True,
+        "data": {
+            "Removed": removed,
+            "Missing": [mac for mac in macs if mac not in removed]
+        }
+    }
+
+
 async def get_ruuvitags(data, ruuvitags):
     logging.info("Returning RuuviTags")
     macs = await ruuvitags.get_macs()
     return {"result": True, "data": macs}
 
 
-async def get_ruuvi_data(args, ruuvitags: List[str]):
-    if args.simulate:
-        data = {}
-        for tag in ruuvitags:
-            ran = randint(-1, 1)
-            data[tag] = {
-                "temperature": 15 + 3.2 * ran,
-                "humidity": 50 + 5.7 * ran,
-                "pressure": 950 + 20.5 * ran,
-                "battery": 3000 + 5 * ran,
-                "measurement_sequence_number": 1234 + 2 * ran
+async def set_publish_interval(request, ruuvitags):
+    if not isinstance(request, dict):
+        request = {"MAC": request}
+    mac = request.get("MAC")
+    if mac is None or not RuuviTags.is_legal_mac(mac):
+        logging.warning("Got illegal RuuviTag MAC {}".format(mac))
+        return {"result": False, "data": "Not a valid MAC address"}
+    interval = request.get("Interval")
+    if interval is not None and (isinstance(
+            interval, bool) or not isinstance(interval, int) or interval < 1):
+        return {
+            "result": False,
+            "data":
+            "Interval must be a whole number of seconds greater than zero"
+        }
+    if not await ruuvitags.set_interval(mac, interval):
+        return {"result": False, "data": "RuuviTag " + mac + " doesn't exist"}
+    if interval is None:
+        logging.info(
+            "Publishing RuuviTag {} at the default interval".format(mac))
+        return {
+            "result": True,
+            "data": "RuuviTag " + mac + " published at the default interval"
+        }
+    logging.info("Publishing RuuviTag {} every {}s".format(mac, interval))
+    return {
+        "result": True,
+        "data": "RuuviTag {} published every {}s".format(mac, interval)
+    }
+
+
+def parse_time(value: Any) -> float:
+    """
+    Args:
+        value (Any): POSIX timestamp or ISO 8601 time, UTC if without time zone
+
+    Returns:
+        float: POSIX timestamp
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    parsed = datetime.datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+
+async def get_history(request, ruuvitags, stores: Sequence["LocalStore"]):
+    if not stores:
+        return {"result": False, "data": "Measurements aren't stored locally"}
+    if not isinstance(request, dict):
+        request = {"MAC": request}
+    mac = request.get("MAC")
+    if mac is None or not RuuviTags.is_legal_mac(mac):
+        logging.warning("Got illegal RuuviTag MAC {}".format(mac))
+        return {"result": False, "data": "Not a valid MAC address"}
+    try:
+        end = parse_time(request["End"]) if request.get("End") else time.time()
+        start = parse_time(
+            request["Start"]) if request.get("Start") else end - 86400
+        points = int(request.get("Points") or 100)
+    except (TypeError, ValueError) as ex:
+        return {"result": False, "data": "Invalid request: {}".format(ex)}
+    if start >= end or points < 1:
+        return {"result": False, "data": "Invalid range"}
+    metrics = request.get("Metrics")
+    if isinstance(metrics, str):
+        metrics = [metrics]
+    elif metrics is not None and not (isinstance(metrics, list) and all(
+            isinstance(metric, str) for metric in metrics)):
+        return {
+            "result": False,
+            "data": "Metrics must be a metric or a list of metrics"
+        }
+    logging.info("Returning history of " + mac)
+    history = await stores[0].history(RuuviTags.normalize_mac(mac), start, end,
+                                      points, metrics)
+    return {"result": True, "data": {"MAC": mac, **history}}
+
+
+async def get_sequence_stats(mac, ruuvitags, tracker: SequenceTracker):
+    if mac is not None:
+        if not RuuviTags.is_legal_mac(mac):
+            logging.warning("Got illegal RuuviTag MAC " + mac)
+            return {"result": False, "data": "Not a valid MAC address"}
+        if ruuvitags.slot_number(mac) is None:
+            return {
+                "result": False,
+                "data": "RuuviTag " + mac + " doesn't exist"
             }
-        await asyncio.sleep(args.interval)
+        macs = [mac]
+    else:
+        macs = await ruuvitags.get_macs()
+    logging.info("Returning sequence statistics")
+    return {
+        "result": True,
+        "data": {
+            mac: tracker.stats(RuuviTags.normalize_mac(mac))
+            for mac in macs
+        }
+    }
+
+
+async def get_diagnostics(request, ruuvitags, diagnostics: Diagnostics):
+    if not isinstance(request, dict):
+        request = {"Duration": request}
+    try:
+        duration = float(request.get("Duration") or Diagnostics.Duration)
+        top = int(request.get("Top") or Diagnostics.Top)
+    except (TypeError, ValueError) as ex:
+        return {"result": False, "data": "Invalid request: {}".format(ex)}
+    if not 0 < duration <= Diagnostics.MaxDuration or not 0 < top <= Diagnostics.MaxTop:
+        return {
+            "result":
+            False,
+            "data":
+            "Duration must be within (0, {}] seconds and top within [1, {}]".
+            format(Diagnostics.MaxDuration, Diagnostics.MaxTop)
+        }
+    if diagnostics.running:
+        return {"result": False, "data": "Diagnostics already running"}
+    logging.info("Collecting diagnostics for {}s".format(duration))
+    return {"result": True, "data": await diagnostics.collect(duration, top)}
+
+
+def log_diagnostics(diagnostics: Diagnostics, running: Set[asyncio.Task]):
+    """
+    Collects diagnostics in the background and logs them, on a signal
+    """
+    if diagnostics.running:
+        logging.warning("Diagnostics already running")
+        return
+
+    async def collect():
+        logging.warning("Collecting diagnostics for {}s".format(
+            Diagnostics.Duration))
+        logging.warning("Diagnostics: " +
+                        json.dumps(await diagnostics.collect()))
+
+    # Referenced until done, the event loop keeps only weak references to tasks
+    task = asyncio.create_task(collect())
+    running.add(task)
+    task.add_done_callback(running.discard)
+
+
+async def watch_ruuvitags(ruuvitags: RuuviTags,
+                          tracker: Optional[SequenceTracker] = None,
+                          deadband: Optional[DeadbandFilter] = None):
+    try:
+        async for _ in FileWatcher(ruuvitags.path).changes():
+            _, removed = await ruuvitags.reload()
+            for mac in removed:
+                forget_ruuvitag(mac, tracker, deadband)
+    except asyncio.CancelledError:
+        logging.info("Exiting RuuviTags file watcher")
+
+
+async def simulated_advertisements(ruuvitags: RuuviTags, simulator: Simulator):
+    while True:
+        macs = await ruuvitags.get_normalized_macs()
+        for mac, data in simulator.readings(macs).items():
+            yield mac, data
+        await asyncio.sleep(1)
+
+
+async def get_ruuvi_data(ruuvitags: List[str],
+                         duration: float,
+                         simulator: Optional[Simulator] = None,
+                         adapters: Sequence[str] = ("", )):
+    if simulator is not None:
+        await asyncio.sleep(duration)
+        data = simulator.readings(ruuvitags)
     else:
         loop = asyncio.get_event_loop()
-        data = await loop.run_in_executor(None,
-                                          RuuviTagSensor.get_data_for_sensors,
-                                          ruuvitags, args.interval)
+        start = time.monotonic()
+        # Scan on every adapter in parallel
+        scans = await asyncio.gather(*[
+            loop.run_in_executor(None, RuuviTagSensor.get_data_for_sensors,
+                                 ruuvitags, duration, adapter)
+            for adapter in adapters
+        ])
+        data = merge_readings(scans)
+        metrics.SCAN_DURATION.observe(time.monotonic() - start)
     return data
 
 
-async def send_ruuvi_data(publisher: DataPublisher, ruuvitags, data):
+async def send_ruuvi_data(publisher: DataPublisher,
+                          ruuvitags: RuuviTags,
+                          data,
+                          deadband: Optional[DeadbandFilter] = None,
+                          stats: Optional[SequenceTracker] = None,
+                          schema: str = "slots"):
+    """
+    Publishes the readings of the RuuviTags in use as one MeasurementBatch. In the
+    "slots" schema every measurement is a telemetry field numbered by the slot of
+    its RuuviTag, e.g. "Temperature1", and in the "map" schema the measurements of
+    every RuuviTag are published under "Tags" keyed by its normalized MAC.
+    """
+    metrics.TAGS_CONFIGURED.set(len(ruuvitags))
+    metrics.TAGS_SEEN.set(len(data))
+    batch = MeasurementBatch(MEASUREMENTS, RuuviTags.Telemetry, schema)
     for mac, data in data.items():
-        await publisher.buffer_data({
-            "Temperature" + str(ruuvitags.index(mac) + 1):
-            data["temperature"],
-            "Humidity" + str(ruuvitags.index(mac) + 1):
-            data["humidity"],
-            "Pressure" + str(ruuvitags.index(mac) + 1):
-            data["pressure"],
-            "Battery" + str(ruuvitags.index(mac) + 1):
-            data["battery"],
-            "Sequence" + str(ruuvitags.index(mac) + 1):
-            data["measurement_sequence_number"]
-        })
-    await publisher.publish_data()
-
-
-async def publish_ruuvi_data(args, publisher: DataPublisher,
-                             ruuvitags: RuuviTags):
+        slot = ruuvitags.slot_number(mac)
+        if slot is None:
+            continue
+        normalized = RuuviTags.normalize_mac(mac)
+        metrics.tag_seen(normalized, data.get("rssi"))
+        if deadband is not None:
+            data = deadband.filter(mac, data)
+        if stats is not None:
+            batch.add(normalized, slot, data, stats.ratios(mac))
+        else:
+            batch.add(normalized, slot, data)
+    start = time.monotonic()
+    await publish_batch(publisher, batch)
+    metrics.PUBLISH_DURATION.observe(time.monotonic() - start)
+
+
+async def publish_ruuvi_data(args,
+                             publisher: DataPublisher,
+                             ruuvitags: RuuviTags,
+                             scanner: Optional[RuuviScanner] = None,
+                             simulator: Optional[Simulator] = None,
+                             tracker: Optional[SequenceTracker] = None,
+                             deadband: Optional[DeadbandFilter] = None):
+    scheduler = TagScheduler(args.interval, args.align)
+    adapters = args.adapters or [""]
+    metrics.CYCLE_OVERRUNS.set_function(lambda: {(): scheduler.overruns})
+    metrics.CYCLE_SKIPPED.set_function(lambda: {(): scheduler.skipped})
+    stats = tracker if args.sequence_stats else None
     while True:
         try:
-            macs = await ruuvitags.get_macs()
+            macs = await ruuvitags.get_normalized_macs()
+            scheduler.update(await ruuvitags.get_intervals())
             if macs:
-                data = await get_ruuvi_data(args, macs)
+                if scanner is None:
+                    # Scan until the next tick, delaying a tick that is due
+                    # too soon for a scan to hear the RuuviTags
+                    duration = max(
+                        scheduler.remaining(),
+                        min(MIN_SCAN_DURATION, scheduler.shortest()))
+                    data = await get_ruuvi_data(macs, duration, simulator,
+                                                adapters)
+                    due = set(await scheduler.wait())
+                    # Publish the RuuviTags due, dropping the measurements
+                    # already published
+                    data = {
+                        mac: reading
+                        for mac, reading in data.items()
+                        if (mac in due or RuuviTags.normalize_mac(mac) in due)
+                        and (tracker is None or tracker.observe(mac, reading))
+                    }
+                else:
+                    due_macs = await scheduler.wait()
+                    # The readings of the RuuviTags not due are kept for their tick
+                    data = scanner.snapshot(due_macs,
+                                            clear=len(due_macs) >= len(macs))
                 if data:
-                    await send_ruuvi_data(publisher, macs, data)
+                    await send_ruuvi_data(publisher, ruuvitags, data, deadband,
+                                          stats, args.schema)
                 else:
                     logging.warning(
                         "Could not read any RuuviTag data. Please make sure that the specified RuuviTags are within range."
                     )
             else:
                 logging.info("No RuuviTags specified.")
-                await asyncio.sleep(args.interval)
+                await scheduler.wait()
         except asyncio.CancelledError:
             break
+        except Exception as ex:
+            logging.error("Publishing RuuviTag data failed: {} {}".format(
+                type(ex).__name__, ex.args))
 
 
 def cancel_tasks(signal, *tasks):
@@ -173,20 +878,73 @@ def cancel_tasks(signal, *tasks):
         task.cancel()
 
 
+async def replay_and_exit(scanner: RuuviScanner, interval: float, *tasks):
+    if await scanner.run():
+        logging.info("Replay finished")
+        # Let the readings of the last interval be published
+        await asyncio.sleep(interval)
+        for task in tasks:
+            task.cancel()
+
+
 async def dummy_task():
     await asyncio.sleep(1)
 
 
-def parse_args():
+def sink_policy(spec: str) -> Tuple[str, str]:
+    name, _, policy = spec.partition("=")
+    if policy not in Sink.Policies:
+        raise argparse.ArgumentTypeError("Expected SINK={}, got '{}'".format(
+            "|".join(Sink.Policies), spec))
+    return name, policy
+
+
+def create_publisher(args, factories) -> DataPublisher:
+    """
+    Returns:
+        DataPublisher: The publisher of the mode, or one fanning out to the
+            publishers of every mode if several were given
+    """
+    modes = list(dict.fromkeys(args.mode))
+    if len(modes) == 1:
+        return factories[modes[0]]()
+    return FanOut({mode: factories[mode]()
+                   for mode in modes}, args.sink_queue,
+                  dict(args.sink_policy or []))
+
+
+def get_publishers(client: DataPublisher) -> List[DataPublisher]:
+    """
+    Returns:
+        List[DataPublisher]: The publishers a publisher fans out to, or the
+            publisher itself
+    """
+    if isinstance(client, FanOut):
+        return [sink.publisher for sink in client.sinks]
+    return [client]
+
+
+def deadband_threshold(spec: str):
+    try:
+        return DeadbandFilter.parse_threshold(spec)
+    except ValueError as ex:
+        raise argparse.ArgumentTypeError(str(ex))
+
+
+def parse_args(factories=None):
+    factories = factories if factories is not None else available_factories()
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '-m',
         '--mode',
         dest='mode',
         type=str,
-        default='azure',
-        choices=['azure', 'stdout'],
-        help='RuuviTag measurements output destination (default: %(default)s)')
+        nargs='+',
+        default=['azure'],
+        choices=sorted(factories),
+        help=
+        'RuuviTag measurements output destinations, each published to through its own queue if several (default: %(default)s)'
+    )
     parser.add_argument('-r',
                         '--ruuvitags',
                         dest='ruuvitags',
@@ -219,6 +977,135 @@ def parse_args():
                         action='store_true',
                         default=False,
                         help='Use simulated RuuviTag measurements')
+    parser.add_argument(
+        '--seed',
+        dest='seed',
+        type=int,
+        default=None,
+        help='Seed of the simulated RuuviTag measurements (default: random)')
+    parser.add_argument(
+        '--packet-loss',
+        dest='packet_loss',
+        type=float,
+        default=0.0,
+        help=
+        'Probability of losing a simulated RuuviTag measurement (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--continuous',
+        action='store_true',
+        default=False,
+        help=
+        'Scan RuuviTags continuously in the background and publish the latest measurements every interval'
+    )
+    parser.add_argument(
+        '--sequence-stats',
+        dest='sequence_stats',
+        action='store_true',
+        default=False,
+        help=
+        'Publish the rolling packet loss and duplicate ratios of every RuuviTag. Requires --continuous'
+    )
+    parser.add_argument(
+        '--adapter',
+        dest='adapters',
+        action='append',
+        metavar='ADAPTER',
+        help=
+        'Bluetooth adapter to scan on, e.g. hci1. Can be repeated to scan on several adapters in parallel (default: the default adapter)'
+    )
+    parser.add_argument(
+        '--record',
+        dest='record',
+        type=str,
+        default=None,
+        metavar='FILE',
+        help=
+        'Append the raw BLE advertisements to a binary log. Requires --continuous'
+    )
+    parser.add_argument(
+        '--replay',
+        dest='replay',
+        type=str,
+        default=None,
+        metavar='FILE',
+        help=
+        'Scan the raw BLE advertisements of a log written with --record instead of BLE and exit at its end. Requires --continuous'
+    )
+    parser.add_argument(
+        '--speed',
+        dest='speed',
+        type=float,
+        default=1.0,
+        help='Multiple of real time to replay the log at (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--align',
+        action='store_true',
+        default=False,
+        help='Align the publish ticks to wall-clock multiples of the interval')
+    parser.add_argument(
+        '--aggregate',
+        action='store_true',
+        default=False,
+        help=
+        'Publish the minimum, maximum and mean of every measurement and the number of samples of each interval. Requires --continuous'
+    )
+    parser.add_argument(
+        '--deadband',
+        dest='deadband',
+        action='append',
+        type=deadband_threshold,
+        metavar='METRIC=THRESHOLD[%]',
+        help=
+        'Publish a measurement only when it has changed more than the absolute or relative threshold, e.g. temperature=0.2 or pressure=0.1%%. Can be repeated for several metrics'
+    )
+    parser.add_argument(
+        '--metrics-port',
+        dest='metrics_port',
+        type=int,
+        default=None,
+        help='Serve Prometheus metrics over HTTP on the given port')
+    parser.add_argument(
+        '--metrics-host',
+        dest='metrics_host',
+        type=str,
+        default='127.0.0.1',
+        help='Address to serve the metrics on (default: %(default)s)')
+    parser.add_argument(
+        '--schema',
+        dest='schema',
+        type=str,
+        default='slots',
+        choices=SCHEMAS,
+        help=
+        'Telemetry schema: fields numbered by the slot of their RuuviTag, e.g. Temperature1, or the measurements of every RuuviTag keyed by its MAC under Tags (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--sink-queue',
+        dest='sink_queue',
+        type=int,
+        default=FanOut.QueueSize,
+        help=
+        'Batches queued per output destination when publishing to several (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--sink-policy',
+        dest='sink_policy',
+        action='append',
+        type=sink_policy,
+        metavar='MODE=drop|block',
+        help=
+        'What to do when the queue of an output destination is full: drop the oldest batch (default) or make the publishing wait. Can be repeated for several destinations'
+    )
+    parser.add_argument(
+        '--heartbeat',
+        dest='heartbeat',
+        type=int,
+        default=900,
+        help=
+        'Interval (seconds) in which all measurements are published regardless of the deadbands (default: %(default)s)'
+    )
 
     args = parser.parse_args()
 
@@ -227,15 +1114,15 @@ def parse_args():
         parser.print_help(sys.stderr)
         sys.exit(exit_code)
 
-    if args.mode == "stdout":
+    if set(args.mode) == {"stdout"}:
         if args.config is not None:
             logging.warning("Configuration file ignored in 'stdout' mode")
     else:
-        if args.config is None:
+        if args.config is None and not set(args.mode) <= CONFIGLESS:
             report_and_exit(
                 "Configuration file needed when not using 'stdout' mode!",
                 os.EX_USAGE)
-        if not os.path.exists(args.config):
+        if args.config is not None and not os.path.exists(args.config):
             report_and_exit(
                 "Given configuration doesn't exist! ({})".format(args.config),
                 os.EX_NOINPUT)
@@ -243,6 +1130,48 @@ def parse_args():
     if args.interval < 1:
         report_and_exit("Interval must be greater than zero", os.EX_DATAERR)
 
+    if args.sink_queue < 1:
+        report_and_exit("Sink queue must hold at least one batch",
+                        os.EX_DATAERR)
+
+    for name, _ in args.sink_policy or []:
+        if name not in args.mode:
+            report_and_exit("Sink policy of unused mode '{}'".format(name),
+                            os.EX_USAGE)
+
+    if args.aggregate and not args.continuous:
+        report_and_exit("Aggregation requires continuous scanning",
+                        os.EX_USAGE)
+
+    if args.sequence_stats and not args.continuous:
+        report_and_exit("Sequence statistics require continuous scanning",
+                        os.EX_USAGE)
+
+    if (args.record or args.replay) and not args.continuous:
+        report_and_exit("Recording and replaying require continuous scanning",
+                        os.EX_USAGE)
+
+    if args.record and (args.replay or args.simulate):
+        report_and_exit("Only BLE advertisements can be recorded", os.EX_USAGE)
+
+    if args.replay and args.simulate:
+        report_and_exit("Replaying and simulating are mutually exclusive",
+                        os.EX_USAGE)
+
+    if args.replay and not os.path.exists(args.replay):
+        report_and_exit(
+            "Given recording doesn't exist! ({})".format(args.replay),
+            os.EX_NOINPUT)
+
+    if args.speed <= 0:
+        report_and_exit("Speed must be greater than zero", os.EX_DATAERR)
+
+    if not 0 <= args.packet_loss <= 1:
+        report_and_exit("Packet loss must be between 0 and 1", os.EX_DATAERR)
+
+    if args.heartbeat < 1:
+        report_and_exit("Heartbeat must be greater than zero", os.EX_DATAERR)
+
     return args
 
 
@@ -252,22 +1181,107 @@ async def main(args, tags: RuuviTags, client: DataPublisher):
     except ConnectionError:
         sys.exit(os.EX_UNAVAILABLE)
 
-    listeners = [
-        asyncio.create_task(
-            client.execute_method_listener("AddRuuviTag", add_ruuvitag, tags))
-    ]
-    listeners.append(
-        asyncio.create_task(
-            client.execute_method_listener("RemoveRuuviTag", remove_ruuvitag,
-                                           tags)))
-    listeners.append(
-        asyncio.create_task(
-            client.execute_method_listener("GetRuuviTags", get_ruuvitags,
-                                           tags)))
+    # Every advertisement is observed when scanning continuously, otherwise only
+    # the latest one of each interval
+    tracker = SequenceTracker(count_gaps=args.continuous)
+    deadband = None
+    if args.deadband:
+        deadband = DeadbandFilter(dict(args.deadband), args.heartbeat)
+    diagnostics = Diagnostics()
+    # Publishers keeping the measurements locally, the backends aren't imported
+    # unless in use
+    stores = cast(List["LocalStore"], [
+        publisher for publisher in get_publishers(client)
+        if hasattr(publisher, "history")
+    ])
+    for publisher in get_publishers(client):
+        if hasattr(publisher, "slot_mac"):
+            publisher.slot_mac = tags.slot_mac  # type: ignore
+    methods = {
+        "AddRuuviTag":
+        add_ruuvitag,
+        "RemoveRuuviTag":
+        functools.partial(remove_ruuvitag, tracker=tracker, deadband=deadband),
+        "GetRuuviTags":
+        get_ruuvitags,
+        "SetPublishInterval":
+        set_publish_interval,
+        "AddRuuviTags":
+        add_ruuvitags,
+        "RemoveRuuviTags":
+        functools.partial(remove_ruuvitags, tracker=tracker,
+                          deadband=deadband),
+        "GetSequenceStats":
+        functools.partial(get_sequence_stats, tracker=tracker),
+        "GetHistory":
+        functools.partial(get_history, stores=stores),
+        "GetDiagnostics":
+        functools.partial(get_diagnostics, diagnostics=diagnostics),
+    }
+    for method_name, handler in methods.items():
+        client.register_method_handler(method_name, handler, tags)
+    listeners = [asyncio.create_task(client.execute_method_dispatcher())]
+
+    simulator = None
+    if args.simulate:
+        simulator = Simulator(args.seed, args.packet_loss)
+
+    scanner = None
+    recorder = None
+    adapters = args.adapters or [""]
+    if args.continuous:
+        if simulator is not None:
+            scanner = RuuviScanner(functools.partial(simulated_advertisements,
+                                                     tags, simulator),
+                                   args.aggregate,
+                                   tracker=tracker,
+                                   registered=tags.__contains__)
+        elif args.replay:
+            replayed = functools.partial(replayed_advertisements, args.replay,
+                                         args.speed)
+            scanner = RuuviScanner(functools.partial(decoded_advertisements,
+                                                     replayed),
+                                   args.aggregate,
+                                   restart=False,
+                                   tracker=tracker,
+                                   registered=tags.__contains__)
+        elif args.record:
+            recorder = AdvertisementRecorder(args.record)
+            raw = functools.partial(merge_sources, [
+                functools.partial(raw_ble_advertisements, adapter)
+                for adapter in adapters
+            ])
+            scanner = RuuviScanner(functools.partial(decoded_advertisements,
+                                                     raw, recorder),
+                                   args.aggregate,
+                                   tracker=tracker,
+                                   registered=tags.__contains__)
+        else:
+            scanner = RuuviScanner(functools.partial(merge_sources, [
+                functools.partial(ble_advertisements, adapter)
+                for adapter in adapters
+            ]),
+                                   args.aggregate,
+                                   tracker=tracker,
+                                   registered=tags.__contains__)
 
     tasks = listeners + [
-        asyncio.create_task(publish_ruuvi_data(args, client, tags))
+        asyncio.create_task(
+            publish_ruuvi_data(args, client, tags, scanner, simulator, tracker,
+                               deadband))
     ]
+    tasks.append(asyncio.create_task(watch_ruuvitags(tags, tracker, deadband)))
+    if scanner is not None and args.replay:
+        tasks.append(
+            asyncio.create_task(replay_and_exit(scanner, args.interval,
+                                                *tasks)))
+    elif scanner is not None:
+        tasks.append(asyncio.create_task(scanner.run()))
+    if args.metrics_port is not None:
+        tasks.append(
+            asyncio.create_task(
+                metrics.serve_metrics(args.metrics_host, args.metrics_port)))
+        tasks.append(asyncio.create_task(metrics.monitor_event_loop_lag()))
     loop = asyncio.get_event_loop()
 
     # Signals to initiate a graceful shutdown
@@ -275,15 +1289,31 @@ async def main(args, tags: RuuviTags, client: DataPublisher):
         loop.add_signal_handler(
             getattr(signal, signame),
             functools.partial(cancel_tasks, signame, *tasks))
+    # Signal to log diagnostics
+    collecting: Set[asyncio.Task] = set()
+    loop.add_signal_handler(
+        signal.SIGUSR1,
+        functools.partial(log_diagnostics, diagnostics, collecting))
 
     await asyncio.gather(*tasks)
+    await tags.flush()
+    for store in stores:
+        await store.disconnect()
+    if recorder is not None:
+        logging.info("Recorded {} advertisements".format(recorder.records))
+        recorder.close()
 
 
 if __name__ == '__main__':
     assert sys.version_info >= (3, 10), "Python 3.10 or greater required"
-    args = parse_args()
+    factories = available_factories()
+    args = parse_args(factories)
     logging.basicConfig(level=args.log_level)
     tags = RuuviTags(args.ruuvitags.name)
-    client = FACTORIES[args.mode]()
+    try:
+        client = create_publisher(args, factories)
+    except ImportError as ex:
+        logging.error("Publisher unavailable: {}".format(ex))
+        sys.exit(os.EX_UNAVAILABLE)
     asyncio.run(main(args, tags, client))
     logging.info("RuuviGate was shutdown")
@@ -0,0 +1,68 @@
+from typing import Any, Dict, Optional, Tuple
+
+
+class RunningStats:
+    '''
+    Minimum, maximum, mean and last value of a metric without keeping the samples
+    '''
+    __slots__ = ("count", "minimum", "maximum", "total", "last")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.minimum = 0.0
+        self.maximum = 0.0
+        self.total = 0.0
+        self.last = 0.0
+
+    def add(self, value: float) -> None:
+        if self.count == 0:
+            self.minimum = self.maximum = value
+        elif value < self.minimum:
+            self.minimum = value
+        elif value > self.maximum:
+            self.maximum = value
+        self.total += value
+        self.last = value
+        self.count += 1
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self.total / self.count if self.count else None
+
+
+class TagWindow:
+    '''
+    Aggregates the readings of one RuuviTag over a publish window
+    '''
+    __slots__ = ("samples", "stats")
+    Metrics = ("temperature", "humidity", "pressure", "battery")
+    # Reading keys of the minimum, maximum and mean of each metric
+    Keys: Tuple[Tuple[str, str, str], ...] = tuple(
+        (metric + "_min", metric + "_max", metric + "_mean")
+        for metric in Metrics)
+    SamplesKey = "samples"
+
+    def __init__(self) -> None:
+        self.samples = 0
+        self.stats = tuple(RunningStats() for _ in self.Metrics)
+
+    def add(self, reading: Dict[str, Any]) -> None:
+        self.samples += 1
+        for stats, metric in zip(self.stats, self.Metrics):
+            value = reading.get(metric)
+            if value is not None:
+                stats.add(value)
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Returns:
+            Dict[str, Any]: Number of samples and the minimum, maximum and mean of
+                every metric that had values in the window
+        """
+        summary: Dict[str, Any] = {self.SamplesKey: self.samples}
+        for stats, (minimum, maximum, mean) in zip(self.stats, self.Keys):
+            if stats.count:
+                summary[minimum] = stats.minimum
+                summary[maximum] = stats.maximum
+                summary[mean] = stats.mean
+        return summary
@@ -0,0 +1,159 @@
+import json
+from array import array
+from typing import Any, Dict, Iterator, List, Mapping, Sequence, Tuple, Union
+
+# In the "map" schema the measurements are published under this field, keyed by
+# the normalized MAC of their RuuviTag, e.g. {"Tags": {"AA:..": {"Temperature":}}}
+TAGS_FIELD = "Tags"
+
+# Types of the values published, bools and Nones are left out
+_NUMBERS = (int, float)
+
+
+class MeasurementBatch:
+    '''
+    Measurements of the RuuviTags of one publish cycle. Instead of a dict per
+    RuuviTag, the measurements are kept flat: the values as read, the numbers of
+    their telemetry fields, slot * len(names) + column, in an array and the offset
+    of the first measurement of every RuuviTag. A batch is serialized once, by the
+    publisher sending it, in the telemetry schema it was built for. Publishers may
+    share a batch, so it must not be modified once published.
+    '''
+    __slots__ = ("names", "schema", "macs", "offsets", "fields", "values",
+                 "_index")
+
+    def __init__(self,
+                 keys: Sequence[str],
+                 names: Sequence[str],
+                 schema: str = "slots"):
+        """
+        Args:
+            keys (Sequence[str]): Keys of the measurements in the readings
+            names (Sequence[str]): Telemetry names of the measurements, in the
+                order of the keys
+            schema (str): "slots" for telemetry fields numbered by the slot of
+                their RuuviTag, "map" for the measurements keyed by MAC under "Tags"
+        """
+        self.names = tuple(names)
+        self.schema = schema
+        self._index = {key: column for column, key in enumerate(keys)}
+        self.macs: List[str] = []
+        self.offsets = array("L")
+        self.fields = array("L")
+        self.values: List[Union[int, float]] = []
+
+    def __len__(self) -> int:
+        return len(self.macs)
+
+    def add(self, mac: str, slot: int, *readings: Mapping[str, Any]) -> None:
+        """
+        Adds the measurements of a RuuviTag. Keys that aren't measurements, and
+        values that aren't numbers, are left out.
+
+        Args:
+            mac (str): Normalized MAC of the RuuviTag
+            slot (int): Slot number of the RuuviTag, e.g. 1 for "Temperature1"
+            readings (Mapping[str, Any]): Measurements of the RuuviTag by key, with
+                no key in several readings
+        """
+        self.macs.append(mac)
+        self.offsets.append(len(self.values))
+        index, fields, values = self._index, self.fields, self.values
+        base = slot * len(self.names)
+        for reading in readings:
+            for key, value in reading.items():
+                column = index.get(key)
+                if column is not None and type(value) in _NUMBERS:
+                    fields.append(base + column)
+                    values.append(value)
+
+    def measurements(self) -> Iterator[Tuple[str, str, Union[int, float]]]:
+        """
+        Returns:
+            Iterator[Tuple[str, str, Union[int, float]]]: MAC, telemetry name and value of
+                every measurement
+        """
+        names = _FieldNames.of(self.names, self.fields).names
+        for row, mac in enumerate(self.macs):
+            start, end = self.__span(row)
+            for field, value in zip(self.fields[start:end],
+                                    self.values[start:end]):
+                yield mac, names[field], value
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Returns:
+            Dict[str, Any]: The measurements as telemetry in the schema of the batch
+        """
+        names = _FieldNames.of(self.names, self.fields)
+        values = self.values
+        if self.schema != "map":
+            return dict(zip(map(names.fields.__getitem__, self.fields),
+                            values))
+        if not self.macs:
+            return {}
+        return {
+            TAGS_FIELD: {
+                mac: self.__measurements(row, names.names, values)
+                for row, mac in enumerate(self.macs)
+            }
+        }
+
+    def to_json(self) -> bytes:
+        """
+        Returns:
+            bytes: to_dict() as JSON
+        """
+        return json.dumps(self.to_dict()).encode()
+
+    def tags_json(self) -> Iterator[Tuple[str, bytes]]:
+        """
+        Returns:
+            Iterator[Tuple[str, bytes]]: MAC of every RuuviTag and its measurements
+                as a JSON object by telemetry name
+        """
+        names = _FieldNames.of(self.names, self.fields).names
+        values = self.values
+        for row, mac in enumerate(self.macs):
+            yield mac, json.dumps(self.__measurements(row, names,
+                                                      values)).encode()
+
+    def __span(self, row: int) -> Tuple[int, int]:
+        end = self.offsets[row + 1] if row + 1 < len(self.offsets) else len(
+            self.values)
+        return self.offsets[row], end
+
+    def __measurements(self, row: int, names: List[str],
+                       values: List[Union[int, float]]) -> Dict[str, Any]:
+        start, end = self.__span(row)
+        return dict(
+            zip(map(names.__getitem__, self.fields[start:end]),
+                values[start:end]))
+
+
+class _FieldNames:
+    '''
+    Names of the telemetry fields by number, shared by the batches of the same
+    measurements and grown as RuuviTags take new slots
+    '''
+    __slots__ = ("width", "fields", "names")
+    _shared: Dict[Tuple[str, ...], "_FieldNames"] = {}
+
+    def __init__(self, names: Tuple[str, ...]):
+        self.width = len(names)
+        # Field names, e.g. "Temperature1", and measurement names by field number
+        self.fields: List[str] = []
+        self.names: List[str] = []
+
+    @classmethod
+    def of(cls, names: Tuple[str, ...], fields: array) -> "_FieldNames":
+        shared = cls._shared.get(names)
+        if shared is None:
+            shared = cls._shared[names] = cls(names)
+        if fields and max(fields) >= len(shared.fields):
+            for slot in range(
+                    len(shared.fields) // shared.width,
+                    max(fields) // shared.width + 1):
+                shared.fields.extend(name + str(slot) for name in names)
+                shared.names.extend(names)
+        return shared
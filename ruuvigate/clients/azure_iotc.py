@@ -4,9 +4,12 @@ import json
 import uuid
 import logging
 import asyncio
+import datetime
+import time
+import gzip
 import yaml
 from enum import Enum
-from typing import Any, Callable
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 
 # Type information will be there, eventually: https://github.com/Azure/azure-iot-sdk-python/pull/1163
 from azure.iot.device.aio import IoTHubDeviceClient  # type: ignore
@@ -14,17 +17,18 @@ from azure.iot.device.aio import ProvisioningDeviceClient  # type: ignore
 from azure.iot.device import MethodResponse  # type: ignore
 from azure.iot.device import Message  # type: ignore
 
+from ruuvigate import metrics
+from ruuvigate.batch import MeasurementBatch
+from .diskqueue import DiskQueue, Position
+from .provisioning import ProvisioningCache
+from .methods import MethodHandler, call_method
+
 
 class AzureIOTC:
     '''
     Class to provide device connectivity to an Azure IoT Central application with
     Azure IoT SDK (https://github.com/Azure/azure-iot-sdk-python)
     '''
-    MethodNames = {
-        "AddRuuviTag": "RuuviGate_250*AddRuuviTag",
-        "RemoveRuuviTag": "RuuviGate_250*RemoveRuuviTag",
-        "GetRuuviTags": "RuuviGate_250*GetRuuviTags"
-    }
 
     class AzureParams(Enum):
         DeviceKey = "IOTHUB_DEVICE_DPS_DEVICE_KEY"
@@ -33,13 +37,56 @@ class AzureIOTC:
         ProvisioningHost = "IOTHUB_DEVICE_DPS_ENDPOINT"
         ModelID = "IOTHUB_DEVICE_DPS_MODEL_ID"
 
+    # Optional configurations and their defaults
+    Options = {
+        "RUUVIGATE_QUEUE_DIR":
+        os.path.join(os.path.expanduser("~"), ".ruuvigate", "queue"),
+        "RUUVIGATE_QUEUE_MAX_BYTES":
+        64 * 1024 * 1024,
+        "RUUVIGATE_REPLAY_BATCH":
+        10,
+        "RUUVIGATE_REPLAY_DELAY":
+        1.0,
+        # Seconds before a failed send is retried, doubled after every failure up
+        # to the maximum
+        "RUUVIGATE_RETRY_MIN":
+        1.0,
+        "RUUVIGATE_RETRY_MAX":
+        60.0,
+        # Batching is disabled when the maximum age is zero
+        "RUUVIGATE_BATCH_MAX_AGE":
+        0,
+        "RUUVIGATE_BATCH_MAX_BYTES":
+        240 * 1024,
+        "RUUVIGATE_BATCH_GZIP":
+        False,
+        # Provisioning isn't cached when empty
+        "RUUVIGATE_PROVISIONING_CACHE":
+        os.path.join(os.path.expanduser("~"), ".ruuvigate",
+                     "provisioning.json"),
+        # Direct method requests handled at a time, and seconds a request may take
+        # before it's answered with a timeout
+        "RUUVIGATE_METHOD_CONCURRENCY":
+        4,
+        "RUUVIGATE_METHOD_TIMEOUT":
+        20.0
+    }
+    # Maximum number of queued readings packed into one message
+    BatchRecords = 1000
+
     class Message(Enum):
         Encoding = "utf8"
         ContentType = "application/json"
+        Compressed = "gzip"
 
     def __init__(self):
         self._client = None
         self._databuf = {}
+        self._queue: Optional[DiskQueue] = None
+        self._sender: Optional[asyncio.Task] = None
+        self._queued: Optional[asyncio.Event] = None
+        self._options = dict(self.Options)
+        self._methods: Dict[str, Tuple[MethodHandler, Any]] = {}
         atexit.register(self.disconnect)
 
     def __connected(func: Callable) -> Any:  # type: ignore
@@ -52,9 +99,36 @@ class AzureIOTC:
 
     async def connect(self, config_path: str):
         config = self.__parse_config(config_path)
+        self._options.update(
+            {key: config[key]
+             for key in self.Options if key in config})
+        self._queue = DiskQueue(self._options["RUUVIGATE_QUEUE_DIR"],
+                                self._options["RUUVIGATE_QUEUE_MAX_BYTES"])
+        if len(self._queue):
+            logging.info("Found queued messages: {}".format(
+                self._queue.stats()))
+
+        key = ProvisioningCache.key(config, (param.value
+                                             for param in self.AzureParams))
+        cache = ProvisioningCache(
+            self._options["RUUVIGATE_PROVISIONING_CACHE"])
+        cached = cache.load(key)
+        if cached is not None:
+            device_host, device_id = cached
+            logging.info("Using cached device hostname: " + device_host)
+            try:
+                await self.__open_connection(
+                    device_host, device_id,
+                    config[self.AzureParams.DeviceKey.value])
+                return
+            except Exception as ex:
+                logging.warning(
+                    "Connecting to the cached hub failed, provisioning again: "
+                    "{} {}".format(type(ex).__name__, ex.args))
+                cache.clear()
 
         # Provision the device
-        device_host = await self.__provision_device(
+        device_host, device_id = await self.__provision_device(
             config[self.AzureParams.ProvisioningHost.value],
             config[self.AzureParams.DeviceIDScope.value],
             config[self.AzureParams.DeviceID.value],
@@ -63,69 +137,274 @@ class AzureIOTC:
 
         logging.info("Got device hostname: " + device_host)
 
-        # Open the connection
         try:
-            self._client = IoTHubDeviceClient.create_from_symmetric_key(
-                symmetric_key=config[self.AzureParams.DeviceKey.value],
-                hostname=device_host,
-                device_id=config[self.AzureParams.DeviceID.value],
-            )
-            await self._client.connect()
+            await self.__open_connection(
+                device_host, device_id,
+                config[self.AzureParams.DeviceKey.value])
         except Exception as ex:
             logging.error("Unable to connect to Azure: {} {}".format(
                 type(ex).__name__, ex.args))
-            self._client = None
             raise ConnectionError()
+        cache.store(key, device_host, device_id)
+
+    async def __open_connection(self, device_host: str, device_id: str,
+                                symmetric_key: str):
+        client = IoTHubDeviceClient.create_from_symmetric_key(
+            symmetric_key=symmetric_key,
+            hostname=device_host,
+            device_id=device_id,
+        )
+        try:
+            await client.connect()
+        except BaseException:
+            await client.shutdown()
+            raise
+        self._client = client
+        # Sends the messages left queued by earlier runs
+        self.__start_sender()
 
     async def disconnect(self):
+        if self._sender is not None:
+            self._sender.cancel()
+            self._sender = None
         if self._client != None:
             logging.info("Disconnecting AzureIOTC")
             await self._client.shutdown()
             self._client = None
+        if self._queue is not None:
+            self._queue.close()
+            self._queue = None
+
+    def register_method_handler(self,
+                                method_name: str,
+                                handler: MethodHandler,
+                                cookie: Any = None) -> None:
+        """
+        Registers the handler of a direct method. Requests of the method name are
+        answered with the handler, whichever component of the device model they
+        are sent to.
+
+        Args:
+            method_name (str): Name of the method without the component, e.g.
+                "AddRuuviTag"
+            handler (MethodHandler): Coroutine function called with the payload of
+                the request and the cookie. Returns the response payload, with
+                "result" telling success.
+            cookie (Any): Passed to the handler
+        """
+        self._methods[method_name] = (handler, cookie)
 
     @__connected
-    async def execute_method_listener(self, method_name, handler, cookie):
-        logging.info("Executing a listener for \"" + method_name + "\" method")
-        while True:
-            try:
-                method_request = await self._client.receive_method_request(
-                    self.MethodNames.get(method_name))
-                logging.info("Received method request \"" + method_name + "\"")
+    async def execute_method_dispatcher(self):
+        """
+        Receives the requests of every direct method and handles them concurrently,
+        up to RUUVIGATE_METHOD_CONCURRENCY at a time. A request not handled within
+        RUUVIGATE_METHOD_TIMEOUT seconds of its arrival is answered with status 504.
+        """
+        logging.info("Executing a dispatcher for methods: {}".format(", ".join(
+            self._methods)))
+        limit = asyncio.Semaphore(
+            self._options["RUUVIGATE_METHOD_CONCURRENCY"])
+        running: Set[asyncio.Task] = set()
+        try:
+            while True:
+                method_request = await self._client.receive_method_request()
+                task = asyncio.create_task(
+                    self.__dispatch(method_request, limit))
+                running.add(task)
+                task.add_done_callback(running.discard)
+        except asyncio.CancelledError:
+            logging.info("Exiting method dispatcher")
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
 
-                response_payload = await handler(method_request.payload,
-                                                 cookie)
-                response_status = 200 if response_payload.get(
-                    "result") else 400
+    async def __dispatch(self, method_request, limit: asyncio.Semaphore):
+        # Methods of a component are named "<component>*<method>"
+        method_name = method_request.name.rpartition("*")[2]
+        logging.info("Received method request \"" + method_name + "\"")
+        status, payload = await call_method(
+            method_name, self._methods.get(method_name),
+            method_request.payload, limit,
+            self._options["RUUVIGATE_METHOD_TIMEOUT"])
 
-                command_response = MethodResponse.create_from_method_request(
-                    method_request, response_status, response_payload)
-                try:
-                    await self._client.send_method_response(command_response)
-                except RuntimeError:
-                    logging.error(
-                        "Responding to command request \"{}\" failed".format(
-                            method_name))
-            except asyncio.CancelledError:
-                logging.info("Exiting \"" + method_name + "\" listener")
-                break
+        command_response = MethodResponse.create_from_method_request(
+            method_request, status, payload)
+        try:
+            await asyncio.wait_for(
+                self._client.send_method_response(command_response),
+                self._options["RUUVIGATE_METHOD_TIMEOUT"])
+        except (RuntimeError, asyncio.TimeoutError):
+            logging.error("Responding to command request \"{}\" failed".format(
+                method_name))
 
     @__connected
     async def publish_data(self, data={}):
         """
             param data: dictionary of values to send
+
+            The data is queued on disk and sent in the background, batched with
+            other queued data if configured. Data that can't be sent stays queued
+            and is sent after the connection recovers.
         """
         self._databuf.update(data)
+        await self.__enqueue(
+            json.dumps(self._databuf).encode(AzureIOTC.Message.Encoding.value))
+        self._databuf.clear()
 
-        msg = Message(json.dumps(self._databuf))
-        msg.content_encoding = AzureIOTC.Message.Encoding.value
+    @__connected
+    async def publish_batch(self, batch: MeasurementBatch):
+        """
+            Queues the batch serialized as is, like publish_data otherwise
+        """
+        if self._databuf:
+            await self.publish_data(batch.to_dict())
+            return
+        await self.__enqueue(batch.to_json())
+
+    async def __enqueue(self, payload: bytes):
+        assert self._queue is not None, "AzureIOTC not connected"
+        await self._queue.put(payload)
+        self.__update_queue_metrics()
+        self.__start_sender()
+
+    def __start_sender(self):
+        if self._queued is None:
+            self._queued = asyncio.Event()
+        self._queued.set()
+        if self._sender is None or self._sender.done():
+            self._sender = asyncio.create_task(self.__send_queued())
+
+    async def __send_queued(self):
+        """
+        Sends the queued messages until disconnected. Waits for new messages while
+        the queue is empty or the next batch isn't due, and retries a failed send
+        with an exponential backoff.
+        """
+        assert self._queued is not None
+        replay_batch = self._options["RUUVIGATE_REPLAY_BATCH"]
+        peek = self.BatchRecords if self._options[
+            "RUUVIGATE_BATCH_MAX_AGE"] else 1
+        retry = self._options["RUUVIGATE_RETRY_MIN"]
+        sent = 0
+        while True:
+            self._queued.clear()
+            if not len(self._queue):
+                await self._queued.wait()
+                continue
+            readings = await self._queue.peek(peek)
+            count, msg = self.__build_message(readings)
+            delay = self.__batch_delay(count)
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._queued.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            start = time.monotonic()
+            try:
+                await self._client.send_message(msg)
+            except Exception as ex:
+                metrics.SEND_FAILURES.inc()
+                logging.error(
+                    "Sending message failed: {} {}. Retrying in {}s. Queue: {}"
+                    .format(
+                        type(ex).__name__, ex.args, retry,
+                        self._queue.stats()))
+                await asyncio.sleep(retry)
+                retry = min(2 * retry, self._options["RUUVIGATE_RETRY_MAX"])
+                continue
+            finally:
+                metrics.SEND_DURATION.observe(time.monotonic() - start)
+            retry = self._options["RUUVIGATE_RETRY_MIN"]
+            await self._queue.ack(readings[count - 1][2])
+            self.__update_queue_metrics()
+            logging.info(
+                "Sent message with id {} containing {} reading(s)".format(
+                    msg.message_id, count))
+            sent += 1
+            if sent % replay_batch == 0 and len(self._queue):
+                logging.info("Replaying queued messages: {}".format(
+                    self._queue.stats()))
+                await asyncio.sleep(self._options["RUUVIGATE_REPLAY_DELAY"])
+
+    def __update_queue_metrics(self):
+        stats = self._queue.stats()
+        metrics.QUEUE_DEPTH.set(stats["depth"])
+        metrics.QUEUE_OLDEST_AGE.set(stats["oldest_age"])
+
+    def __batch_delay(self, count: int) -> float:
+        """
+        Args:
+            count (int): Number of readings that fit into the next message
+
+        Returns:
+            float: Seconds the next message should wait for more readings, zero if
+                it is due
+        """
+        max_age = self._options["RUUVIGATE_BATCH_MAX_AGE"]
+        assert self._queue is not None, "AzureIOTC not connected"
+        # Wait while all the queued readings fit into the message
+        if not max_age or count < len(self._queue):
+            return 0.0
+        return max(0.0, max_age - self._queue.stats()["oldest_age"])
+
+    def __build_message(self, readings: List[Tuple[float, bytes, Position]]):
+        """
+        Packs queued readings into a message. A single reading is sent as is. Several
+        readings are sent as a JSON array of readings, each with its "Timestamp",
+        up to the maximum batch size.
+
+        Returns:
+            Tuple[int, Message]: Number of readings packed and the message
+        """
+        timestamp = readings[0][0]
+        if not self._options["RUUVIGATE_BATCH_MAX_AGE"]:
+            count, body = 1, readings[0][1]
+        else:
+            max_bytes = self._options["RUUVIGATE_BATCH_MAX_BYTES"]
+            items: List[bytes] = []
+            size = 2
+            for created, payload, _ in readings:
+                item = self.__timestamped(created, payload)
+                if items and size + len(item) + 1 > max_bytes:
+                    break
+                items.append(item)
+                size += len(item) + 1
+            count, body = len(items), b"[" + b",".join(items) + b"]"
+
+        encoding = AzureIOTC.Message.Encoding.value
+        if self._options["RUUVIGATE_BATCH_GZIP"]:
+            body = gzip.compress(body)
+            encoding = AzureIOTC.Message.Compressed.value
+
+        msg = Message(body)
+        msg.content_encoding = encoding
         msg.content_type = AzureIOTC.Message.ContentType.value
         msg.message_id = uuid.uuid4()
+        # Timestamp replayed messages with their original time
+        msg.custom_properties["iothub-creation-time-utc"] = self.__isoformat(
+            timestamp)
+        return count, msg
 
-        await self._client.send_message(msg)
-        logging.info("Sent message " + str(msg) + " with id " +
-                     str(msg.message_id))
+    @classmethod
+    def __timestamped(cls, created: float, payload: bytes) -> bytes:
+        """
+        Returns:
+            bytes: The JSON object of a reading with its "Timestamp" first, spliced
+                in without parsing the reading
+        """
+        timestamp = '{{"Timestamp": "{}"'.format(
+            cls.__isoformat(created)).encode(AzureIOTC.Message.Encoding.value)
+        body = payload.strip()[1:]
+        if body.lstrip().startswith(b"}"):
+            return timestamp + b"}"
+        return timestamp + b", " + body
 
-        self._databuf.clear()
+    @staticmethod
+    def __isoformat(timestamp: float) -> str:
+        return datetime.datetime.fromtimestamp(
+            timestamp, datetime.timezone.utc).isoformat()
 
     async def buffer_data(self, data={}):
         self._databuf.update(data)
@@ -172,4 +451,5 @@ class AzureIOTC:
         else:
             raise RuntimeError("Could not provision device.")
 
-        return registration_result.registration_state.assigned_hub
+        return (registration_result.registration_state.assigned_hub,
+                registration_result.registration_state.device_id)
@@ -1,9 +1,85 @@
+import re
+import sys
+import logging
+import importlib
 from abc import abstractmethod
-from typing import Protocol, Type
+from typing import Any, Callable, Dict, Optional, Protocol, Tuple
 from dataclasses import dataclass
 
-from .azure_iotc import AzureIOTC
-from .stdout import StdOut
+from ruuvigate.batch import TAGS_FIELD, MeasurementBatch
+
+# Entry point group third-party publishers register under, e.g. in pyproject.toml:
+#   [tool.poetry.plugins."ruuvigate.publishers"]
+#   "mqtt" = "mypackage.mqtt:MqttPublisher"
+ENTRY_POINT_GROUP = "ruuvigate.publishers"
+
+# Telemetry fields are named by the measurement and the slot number of their
+# RuuviTag, e.g. "Temperature1"
+TELEMETRY_FIELD = re.compile(r"^([A-Za-z]+)(\d+)$")
+
+
+def split_field(field: str) -> Optional[Tuple[str, int]]:
+    """
+    Args:
+        field (str): Name of a telemetry field
+
+    Returns:
+        Optional[Tuple[str, int]]: Name of the measurement and the slot number,
+            None if the field isn't a telemetry field of a RuuviTag
+    """
+    match = TELEMETRY_FIELD.match(field)
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2))
+
+
+def tag_measurements(
+        data: Dict[str, Any],
+        slot_mac: Callable[[int], Optional[str]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Groups published data by RuuviTag, in either schema.
+
+    Args:
+        data (Dict[str, Any]): Telemetry fields, or measurements keyed by MAC
+            under TAGS_FIELD
+        slot_mac (Callable): Resolves the slot number of a telemetry field to the
+            normalized MAC of its RuuviTag
+
+    Returns:
+        Dict[str, Dict[str, Any]]: Measurements by name, e.g. "Temperature", by
+            the normalized MAC of their RuuviTag
+    """
+    tags: Dict[str, Dict[str, Any]] = {}
+    for field, value in data.items():
+        if field == TAGS_FIELD and isinstance(value, dict):
+            for mac, measurements in value.items():
+                tags.setdefault(mac, {}).update(measurements)
+            continue
+        split = split_field(field)
+        mac = slot_mac(split[1]) if split is not None else None
+        if mac is None:
+            logging.debug("No RuuviTag for field " + field)
+            continue
+        tags.setdefault(mac, {})[split[0]] = value  # type: ignore
+    return tags
+
+
+async def publish_batch(publisher: "DataPublisher",
+                        batch: MeasurementBatch) -> None:
+    """
+    Publishes a batch of measurements. Publishers may implement
+    publish_batch(batch) to serialize the batch themselves, the others are given
+    the batch as data.
+
+    Args:
+        publisher (DataPublisher): Publisher to publish with
+        batch (MeasurementBatch): Measurements to publish
+    """
+    publish = getattr(publisher, "publish_batch", None)
+    if publish is not None:
+        await publish(batch)
+    else:
+        await publisher.publish_data(batch.to_dict())
 
 
 class DataPublisher(Protocol):
@@ -21,19 +97,79 @@ class DataPublisher(Protocol):
         ...
 
     @abstractmethod
-    async def execute_method_listener(self, method_name, handler, cookie):
+    def register_method_handler(self, method_name, handler, cookie=None):
+        ...
+
+    @abstractmethod
+    async def execute_method_dispatcher(self):
         ...
 
 
 @dataclass
 class DataPublisherFactory:
-    publisher: Type[DataPublisher]
+    '''
+    Creates a publisher given as "module:attribute", in the syntax of entry points.
+    The module is imported only when the first publisher is created, so that the
+    dependencies of publishers not in use are never loaded.
+    '''
+    target: str
+
+    def load(self) -> Any:
+        module, _, attribute = self.target.partition(":")
+        publisher: Any = importlib.import_module(module)
+        for name in attribute.split(".") if attribute else ():
+            publisher = getattr(publisher, name)
+        return publisher
 
     def __call__(self) -> DataPublisher:
-        return self.publisher()
+        return self.load()()
 
 
 FACTORIES = {
-    "azure": DataPublisherFactory(AzureIOTC),
-    "stdout": DataPublisherFactory(StdOut),
+    "azure": DataPublisherFactory("ruuvigate.clients.azure_iotc:AzureIOTC"),
+    "stdout": DataPublisherFactory("ruuvigate.clients.stdout:StdOut"),
+    "sqlite": DataPublisherFactory("ruuvigate.clients.localstore:LocalStore"),
+    "mqtt": DataPublisherFactory("ruuvigate.clients.mqtt:MqttPublisher"),
 }
+# Publishers that don't need a configuration file
+CONFIGLESS = {"stdout", "sqlite"}
+
+
+def entry_point_factories() -> Dict[str, DataPublisherFactory]:
+    """
+    Returns:
+        Dict[str, DataPublisherFactory]: Publishers installed packages register in
+            the ruuvigate.publishers entry point group
+    """
+    from importlib.metadata import entry_points
+    if sys.version_info >= (3, 10):
+        found = entry_points(group=ENTRY_POINT_GROUP)
+    else:
+        found = entry_points().get(ENTRY_POINT_GROUP, [])
+    return {
+        entry_point.name: DataPublisherFactory(entry_point.value)
+        for entry_point in found
+    }
+
+
+def available_factories() -> Dict[str, DataPublisherFactory]:
+    """
+    Returns:
+        Dict[str, DataPublisherFactory]: The built-in publishers and those
+            registered through entry points. A built-in publisher can't be replaced.
+    """
+    factories = dict(FACTORIES)
+    try:
+        discovered = entry_point_factories()
+    except Exception as ex:
+        logging.warning("Couldn't discover publishers: {} {}".format(
+            type(ex).__name__, ex.args))
+        discovered = {}
+    for name, factory in discovered.items():
+        if name in factories:
+            logging.warning(
+                "Publisher '{}' of {} shadowed by the built-in one".format(
+                    name, factory.target))
+            continue
+        factories[name] = factory
+    return factories
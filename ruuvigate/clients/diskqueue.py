@@ -0,0 +1,245 @@
+import os
+import time
+import asyncio
+import struct
+import zlib
+import logging
+import itertools
+from collections import deque
+from typing import BinaryIO, Deque, Dict, List, Tuple
+
+# Segment and offset in a queue
+Position = Tuple[int, int]
+
+
+class DiskQueue:
+    '''
+    Bounded, crash-safe FIFO of byte payloads on local disk. Payloads are appended to
+    segment files and the position of the oldest unacknowledged payload is kept in a
+    separate head file. A torn write at the end of a segment is detected by its
+    checksum and truncated away when the queue is opened.
+    '''
+    # length, CRC-32 of timestamp and payload, enqueue time
+    Header = struct.Struct("<IId")
+    SegmentBytes = 1024 * 1024
+    SegmentSuffix = ".seg"
+    HeadFile = "head"
+
+    def __init__(self, path: str, max_bytes: int = 64 * 1024 * 1024):
+        """
+        Args:
+            path (str): Directory of the queue, created if it doesn't exist
+            max_bytes (int): Upper bound of the queued data. The oldest segments are
+                dropped when exceeded.
+        """
+        self._path = path
+        self._max_bytes = max_bytes
+        # segment, offset, record size and enqueue time of every queued payload
+        self._index: Deque[Tuple[int, int, int, float]] = deque()
+        self._segments: Deque[int] = deque()
+        self._bytes = 0
+
+        os.makedirs(self._path, exist_ok=True)
+        head_segment, head_offset = self.__read_head()
+        for segment in self.__list_segments():
+            if segment < head_segment:
+                os.remove(self.__segment_path(segment))
+                continue
+            self._segments.append(segment)
+            self.__scan_segment(segment,
+                                head_offset if segment == head_segment else 0)
+        if not self._segments:
+            self._segments.append(head_segment)
+        self._writer = open(self.__segment_path(self._segments[-1]), "ab")
+        # Segment and offset after the last queued payload
+        self._end: Position = (self._segments[-1], self._writer.tell())
+        self._lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    async def put(self, payload: bytes) -> None:
+        """
+        Appends a payload durably to the end of the queue. The payload is written
+        and synced off the event loop, one payload at a time.
+
+        Args:
+            payload (bytes): The payload
+
+        Returns:
+            None
+        """
+        timestamp = time.time()
+        record = self.Header.pack(len(payload),
+                                  self.__checksum(timestamp, payload),
+                                  timestamp) + payload
+        async with self._lock:
+            segment, offset = self._end
+            roll = offset > 0 and offset + len(record) > self.SegmentBytes
+            if roll:
+                segment, offset = segment + 1, 0
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.__append, segment, record, roll)
+            if roll:
+                self._segments.append(segment)
+            self._end = (segment, offset + len(record))
+            self._index.append((segment, offset, len(record), timestamp))
+            self._bytes += len(record)
+
+            dropped = 0
+            obsolete: List[int] = []
+            while self._bytes > self._max_bytes and len(self._segments) > 1:
+                obsolete.append(self._segments.popleft())
+                while self._index and self._index[0][0] == obsolete[-1]:
+                    self._bytes -= self._index.popleft()[2]
+                    dropped += 1
+            if obsolete:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.__move_head, self._segments[0], 0, obsolete)
+                logging.warning(
+                    "Queue {} exceeded {} bytes, dropped {} oldest payloads".
+                    format(self._path, self._max_bytes, dropped))
+
+    async def peek(self, count: int) -> List[Tuple[float, bytes, Position]]:
+        """
+        Reads the oldest payloads without removing them. The payloads are read off
+        the event loop.
+
+        Args:
+            count (int): Maximum number of payloads to read
+
+        Returns:
+            List[Tuple[float, bytes, Position]]: Enqueue times, payloads and the
+                positions after them to acknowledge, oldest first
+        """
+        async with self._lock:
+            entries = list(itertools.islice(self._index, count))
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self.__read, entries)
+
+    async def ack(self, end: Position) -> None:
+        """
+        Removes the payloads before a position after they have been delivered.
+        Payloads already dropped to bound the queue are skipped, so the payloads
+        queued after them are kept. The head is written off the event loop.
+
+        Args:
+            end (Position): Position after the last delivered payload, as returned
+                by peek
+
+        Returns:
+            None
+        """
+        async with self._lock:
+            while self._index and self._index[0][:2] < end:
+                self._bytes -= self._index.popleft()[2]
+            if self._index:
+                segment, offset = self._index[0][0], self._index[0][1]
+            else:
+                segment, offset = self._end
+            obsolete: List[int] = []
+            while self._segments[0] < segment:
+                obsolete.append(self._segments.popleft())
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.__move_head, segment, offset, obsolete)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns:
+            Dict[str, float]: Number of queued payloads, their size in bytes and
+                the age of the oldest payload in seconds
+        """
+        return {
+            "depth": len(self._index),
+            "bytes": self._bytes,
+            "oldest_age":
+            time.time() - self._index[0][3] if self._index else 0.0
+        }
+
+    def close(self) -> None:
+        self._writer.close()
+
+    def __append(self, segment: int, record: bytes, roll: bool) -> None:
+        if roll:
+            self._writer.close()
+            self._writer = open(self.__segment_path(segment), "ab")
+        self._writer.write(record)
+        self._writer.flush()
+        os.fsync(self._writer.fileno())
+
+    def __read(
+        self, entries: List[Tuple[int, int, int, float]]
+    ) -> List[Tuple[float, bytes, Position]]:
+        items = []
+        streams: Dict[int, BinaryIO] = {}
+        try:
+            for segment, offset, size, timestamp in entries:
+                if segment not in streams:
+                    streams[segment] = open(self.__segment_path(segment), "rb")
+                streams[segment].seek(offset + self.Header.size)
+                items.append(
+                    (timestamp, streams[segment].read(size - self.Header.size),
+                     (segment, offset + size)))
+        finally:
+            for stream in streams.values():
+                stream.close()
+        return items
+
+    def __move_head(self, segment: int, offset: int,
+                    obsolete: List[int]) -> None:
+        self.__write_head(segment, offset)
+        for old in obsolete:
+            os.remove(self.__segment_path(old))
+
+    def __scan_segment(self, segment: int, offset: int) -> None:
+        path = self.__segment_path(segment)
+        with open(path, "rb") as stream:
+            stream.seek(offset)
+            while True:
+                header = stream.read(self.Header.size)
+                if not header:
+                    return
+                if len(header) == self.Header.size:
+                    length, crc, timestamp = self.Header.unpack(header)
+                    payload = stream.read(length)
+                    if len(payload) == length and crc == self.__checksum(
+                            timestamp, payload):
+                        size = self.Header.size + length
+                        self._index.append((segment, offset, size, timestamp))
+                        self._bytes += size
+                        offset += size
+                        continue
+                break
+        logging.warning("Truncating torn write in {} at {}".format(
+            path, offset))
+        os.truncate(path, offset)
+
+    @staticmethod
+    def __checksum(timestamp: float, payload: bytes) -> int:
+        return zlib.crc32(payload, zlib.crc32(struct.pack("<d", timestamp)))
+
+    def __list_segments(self) -> List[int]:
+        return sorted(
+            int(name[:-len(self.SegmentSuffix)])
+            for name in os.listdir(self._path)
+            if name.endswith(self.SegmentSuffix))
+
+    def __segment_path(self, segment: int) -> str:
+        return os.path.join(self._path,
+                            "{:08d}{}".format(segment, self.SegmentSuffix))
+
+    def __read_head(self) -> Tuple[int, int]:
+        try:
+            with open(os.path.join(self._path, self.HeadFile), "r") as stream:
+                segment, offset = stream.read().split()
+            return int(segment), int(offset)
+        except (FileNotFoundError, ValueError):
+            return 0, 0
+
+    def __write_head(self, segment: int, offset: int) -> None:
+        path = os.path.join(self._path, self.HeadFile)
+        with open(path + ".tmp", "w") as stream:
+            stream.write("{} {}".format(segment, offset))
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,153 @@
+import time
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from ruuvigate import metrics
+from ruuvigate.batch import MeasurementBatch
+from .client import DataPublisher, publish_batch
+
+# Time of queueing and the batch, as data or measurements
+QueuedBatch = Tuple[float, Union[Dict[str, Any], MeasurementBatch]]
+
+
+class Sink:
+    '''
+    Publisher behind a bounded queue, fed by FanOut and drained by its own worker
+    '''
+    Policies = ("drop", "block")
+
+    def __init__(self, name: str, publisher: DataPublisher, maxsize: int,
+                 policy: str):
+        """
+        Args:
+            name (str): Name of the sink in logs and metrics
+            publisher (DataPublisher): Publisher of the sink
+            maxsize (int): Number of batches the queue holds
+            policy (str): "drop" drops the oldest queued batch when the queue is
+                full, "block" makes the publishing wait for room
+        """
+        if policy not in self.Policies:
+            raise ValueError("Unknown sink policy: {}".format(policy))
+        self.name = name
+        self.publisher = publisher
+        self.policy = policy
+        self.queue: asyncio.Queue[QueuedBatch] = asyncio.Queue(maxsize)
+        self.dropped = 0
+        self.worker: Optional[asyncio.Task] = None
+
+    async def put(self, data: Union[Dict[str, Any], MeasurementBatch]) -> None:
+        item = (time.monotonic(), data)
+        if self.policy == "block":
+            await self.queue.put(item)
+        else:
+            while self.queue.full():
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.dropped += 1
+                metrics.SINK_DROPPED.inc(self.name)
+            self.queue.put_nowait(item)
+        metrics.SINK_QUEUE_DEPTH.set(self.queue.qsize(), self.name)
+
+    async def run(self) -> None:
+        while True:
+            queued, data = await self.queue.get()
+            try:
+                if isinstance(data, MeasurementBatch):
+                    await publish_batch(self.publisher, data)
+                else:
+                    await self.publisher.publish_data(data)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logging.error("Publishing to sink '{}' failed: {} {}".format(
+                    self.name,
+                    type(ex).__name__, ex.args))
+            finally:
+                self.queue.task_done()
+            metrics.SINK_LAG.observe(time.monotonic() - queued, self.name)
+            metrics.SINK_QUEUE_DEPTH.set(self.queue.qsize(), self.name)
+
+
+class FanOut:
+    '''
+    DataPublisher that publishes every batch to several sinks. Each sink has its own
+    bounded queue and worker task, so a slow or unreachable sink doesn't delay the
+    others or the caller, unless its policy is to block.
+    '''
+    QueueSize = 100
+
+    def __init__(self,
+                 publishers: Dict[str, DataPublisher],
+                 maxsize: int = QueueSize,
+                 policies: Dict[str, str] = {}):
+        """
+        Args:
+            publishers (Dict[str, DataPublisher]): Publishers of the sinks by name
+            maxsize (int): Number of batches the queue of a sink holds
+            policies (Dict[str, str]): Policy of a sink by name when its queue is
+                full, "drop" (default) or "block"
+        """
+        self._sinks: List[Sink] = [
+            Sink(name, publisher, maxsize, policies.get(name, "drop"))
+            for name, publisher in publishers.items()
+        ]
+        self._databuf: Dict[str, Any] = {}
+
+    @property
+    def sinks(self) -> List[Sink]:
+        return self._sinks
+
+    async def connect(self, config) -> None:
+        for sink in self._sinks:
+            await sink.publisher.connect(config)
+        for sink in self._sinks:
+            sink.worker = asyncio.create_task(sink.run())
+
+    async def disconnect(self) -> None:
+        for sink in self._sinks:
+            if sink.worker is not None:
+                sink.worker.cancel()
+                sink.worker = None
+            disconnect = getattr(sink.publisher, "disconnect", None)
+            if disconnect is not None:
+                await disconnect()
+
+    async def join(self) -> None:
+        """
+        Waits until every sink has published its queued batches
+        """
+        await asyncio.gather(*(sink.queue.join() for sink in self._sinks))
+
+    def register_method_handler(self, method_name, handler, cookie=None):
+        for sink in self._sinks:
+            sink.publisher.register_method_handler(method_name, handler,
+                                                   cookie)
+
+    async def execute_method_dispatcher(self):
+        await asyncio.gather(*(sink.publisher.execute_method_dispatcher()
+                               for sink in self._sinks))
+
+    async def buffer_data(self, data: Dict[str, Any]) -> None:
+        self._databuf.update(data)
+
+    async def publish_data(self, data: Dict[str, Any] = {}) -> None:
+        """
+        Queues the buffered and the given data to every sink. The batch is shared
+        by the sinks and must not be modified.
+        """
+        self._databuf.update(data)
+        batch, self._databuf = self._databuf, {}
+        for sink in self._sinks:
+            await sink.put(batch)
+
+    async def publish_batch(self, batch: MeasurementBatch) -> None:
+        """
+        Queues the batch to every sink as it is, to be serialized by each sink, like
+        publish_data otherwise
+        """
+        if self._databuf:
+            await self.publish_data(batch.to_dict())
+            return
+        for sink in self._sinks:
+            await sink.put(batch)
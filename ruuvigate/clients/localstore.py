@@ -0,0 +1,243 @@
+import os
+import time
+import sqlite3
+import asyncio
+import logging
+import concurrent.futures
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import yaml
+
+from ruuvigate.batch import MeasurementBatch
+from .client import tag_measurements
+
+# Time, MAC, metric and value
+Row = Tuple[float, str, str, float]
+
+
+class LocalStore:
+    '''
+    DataPublisher that keeps the published measurements in a local SQLite database
+    in WAL mode, so that they can be looked into without the cloud. Measurements
+    are buffered and inserted in batches off the event loop, and those older than
+    the retention are deleted periodically.
+    '''
+    # Optional configurations and their defaults
+    Options = {
+        "RUUVIGATE_HISTORY_FILE":
+        os.path.join(os.path.expanduser("~"), ".ruuvigate", "history.sqlite"),
+        "RUUVIGATE_HISTORY_RETENTION_DAYS":
+        30,
+        # Seconds measurements are buffered before being inserted
+        "RUUVIGATE_HISTORY_FLUSH_INTERVAL":
+        10.0
+    }
+    FlushRows = 5000
+    CompactInterval = 3600.0
+    MaxPoints = 1000
+    Schema = """
+        CREATE TABLE IF NOT EXISTS readings (
+            time REAL NOT NULL,
+            mac TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            value REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS readings_by_mac
+            ON readings (mac, metric, time);
+        CREATE INDEX IF NOT EXISTS readings_by_time ON readings (time);
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        """
+        Args:
+            clock (Callable): Wall clock the measurements are timestamped with
+        """
+        self._clock = clock
+        self._options: Dict[str, Any] = dict(self.Options)
+        self._databuf: Dict[str, Any] = {}
+        self._rows: List[Row] = []
+        self._flushed = 0.0
+        self._compacted = 0.0
+        self._db: Optional[sqlite3.Connection] = None
+        # A single thread owns the connection
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="localstore")
+        # Resolves the number of telemetry fields to the MAC of their RuuviTag
+        self.slot_mac: Callable[[int], Optional[str]] = lambda _: None
+
+    async def connect(self, config_path: Optional[str]) -> None:
+        if config_path is not None:
+            with open(config_path, "r") as stream:
+                config = yaml.safe_load(stream) or {}
+            self._options.update(
+                {key: config[key]
+                 for key in self.Options if key in config})
+        path = self._options["RUUVIGATE_HISTORY_FILE"]
+        await self.__run(self.__open, path)
+        logging.info("Storing measurements in " + path)
+        self._flushed = self._compacted = time.monotonic()
+
+    async def disconnect(self) -> None:
+        if self._db is None:
+            return
+        await self.flush()
+        await self.__run(self.__close)
+
+    def register_method_handler(self, *_) -> None:
+        pass
+
+    async def execute_method_dispatcher(self) -> None:
+        pass
+
+    async def buffer_data(self, data: Dict[str, Any]) -> None:
+        self._databuf.update(data)
+
+    async def publish_data(self, data: Dict[str, Any] = {}) -> None:
+        """
+        Buffers the measurements of the buffered and given data, and
+        inserts the buffered measurements once enough of them are buffered or the
+        flush interval has passed.
+        """
+        self._databuf.update(data)
+        now = self._clock()
+        for mac, measurements in tag_measurements(self._databuf,
+                                                  self.slot_mac).items():
+            for metric, value in measurements.items():
+                if isinstance(value, (int, float)):
+                    self._rows.append((now, mac, metric, float(value)))
+        self._databuf.clear()
+        await self.__flush_if_due()
+
+    async def publish_batch(self, batch: MeasurementBatch) -> None:
+        """
+        Buffers the measurements of the batch as they are, like publish_data
+        otherwise
+        """
+        if self._databuf:
+            await self.publish_data(batch.to_dict())
+            return
+        now = self._clock()
+        self._rows.extend((now, mac, metric, value)
+                          for mac, metric, value in batch.measurements())
+        await self.__flush_if_due()
+
+    async def __flush_if_due(self) -> None:
+        elapsed = time.monotonic() - self._flushed
+        if len(self._rows) >= self.FlushRows or elapsed >= self._options[
+                "RUUVIGATE_HISTORY_FLUSH_INTERVAL"]:
+            await self.flush()
+
+    async def flush(self) -> None:
+        """
+        Inserts the buffered measurements, and deletes the expired ones if it's
+        time to
+        """
+        rows, self._rows = self._rows, []
+        self._flushed = time.monotonic()
+        if rows:
+            await self.__run(self.__insert, rows)
+        if time.monotonic() - self._compacted >= self.CompactInterval:
+            self._compacted = time.monotonic()
+            await self.compact()
+
+    async def compact(self) -> int:
+        """
+        Deletes the measurements older than the retention and returns their space
+        to the file system.
+
+        Returns:
+            int: Number of measurements deleted
+        """
+        cutoff = self._clock(
+        ) - self._options["RUUVIGATE_HISTORY_RETENTION_DAYS"] * 86400
+        deleted = await self.__run(self.__delete_before, cutoff)
+        if deleted:
+            logging.info("Deleted {} expired measurements".format(deleted))
+        return deleted
+
+    async def history(
+            self,
+            mac: str,
+            start: float,
+            end: float,
+            points: int = 100,
+            metrics: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+        """
+        Measurements of a RuuviTag downsampled into equal time buckets.
+
+        Args:
+            mac (str): Normalized MAC of the RuuviTag
+            start (float): Start of the range as a POSIX timestamp
+            end (float): End of the range as a POSIX timestamp
+            points (int): Number of buckets, at most MaxPoints
+            metrics (Sequence[str]): Metrics to return, e.g. "Temperature", all if
+                not given
+
+        Returns:
+            Dict[str, Any]: Width of the buckets in seconds ("Bucket") and per metric
+                [time, mean, min, max] of every bucket with measurements ("Series")
+        """
+        await self.flush()
+        bucket = max(end - start, 1.0) / max(1, min(points, self.MaxPoints))
+        rows = await self.__run(self.__select, mac, start, end, bucket,
+                                metrics)
+        series: Dict[str, List[List[float]]] = {}
+        for metric, index, mean, low, high in rows:
+            series.setdefault(metric, []).append(
+                [round(start + index * bucket, 3),
+                 round(mean, 4), low, high])
+        return {"Bucket": bucket, "Series": series}
+
+    async def __run(self, function: Callable, *args) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, function, *args)
+
+    def __open(self, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # Takes effect only before the first table is created
+        self._db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # Durable enough with WAL, a crash can only lose the last transactions
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(self.Schema)
+
+    def __close(self) -> None:
+        assert self._db is not None, "LocalStore not connected"
+        self._db.close()
+        self._db = None
+
+    def __insert(self, rows: List[Row]) -> None:
+        assert self._db is not None, "LocalStore not connected"
+        with self._db:
+            self._db.executemany("INSERT INTO readings VALUES (?, ?, ?, ?)",
+                                 rows)
+
+    def __delete_before(self, cutoff: float) -> int:
+        assert self._db is not None, "LocalStore not connected"
+        with self._db:
+            deleted = self._db.execute("DELETE FROM readings WHERE time < ?",
+                                       (cutoff, )).rowcount
+        if deleted:
+            self._db.execute("PRAGMA incremental_vacuum")
+            self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return deleted
+
+    def __select(self, mac: str, start: float, end: float, bucket: float,
+                 metrics: Optional[Sequence[str]]) -> List[Tuple]:
+        assert self._db is not None, "LocalStore not connected"
+        query = """
+            SELECT metric, CAST((time - ?) / ? AS INTEGER) AS bucket,
+                   AVG(value), MIN(value), MAX(value)
+            FROM readings
+            WHERE mac = ? AND time >= ? AND time < ?{}
+            GROUP BY metric, bucket
+            ORDER BY metric, bucket
+        """
+        params: List[Any] = [start, bucket, mac, start, end]
+        condition = ""
+        if metrics:
+            condition = " AND metric IN ({})".format(",".join("?" *
+                                                              len(metrics)))
+            params.extend(metrics)
+        return self._db.execute(query.format(condition), params).fetchall()
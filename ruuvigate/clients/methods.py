@@ -0,0 +1,62 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from ruuvigate import metrics
+
+MethodHandler = Callable[[Any, Any], Awaitable[Dict[str, Any]]]
+
+
+async def call_method(method_name: str,
+                      registered: Optional[Tuple[MethodHandler, Any]],
+                      payload: Any, limit: asyncio.Semaphore,
+                      timeout: float) -> Tuple[int, Dict[str, Any]]:
+    """
+    Calls the handler of a direct method under the concurrency limit and the
+    deadline, and counts the request in the metrics.
+
+    Args:
+        method_name (str): Name of the method
+        registered (Optional[Tuple[MethodHandler, Any]]): Handler and cookie of the
+            method, None if the method is unknown
+        payload (Any): Payload of the request
+        limit (asyncio.Semaphore): Limit of the requests handled at a time
+        timeout (float): Seconds the request may take, waiting for the limit
+            included
+
+    Returns:
+        Tuple[int, Dict[str, Any]]: Status and payload of the response. 200 if the
+            handler succeeded, 400 if it didn't, 404 for an unknown method, 500 if
+            the handler raised and 504 if it timed out.
+    """
+    response: Dict[str, Any]
+    if registered is None:
+        logging.warning("No handler for method \"{}\"".format(method_name))
+        method_name = "unknown"
+        status, response = 404, {"result": False, "data": "Unknown method"}
+    else:
+        handler, cookie = registered
+        try:
+            response = await asyncio.wait_for(
+                _handle(limit, handler, payload, cookie), timeout)
+            status = 200 if response.get("result") else 400
+        except asyncio.TimeoutError:
+            logging.error("Method \"{}\" timed out after {}s".format(
+                method_name, timeout))
+            status, response = 504, {
+                "result": False,
+                "data": "Timed out after {}s".format(timeout)
+            }
+        except Exception as ex:
+            logging.error("Method \"{}\" failed: {} {}".format(
+                method_name,
+                type(ex).__name__, ex.args))
+            status, response = 500, {"result": False, "data": "Failed"}
+    metrics.METHOD_REQUESTS.inc(method_name, str(status))
+    return status, response
+
+
+async def _handle(limit: asyncio.Semaphore, handler: MethodHandler,
+                  payload: Any, cookie: Any) -> Dict[str, Any]:
+    async with limit:
+        return await handler(payload, cookie)
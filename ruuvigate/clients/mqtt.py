@@ -0,0 +1,276 @@
+import os
+import json
+import time
+import socket
+import asyncio
+import logging
+from typing import Any, Callable, Dict, Optional, Set, Tuple, Union
+
+import yaml
+import paho.mqtt.client as paho  # type: ignore
+
+from ruuvigate import metrics
+from ruuvigate.batch import MeasurementBatch
+from .client import tag_measurements
+from .methods import MethodHandler, call_method
+
+
+class MqttPublisher:
+    '''
+    Publishes RuuviTag data to an MQTT broker with QoS 1. Up to MQTT_INFLIGHT
+    publishes are kept in flight unacknowledged instead of waiting for each
+    acknowledgement, and the publishes beyond the window are queued. The session is
+    persistent, so publishes unacknowledged when the connection drops are resent
+    after the reconnect, and the reconnects back off exponentially.
+
+    Direct methods are requested by publishing to <prefix>/commands/<method> and
+    answered on <prefix>/responses/<method>.
+    '''
+    # Configurations and their defaults, MQTT_HOST is required
+    Options: Dict[str, Any] = {
+        "MQTT_HOST": None,
+        "MQTT_PORT": 1883,
+        "MQTT_CLIENT_ID": "ruuvigate-" + socket.gethostname(),
+        "MQTT_USERNAME": None,
+        "MQTT_PASSWORD": None,
+        "MQTT_TLS": False,
+        "MQTT_KEEPALIVE": 60,
+        # Topics are <prefix>/... and the client ID is used if not given
+        "MQTT_TOPIC_PREFIX": None,
+        # Publish the measurements of every RuuviTag to <prefix>/tags/<MAC>
+        # instead of all of them to <prefix>/telemetry
+        "MQTT_PER_TAG_TOPICS": False,
+        "MQTT_INFLIGHT": 20,
+        # Publishes queued beyond the window, newer ones are dropped when full
+        "MQTT_MAX_QUEUED": 10000,
+        "MQTT_RECONNECT_MIN": 1,
+        "MQTT_RECONNECT_MAX": 120,
+        "MQTT_CONNECT_TIMEOUT": 30,
+        "RUUVIGATE_METHOD_CONCURRENCY": 4,
+        "RUUVIGATE_METHOD_TIMEOUT": 20.0
+    }
+    QoS = 1
+
+    def __init__(self) -> None:
+        self._options = dict(self.Options)
+        self._client: Optional[paho.Client] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._connected = asyncio.Event()
+        self._prefix = ""
+        self._databuf: Dict[str, Any] = {}
+        self._methods: Dict[str, Tuple[MethodHandler, Any]] = {}
+        self._requests: "asyncio.Queue[Tuple[str, Any]]" = asyncio.Queue()
+        # Publish times of the unacknowledged publishes by message ID
+        self._unacked: Dict[int, float] = {}
+        # Resolves the number of telemetry fields to the MAC of their RuuviTag
+        self.slot_mac: Callable[[int], Optional[str]] = lambda _: None
+
+    @property
+    def unacked(self) -> int:
+        return len(self._unacked)
+
+    async def connect(self, config_path: str) -> None:
+        self.__configure(config_path)
+        self._loop = asyncio.get_running_loop()
+        self._prefix = self._options["MQTT_TOPIC_PREFIX"] or self._options[
+            "MQTT_CLIENT_ID"]
+        client = paho.Client(client_id=self._options["MQTT_CLIENT_ID"],
+                             clean_session=False,
+                             protocol=paho.MQTTv311)
+        if self._options["MQTT_USERNAME"] is not None:
+            client.username_pw_set(self._options["MQTT_USERNAME"],
+                                   self._options["MQTT_PASSWORD"])
+        if self._options["MQTT_TLS"]:
+            client.tls_set()
+        client.max_inflight_messages_set(self._options["MQTT_INFLIGHT"])
+        client.max_queued_messages_set(self._options["MQTT_MAX_QUEUED"])
+        client.reconnect_delay_set(self._options["MQTT_RECONNECT_MIN"],
+                                   self._options["MQTT_RECONNECT_MAX"])
+        client.will_set(self.__topic("status"),
+                        "offline",
+                        qos=self.QoS,
+                        retain=True)
+        client.on_connect = self.__on_connect
+        client.on_disconnect = self.__on_disconnect
+        client.on_publish = self.__on_publish
+        client.on_message = self.__on_message
+        self._client = client
+
+        logging.info("Connecting to MQTT broker {}:{}".format(
+            self._options["MQTT_HOST"], self._options["MQTT_PORT"]))
+        client.connect_async(self._options["MQTT_HOST"],
+                             self._options["MQTT_PORT"],
+                             self._options["MQTT_KEEPALIVE"])
+        client.loop_start()
+        try:
+            await asyncio.wait_for(self._connected.wait(),
+                                   self._options["MQTT_CONNECT_TIMEOUT"])
+        except asyncio.TimeoutError:
+            logging.error("Unable to connect to MQTT broker {}:{}".format(
+                self._options["MQTT_HOST"], self._options["MQTT_PORT"]))
+            await self.disconnect()
+            raise ConnectionError()
+
+    async def disconnect(self) -> None:
+        if self._client is None:
+            return
+        logging.info("Disconnecting MQTT")
+        client, self._client = self._client, None
+        if self._connected.is_set():
+            client.publish(self.__topic("status"),
+                           "offline",
+                           qos=self.QoS,
+                           retain=True)
+        client.disconnect()
+        # Joins the network thread, off the event loop
+        await asyncio.get_running_loop().run_in_executor(
+            None, client.loop_stop)
+        self._connected.clear()
+
+    def register_method_handler(self,
+                                method_name: str,
+                                handler: MethodHandler,
+                                cookie: Any = None) -> None:
+        self._methods[method_name] = (handler, cookie)
+
+    async def execute_method_dispatcher(self) -> None:
+        """
+        Handles the requests published to the command topics concurrently, up to
+        RUUVIGATE_METHOD_CONCURRENCY at a time and each within
+        RUUVIGATE_METHOD_TIMEOUT seconds.
+        """
+        logging.info("Executing a dispatcher for methods: {}".format(", ".join(
+            self._methods)))
+        limit = asyncio.Semaphore(
+            self._options["RUUVIGATE_METHOD_CONCURRENCY"])
+        running: Set[asyncio.Task] = set()
+        try:
+            while True:
+                method_name, payload = await self._requests.get()
+                task = asyncio.create_task(
+                    self.__dispatch(method_name, payload, limit))
+                running.add(task)
+                task.add_done_callback(running.discard)
+        except asyncio.CancelledError:
+            logging.info("Exiting method dispatcher")
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+
+    async def buffer_data(self, data: Dict[str, Any]) -> None:
+        self._databuf.update(data)
+
+    async def publish_data(self, data: Dict[str, Any] = {}) -> None:
+        """
+        Publishes the buffered and given data without waiting for the
+        acknowledgements. While disconnected the publishes are queued by the
+        client and sent after the reconnect.
+        """
+        self._databuf.update(data)
+        if self._options["MQTT_PER_TAG_TOPICS"]:
+            for mac, tag in tag_measurements(self._databuf,
+                                             self.slot_mac).items():
+                self.__publish(self.__tag_topic(mac), json.dumps(tag))
+        elif self._databuf:
+            self.__publish(self.__topic("telemetry"),
+                           json.dumps(self._databuf))
+        self._databuf.clear()
+
+    async def publish_batch(self, batch: MeasurementBatch) -> None:
+        """
+        Publishes the batch serialized as is, like publish_data otherwise
+        """
+        if self._databuf:
+            await self.publish_data(batch.to_dict())
+        elif self._options["MQTT_PER_TAG_TOPICS"]:
+            for mac, payload in batch.tags_json():
+                self.__publish(self.__tag_topic(mac), payload)
+        elif len(batch):
+            self.__publish(self.__topic("telemetry"), batch.to_json())
+
+    def __publish(self, topic: str, payload: Union[str, bytes]) -> None:
+        assert self._client is not None, "MqttPublisher not connected"
+        info = self._client.publish(topic, payload, qos=self.QoS)
+        if info.rc == paho.MQTT_ERR_QUEUE_SIZE:
+            metrics.SEND_FAILURES.inc()
+            logging.error("Publish queue full, dropped message to " + topic)
+            return
+        self._unacked[info.mid] = time.monotonic()
+        metrics.MQTT_UNACKED.set(len(self._unacked))
+
+    def __tag_topic(self, mac: str) -> str:
+        return self.__topic("tags", mac.replace(":", ""))
+
+    def __topic(self, *levels: str) -> str:
+        return "/".join((self._prefix, ) + levels)
+
+    async def __dispatch(self, method_name: str, payload: Any,
+                         limit: asyncio.Semaphore) -> None:
+        logging.info("Received method request \"" + method_name + "\"")
+        status, response = await call_method(
+            method_name, self._methods.get(method_name), payload, limit,
+            self._options["RUUVIGATE_METHOD_TIMEOUT"])
+        if self._client is not None:
+            self._client.publish(self.__topic("responses", method_name),
+                                 json.dumps({
+                                     "status": status,
+                                     **response
+                                 }),
+                                 qos=self.QoS)
+
+    def __configure(self, config_path: str) -> None:
+        if not os.path.exists(config_path):
+            logging.error("Can't find file: " + config_path)
+            raise FileNotFoundError(config_path)
+        with open(config_path, "r") as stream:
+            config = yaml.safe_load(stream) or {}
+        self._options.update(
+            {key: config[key]
+             for key in self.Options if key in config})
+        if self._options["MQTT_HOST"] is None:
+            logging.error(
+                "Configuration error! Missing configuration: MQTT_HOST")
+            raise ValueError("Missing configuration")
+
+    # The callbacks run in the network thread of the client
+
+    def __on_connect(self, client, userdata, flags, rc) -> None:
+        if rc != paho.CONNACK_ACCEPTED:
+            logging.error("MQTT connection refused: " +
+                          paho.connack_string(rc))
+            return
+        logging.info("Connected to MQTT broker, session present: {}".format(
+            bool(flags.get("session present"))))
+        client.subscribe(self.__topic("commands", "+"), qos=self.QoS)
+        client.publish(self.__topic("status"),
+                       "online",
+                       qos=self.QoS,
+                       retain=True)
+        self.__call_soon(self._connected.set)
+
+    def __on_disconnect(self, client, userdata, rc) -> None:
+        if rc != paho.MQTT_ERR_SUCCESS:
+            logging.warning("MQTT connection lost ({}), reconnecting".format(
+                paho.error_string(rc)))
+        self.__call_soon(self._connected.clear)
+
+    def __on_publish(self, client, userdata, mid) -> None:
+        self.__call_soon(self.__acknowledged, mid)
+
+    def __on_message(self, client, userdata, message) -> None:
+        method_name = message.topic.rpartition("/")[2]
+        try:
+            payload = json.loads(message.payload) if message.payload else None
+        except ValueError:
+            payload = message.payload.decode(errors="replace")
+        self.__call_soon(self._requests.put_nowait, (method_name, payload))
+
+    def __call_soon(self, callback, *args) -> None:
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(callback, *args)
+
+    def __acknowledged(self, mid: int) -> None:
+        published = self._unacked.pop(mid, None)
+        if published is not None:
+            metrics.SEND_DURATION.observe(time.monotonic() - published)
+        metrics.MQTT_UNACKED.set(len(self._unacked))
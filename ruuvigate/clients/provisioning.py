@@ -0,0 +1,96 @@
+import os
+import json
+import hashlib
+import logging
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+
+class ProvisioningCache:
+    '''
+    Remembers the IoT hub and device ID the Device Provisioning Service assigned, so
+    that a restart can connect to the hub without provisioning again. The result is
+    keyed by a digest of the configuration it was provisioned with and is ignored
+    once the configuration changes. No secrets are stored.
+    '''
+
+    def __init__(self, path: Optional[str]):
+        """
+        Args:
+            path (Optional[str]): Cache file, created when a result is stored.
+                Nothing is cached if empty.
+        """
+        self._path = path
+
+    @staticmethod
+    def key(config: Dict[str, Any], params: Iterable[str]) -> str:
+        """
+        Args:
+            config (Dict[str, Any]): The configuration
+            params (Iterable[str]): The configurations provisioning depends on
+
+        Returns:
+            str: Digest of the configurations
+        """
+        relevant = {param: config.get(param) for param in params}
+        return hashlib.sha256(json.dumps(relevant,
+                                         sort_keys=True).encode()).hexdigest()
+
+    def load(self, key: str) -> Optional[Tuple[str, str]]:
+        """
+        Args:
+            key (str): Digest of the current configuration
+
+        Returns:
+            Optional[Tuple[str, str]]: Assigned hub and device ID, None if there is
+                no result for the configuration
+        """
+        if not self._path:
+            return None
+        try:
+            with open(self._path, "r") as stream:
+                cached = json.load(stream)
+            if cached["key"] != key:
+                logging.info("Configuration changed since provisioning")
+                return None
+            return cached["assigned_hub"], cached["device_id"]
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as ex:
+            logging.warning(
+                "Ignoring unreadable provisioning cache {}: {} {}".format(
+                    self._path,
+                    type(ex).__name__, ex.args))
+            return None
+
+    def store(self, key: str, assigned_hub: str, device_id: str) -> None:
+        if not self._path:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self._path)),
+                        exist_ok=True)
+            tmp = self._path + ".tmp"
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as stream:
+                json.dump(
+                    {
+                        "key": key,
+                        "assigned_hub": assigned_hub,
+                        "device_id": device_id
+                    }, stream)
+                stream.flush()
+                os.fsync(stream.fileno())
+            os.replace(tmp, self._path)
+        except OSError as ex:
+            logging.warning("Couldn't cache provisioning result: {} {}".format(
+                type(ex).__name__, ex.args))
+
+    def clear(self) -> None:
+        if not self._path:
+            return
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+        except OSError as ex:
+            logging.warning("Couldn't clear provisioning cache: {} {}".format(
+                type(ex).__name__, ex.args))
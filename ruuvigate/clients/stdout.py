@@ -18,9 +18,9 @@ class StdOut:
         """
         pass
 
-    async def execute_method_listener(self, *_) -> None:
+    def register_method_handler(self, *_) -> None:
         """
-        Dummy implementation for abstract execute_method_listener method.
+        Dummy implementation for abstract register_method_handler method.
 
         Args:
             *_: Placeholder arguments.
@@ -30,6 +30,15 @@ class StdOut:
         """
         pass
 
+    async def execute_method_dispatcher(self) -> None:
+        """
+        Dummy implementation for abstract execute_method_dispatcher method.
+
+        Returns:
+            None
+        """
+        pass
+
     async def publish_data(self, data: Dict[str, str] = {}) -> None:
         """
         Publishes stored and provided data to the standard output.
@@ -0,0 +1,93 @@
+import time
+from typing import Any, Callable, Dict, NamedTuple, Tuple
+
+
+class Threshold(NamedTuple):
+    value: float
+    relative: bool = False
+
+    def exceeded(self, previous: float, current: float) -> bool:
+        limit = self.value * abs(previous) if self.relative else self.value
+        return abs(current - previous) > limit
+
+
+class DeadbandFilter:
+    '''
+    Suppresses RuuviTag measurements that haven't changed more than a threshold
+    since they were last forwarded. The measurement sequence number is always
+    forwarded and every RuuviTag gets a full heartbeat reading periodically.
+    '''
+    Metrics = ("temperature", "humidity", "pressure", "battery")
+    AlwaysForwarded = ("measurement_sequence_number", )
+
+    def __init__(self,
+                 thresholds: Dict[str, Threshold],
+                 heartbeat: float,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        Args:
+            thresholds (Dict[str, Threshold]): Deadband of each filtered metric
+            heartbeat (float): Seconds between forced full readings of a RuuviTag
+            clock (Callable): Monotonic clock
+        """
+        self._thresholds = thresholds
+        self._heartbeat = heartbeat
+        self._clock = clock
+        # Last forwarded values and the time of the last full reading per MAC
+        self._forwarded: Dict[str, Dict[str, Any]] = {}
+        self._full: Dict[str, float] = {}
+
+    def filter(self, mac: str, reading: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Args:
+            mac (str): MAC of the RuuviTag
+            reading (Dict[str, Any]): The measurements of the RuuviTag
+
+        Returns:
+            Dict[str, Any]: The measurements to forward
+        """
+        now = self._clock()
+        forwarded = self._forwarded.get(mac)
+        if forwarded is None or now - self._full[mac] >= self._heartbeat:
+            self._forwarded[mac] = dict(reading)
+            self._full[mac] = now
+            return reading
+
+        changed = {}
+        for metric, value in reading.items():
+            threshold = self._thresholds.get(metric)
+            if (metric in self.AlwaysForwarded or threshold is None
+                    or metric not in forwarded or value is None
+                    or forwarded[metric] is None
+                    or threshold.exceeded(forwarded[metric], value)):
+                changed[metric] = value
+        forwarded.update(changed)
+        return changed
+
+    def remove(self, mac: str) -> None:
+        self._forwarded.pop(mac, None)
+        self._full.pop(mac, None)
+
+    @classmethod
+    def parse_threshold(cls, spec: str) -> Tuple[str, Threshold]:
+        """
+        Args:
+            spec (str): METRIC=VALUE for an absolute or METRIC=VALUE% for a relative
+                threshold, e.g. "temperature=0.2" or "pressure=0.1%"
+
+        Returns:
+            Tuple[str, Threshold]: The metric and its threshold
+        """
+        metric, _, value = spec.partition("=")
+        metric = metric.strip().lower()
+        if metric not in cls.Metrics:
+            raise ValueError(
+                "Unknown metric \"{}\", expected one of: {}".format(
+                    metric, ", ".join(cls.Metrics)))
+        value = value.strip()
+        relative = value.endswith("%")
+        threshold = float(value.rstrip("%"))
+        if threshold < 0:
+            raise ValueError("Threshold must not be negative")
+        return metric, Threshold(threshold / 100 if relative else threshold,
+                                 relative)
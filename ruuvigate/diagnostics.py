@@ -0,0 +1,138 @@
+import os
+import time
+import asyncio
+from typing import Any, Dict, List, Optional, Sequence
+
+
+class Diagnostics:
+    '''
+    Diagnoses the running gateway on demand. For a given time the event loop is
+    profiled, the time the coroutines of interest run is recorded and the memory
+    allocated and not freed is traced. The profiler and tracemalloc are imported
+    and enabled only while collecting, so there is no overhead otherwise.
+    '''
+    Duration = 5.0
+    # Longest collection that fits in the default timeout of direct methods
+    MaxDuration = 15.0
+    Top = 10
+    MaxTop = 50
+    # Frames traced per allocation
+    Frames = 1
+    # Coroutines whose running time is reported by name
+    Coroutines = ("publish_ruuvi_data", "get_ruuvi_data", "send_ruuvi_data",
+                  "publish_data", "execute_method_dispatcher", "call_method")
+
+    def __init__(self, coroutines: Sequence[str] = Coroutines):
+        """
+        Args:
+            coroutines (Sequence[str]): Names of the coroutine functions to time
+        """
+        self._coroutines = tuple(coroutines)
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    async def collect(self,
+                      duration: float = Duration,
+                      top: int = Top) -> Dict[str, Any]:
+        """
+        Args:
+            duration (float): Seconds to collect for
+            top (int): Number of functions and allocation sites reported
+
+        Returns:
+            Dict[str, Any]: Wall and CPU time of the collection, the number of
+                tasks, the functions that ran longest on the event loop
+                ("Profile"), the number of resumes and the running time of the
+                coroutines of interest ("Coroutines") and the source lines that
+                allocated the most memory not freed by the end ("Memory")
+
+        Raises:
+            RuntimeError: If a collection is already running
+        """
+        if self.running:
+            raise RuntimeError("Diagnostics already running")
+        async with self._lock:
+            import cProfile
+            import pstats
+            import tracemalloc
+            tracing = tracemalloc.is_tracing()
+            if not tracing:
+                tracemalloc.start(self.Frames)
+            profiler = cProfile.Profile()
+            wall, cpu = time.monotonic(), time.process_time()
+            profiler.enable()
+            try:
+                await asyncio.sleep(duration)
+            finally:
+                profiler.disable()
+                wall = time.monotonic() - wall
+                cpu = time.process_time() - cpu
+                snapshot = tracemalloc.take_snapshot()
+                traced, peak = tracemalloc.get_traced_memory()
+                if not tracing:
+                    tracemalloc.stop()
+            snapshot = snapshot.filter_traces(
+                (tracemalloc.Filter(False, tracemalloc.__file__), ))
+            stats = pstats.Stats(profiler).stats  # type: ignore
+        return {
+            "Duration": round(wall, 3),
+            "CpuTime": round(cpu, 3),
+            "Tasks": len(asyncio.all_tasks()),
+            "Profile": self.__profile(stats, top),
+            "Coroutines": self.__coroutines(stats),
+            "Memory": {
+                "Traced":
+                traced,
+                "Peak":
+                peak,
+                "Top": [{
+                    "Line": self.__location(frame.filename, frame.lineno),
+                    "Size": stat.size,
+                    "Count": stat.count
+                } for stat in snapshot.statistics("lineno")[:top]
+                        for frame in stat.traceback[:1]]
+            }
+        }
+
+    @classmethod
+    def __profile(cls, stats: Dict[tuple, tuple],
+                  top: int) -> List[Dict[str, Any]]:
+        # Sorted by cumulative time, without the collection itself
+        ordered = sorted(
+            ((function, entry)
+             for function, entry in stats.items() if function[2] != "collect"),
+            key=lambda item: item[1][3],
+            reverse=True)
+        return [{
+            "Function": cls.__function(function),
+            "Calls": calls,
+            "Time": round(own, 6),
+            "Cumulative": round(cumulative, 6)
+        } for function, (_, calls, own, cumulative, _) in ordered[:top]]
+
+    def __coroutines(self, stats: Dict[tuple,
+                                       tuple]) -> Dict[str, Dict[str, Any]]:
+        # A coroutine is "called" whenever it's resumed, so the cumulative time
+        # is the time it ran on the event loop, not the time it was suspended
+        timings: Dict[str, Dict[str, Any]] = {}
+        for (_, _, name), (_, calls, _, cumulative, _) in stats.items():
+            if name in self._coroutines:
+                timing = timings.setdefault(name, {"Resumes": 0, "Time": 0.0})
+                timing["Resumes"] += calls
+                timing["Time"] = round(timing["Time"] + cumulative, 6)
+        return timings
+
+    @classmethod
+    def __function(cls, function: tuple) -> str:
+        filename, line, name = function
+        if filename == "~":
+            # Built-in function
+            return name
+        return "{} ({})".format(name, cls.__location(filename, line))
+
+    @staticmethod
+    def __location(filename: Optional[str], line: int) -> str:
+        return "{}:{}".format(os.path.basename(filename or "?"), line)
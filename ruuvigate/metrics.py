@@ -0,0 +1,255 @@
+import time
+import asyncio
+import logging
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+LabelValues = Tuple[str, ...]
+Sample = Tuple[str, LabelValues, Sequence[str], float]
+
+
+class Metric:
+    '''
+    Base of the Prometheus metrics. Values are kept per label values, or produced at
+    collection time by a function returning them.
+    '''
+    Type = "untyped"
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labels: Sequence[str] = (),
+                 registry: Optional["Registry"] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: Dict[LabelValues, float] = {}
+        self._function: Optional[Callable[[], Dict[LabelValues, float]]] = None
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def set_function(self, function: Callable[[], Dict[LabelValues,
+                                                       float]]) -> None:
+        """
+        Args:
+            function (Callable): Returns the values per label values on collection
+        """
+        self._function = function
+
+    def remove(self, *label_values: str) -> None:
+        self._values.pop(label_values, None)
+
+    def samples(self) -> Iterator[Sample]:
+        values = self._function() if self._function else self._values
+        for label_values, value in list(values.items()):
+            yield self.name, label_values, self.labels, value
+
+
+class Counter(Metric):
+    Type = "counter"
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        self._values[label_values] = self._values.get(label_values,
+                                                      0.0) + amount
+
+
+class Gauge(Metric):
+    Type = "gauge"
+
+    def set(self, value: float, *label_values: str) -> None:
+        self._values[label_values] = value
+
+
+class Histogram(Metric):
+    Type = "histogram"
+    DefaultBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                      10.0, 30.0, 60.0)
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DefaultBuckets,
+                 registry: Optional["Registry"] = None):
+        super().__init__(name, documentation, labels, registry)
+        self._buckets = tuple(buckets)
+        # Bucket counts followed by the sum and the count of the observations
+        self._observations: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        observations = self._observations.get(label_values)
+        if observations is None:
+            observations = [0.0] * (len(self._buckets) + 2)
+            self._observations[label_values] = observations
+        for i, bound in enumerate(self._buckets):
+            if value <= bound:
+                observations[i] += 1
+        observations[-2] += value
+        observations[-1] += 1
+
+    def samples(self) -> Iterator[Sample]:
+        bucket = self.name + "_bucket"
+        bucket_labels = self.labels + ("le", )
+        for label_values, observations in list(self._observations.items()):
+            total, count = observations[-2], observations[-1]
+            for bound, observed in zip(self._buckets, observations):
+                yield (bucket, label_values + (repr(bound), ), bucket_labels,
+                       observed)
+            yield bucket, label_values + ("+Inf", ), bucket_labels, count
+            yield self.name + "_sum", label_values, self.labels, total
+            yield self.name + "_count", label_values, self.labels, count
+
+
+class Registry:
+    '''
+    Collects metrics and renders them in the Prometheus text exposition format
+    '''
+
+    def __init__(self) -> None:
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> None:
+        self._metrics.append(metric)
+
+    def exposition(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append("# HELP {} {}".format(metric.name,
+                                               metric.documentation))
+            lines.append("# TYPE {} {}".format(metric.name, metric.Type))
+            for name, label_values, labels, value in metric.samples():
+                if labels:
+                    name += "{" + ",".join(
+                        '{}="{}"'.format(label, self.__escape(label_value))
+                        for label, label_value in zip(labels,
+                                                      label_values)) + "}"
+                lines.append("{} {}".format(name, repr(float(value))))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def __escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace("\n",
+                                                   "\\n").replace('"', '\\"')
+
+
+REGISTRY = Registry()
+
+SCAN_DURATION = Histogram("ruuvigate_scan_duration_seconds",
+                          "Duration of the periodic RuuviTag scans")
+TAGS_CONFIGURED = Gauge("ruuvigate_tags_configured",
+                        "Number of RuuviTags in use")
+TAGS_SEEN = Gauge("ruuvigate_tags_seen",
+                  "Number of RuuviTags heard during the last cycle")
+TAG_LAST_SEEN_AGE = Gauge("ruuvigate_tag_last_seen_age_seconds",
+                          "Seconds since a RuuviTag was last heard", ["mac"])
+TAG_RSSI = Gauge("ruuvigate_tag_rssi_dbm",
+                 "Signal strength of the last reading of a RuuviTag", ["mac"])
+CYCLE_OVERRUNS = Counter("ruuvigate_cycle_overruns_total",
+                         "Publish cycles that overran their deadline")
+CYCLE_SKIPPED = Counter("ruuvigate_cycle_skipped_ticks_total",
+                        "Publish ticks skipped after overruns")
+PUBLISH_DURATION = Histogram(
+    "ruuvigate_publish_duration_seconds",
+    "Duration of handing a cycle of readings to the publisher")
+SEND_DURATION = Histogram("ruuvigate_send_duration_seconds",
+                          "Duration of sending a message to the cloud")
+SEND_FAILURES = Counter("ruuvigate_send_failures_total",
+                        "Messages that failed to be sent to the cloud")
+QUEUE_DEPTH = Gauge("ruuvigate_queue_depth",
+                    "Readings waiting in the store-and-forward queue")
+QUEUE_OLDEST_AGE = Gauge(
+    "ruuvigate_queue_oldest_age_seconds",
+    "Age of the oldest reading in the store-and-forward queue")
+MQTT_UNACKED = Gauge(
+    "ruuvigate_mqtt_unacked",
+    "MQTT publishes waiting for an acknowledgement, in flight or queued")
+SINK_QUEUE_DEPTH = Gauge("ruuvigate_sink_queue_depth",
+                         "Batches waiting in the queue of a publishing sink",
+                         ["sink"])
+SINK_LAG = Histogram(
+    "ruuvigate_sink_lag_seconds",
+    "Delay from queueing a batch to a publishing sink until it was published",
+    ["sink"])
+SINK_DROPPED = Counter(
+    "ruuvigate_sink_dropped_total",
+    "Batches dropped from the full queue of a publishing sink", ["sink"])
+METHOD_REQUESTS = Counter("ruuvigate_method_requests_total",
+                          "Handled direct method requests",
+                          ["method", "status"])
+EVENT_LOOP_LAG = Histogram(
+    "ruuvigate_event_loop_lag_seconds",
+    "Delay of the event loop in waking up a periodic task",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+
+_last_seen: Dict[str, float] = {}
+TAG_LAST_SEEN_AGE.set_function(lambda: {
+    (mac, ): time.monotonic() - seen
+    for mac, seen in _last_seen.items()
+})
+
+
+def tag_seen(mac: str, rssi: Optional[float]) -> None:
+    _last_seen[mac] = time.monotonic()
+    if rssi is not None:
+        TAG_RSSI.set(rssi, mac)
+
+
+def tag_removed(mac: str) -> None:
+    _last_seen.pop(mac, None)
+    TAG_RSSI.remove(mac)
+
+
+async def monitor_event_loop_lag(interval: float = 1.0) -> None:
+    """
+    Measures how late the event loop wakes up a sleeping task until cancelled.
+
+    Args:
+        interval (float): Seconds between the measurements
+    """
+    while True:
+        try:
+            start = time.monotonic()
+            await asyncio.sleep(interval)
+            EVENT_LOOP_LAG.observe(
+                max(0.0,
+                    time.monotonic() - start - interval))
+        except asyncio.CancelledError:
+            break
+
+
+async def serve_metrics(host: str, port: int) -> None:
+    """
+    Serves the metrics over HTTP until cancelled.
+
+    Args:
+        host (str): Address to listen on
+        port (int): Port to listen on
+    """
+
+    async def handle(reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            path = request.split()[1].decode() if len(
+                request.split()) > 1 else ""
+            if path.split("?")[0] in ("/", "/metrics"):
+                status = "200 OK"
+                body = REGISTRY.exposition().encode()
+            else:
+                status, body = "404 Not Found", b""
+            writer.write(
+                "HTTP/1.1 {}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {}\r\nConnection: close\r\n\r\n"
+                .format(status, len(body)).encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logging.info("Serving metrics on {}:{}".format(host, port))
+    try:
+        async with server:
+            await server.serve_forever()
+    except asyncio.CancelledError:
+        logging.info("Exiting metrics server")
@@ -0,0 +1,243 @@
+"""
+Generates the IoT Central device model (DTDL) of the published telemetry, for
+either schema:
+
+    python -m ruuvigate.model --schema map > RuuviGateMap.json
+    python -m ruuvigate.model --schema slots --slots 20 > RuuviGate20.json
+"""
+import os
+import re
+import sys
+import json
+import argparse
+from typing import Any, Dict, List, Optional, Tuple
+
+SCHEMAS = ("slots", "map")
+
+# Interface of the direct methods, referenced as a component
+COMMANDS_ID = "dtmi:ruuvimonitor:RuuviGate_250;1"
+COMMANDS_COMPONENT = "RuuviGate_250"
+COMMANDS_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                             "resources", "azure-iot-central",
+                             "RuuviGateCtrl.json")
+CONTEXT = ["dtmi:iotcentral:context;2", "dtmi:dtdl:context;2"]
+# Interface of the shipped model of five RuuviTags in the "slots" schema
+SLOTS_INTERFACE = "dtmi:ruuvimonitor:RuuviGate5g5;2"
+
+# Semantic type, unit and schema of every telemetry, in the order of
+# RuuviTags.Telemetry
+_METRICS: Dict[str, Tuple[str, str]] = {
+    "Temperature": ("Temperature", "degreeCelsius"),
+    "Humidity": ("RelativeHumidity", "percent"),
+    "Pressure": ("Pressure", "pascal"),
+    "Battery": ("Voltage", "volt"),
+}
+# Units in the display names of map fields
+_SYMBOLS = {"degreeCelsius": "°C", "percent": "%", "pascal": "Pa", "volt": "V"}
+Measurement = Tuple[str, Optional[str], Optional[str], str, Optional[str]]
+MEASUREMENTS: Tuple[Measurement, ...] = (
+    tuple((name, semantic, unit, "double", None)
+          for name, (semantic, unit) in _METRICS.items()) +
+    (("Sequence", None, None, "integer", "Measurement sequence number"),
+     ("Samples", None, None, "integer",
+      "Number of measurements aggregated over the interval")) + tuple(
+          (metric + aggregate, semantic, unit, "double",
+           "{} of the interval".format(description))
+          for metric, (semantic, unit) in _METRICS.items()
+          for aggregate, description in (("Min", "Minimum"),
+                                         ("Max", "Maximum"),
+                                         ("Mean", "Mean"))) +
+    (("PacketLoss", None, None, "double",
+      "Rolling ratio of lost measurements"),
+     ("Duplicates", None, None, "double",
+      "Rolling ratio of duplicate measurements")))
+
+
+def _telemetry(interface: str, name: str, display_name: str,
+               measurement: Measurement) -> Dict[str, Any]:
+    _, semantic, unit, schema, description = measurement
+    content: Dict[str, Any] = {
+        "@id": "{}:{};1".format(interface.rpartition(";")[0], name),
+        "@type": ["Telemetry", semantic] if semantic else "Telemetry",
+    }
+    if description:
+        content["description"] = {"en": description}
+    content.update({
+        "displayName": {
+            "en": display_name
+        },
+        "name": name,
+        "schema": schema
+    })
+    if unit:
+        content["unit"] = unit
+    return content
+
+
+def _slots_contents(interface: str, slots: int) -> List[Dict[str, Any]]:
+    contents = []
+    for slot in range(1, slots + 1):
+        for measurement in MEASUREMENTS:
+            name = measurement[0]
+            contents.append(
+                _telemetry(interface, name + str(slot),
+                           "Ruuvi{} {}".format(slot,
+                                               _words(name)), measurement))
+        contents.append({
+            "@id":
+            "{}:MAC{};1".format(interface.rpartition(";")[0], slot),
+            "@type":
+            "Property",
+            "description": {
+                "en": "MAC address of the associated RuuviTag"
+            },
+            "displayName": {
+                "en": "Ruuvi{} MAC".format(slot)
+            },
+            "name":
+            "MAC" + str(slot),
+            "schema":
+            "string",
+            "writable":
+            True
+        })
+    return contents
+
+
+def _words(name: str) -> str:
+    """
+    Returns:
+        str: The name in lower case words, e.g. "packet loss" for "PacketLoss"
+    """
+    return re.sub(r"(?<!^)(?=[A-Z])", " ", name).lower()
+
+
+def _map_contents(interface: str) -> List[Dict[str, Any]]:
+    # Fields of objects can't have units, they are in the display names
+    fields = [{
+        "name": name,
+        "displayName": {
+            "en": "{} ({})".format(name, _SYMBOLS[unit]) if unit else name
+        },
+        "schema": schema
+    } for name, _, unit, schema, _ in MEASUREMENTS]
+    return [{
+        "@id": "{}:Tags;1".format(interface.rpartition(";")[0]),
+        "@type": "Telemetry",
+        "description": {
+            "en": "Measurements of every RuuviTag by its MAC"
+        },
+        "displayName": {
+            "en": "RuuviTags"
+        },
+        "name": "Tags",
+        "schema": {
+            "@type": "Map",
+            "mapKey": {
+                "name": "MAC",
+                "schema": "string"
+            },
+            "mapValue": {
+                "name": "Measurements",
+                "schema": {
+                    "@type": "Object",
+                    "fields": fields
+                }
+            }
+        }
+    }]
+
+
+def device_model(schema: str,
+                 slots: int = 5,
+                 commands: Optional[Dict[str, Any]] = None,
+                 interface: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Args:
+        schema (str): "slots" for telemetry fields numbered by the slot of their
+            RuuviTag, e.g. "Temperature1", or "map" for the measurements keyed by
+            MAC under "Tags"
+        slots (int): Number of RuuviTags modelled in the "slots" schema
+        commands (Dict[str, Any]): Interface of the direct methods, included after
+            the telemetry interface if given
+        interface (str): DTMI of the telemetry interface
+
+    Returns:
+        List[Dict[str, Any]]: The interfaces of the device model
+    """
+    if schema not in SCHEMAS:
+        raise ValueError("Unknown schema: {}".format(schema))
+    if interface is None:
+        interface = "dtmi:ruuvimonitor:RuuviGateMap;1" if schema == "map" else \
+            SLOTS_INTERFACE if slots == 5 else \
+            "dtmi:ruuvimonitor:RuuviGate{};1".format(slots)
+    contents = _map_contents(interface) if schema == "map" else \
+        _slots_contents(interface, slots)
+    # The component is versioned with the interface
+    prefix, _, version = interface.rpartition(";")
+    contents.append({
+        "@id":
+        "{}:{};{}".format(prefix, COMMANDS_COMPONENT, version),
+        "@type":
+        "Component",
+        "displayName": {
+            "en": "RuuviGateCtrl"
+        },
+        "name":
+        COMMANDS_COMPONENT,
+        "schema":
+        COMMANDS_ID
+    })
+    model: List[Dict[str, Any]] = [{
+        "@id": interface,
+        "@type": "Interface",
+        "contents": contents,
+        "displayName": {
+            "en": "RuuviGate"
+        },
+        "@context": CONTEXT
+    }]
+    if commands is not None:
+        model.append(commands)
+    return model
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m ruuvigate.model",
+        description="Generates the IoT Central device model of RuuviGate")
+    parser.add_argument('--schema',
+                        choices=SCHEMAS,
+                        default="map",
+                        help='Telemetry schema (default: %(default)s)')
+    parser.add_argument(
+        '--slots',
+        type=int,
+        default=5,
+        help='RuuviTags modelled in the slots schema (default: %(default)s)')
+    parser.add_argument(
+        '--commands',
+        default=COMMANDS_PATH,
+        help='Interface of the direct methods to include (default: %(default)s)'
+    )
+    parser.add_argument('--interface',
+                        default=None,
+                        help='DTMI of the telemetry interface')
+    parser.add_argument('-o',
+                        '--output',
+                        type=argparse.FileType('w'),
+                        default=sys.stdout,
+                        help='File to write the model to (default: stdout)')
+    args = parser.parse_args(argv)
+    if args.slots < 1:
+        parser.error("Slots must be greater than zero")
+    commands = None
+    if args.commands and os.path.exists(args.commands):
+        with open(args.commands, "r") as stream:
+            commands = json.load(stream)
+    model = device_model(args.schema, args.slots, commands, args.interface)
+    args.output.write(json.dumps(model, indent=2, ensure_ascii=False) + "\n")
+
+
+if __name__ == '__main__':
+    main()
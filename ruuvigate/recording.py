@@ -0,0 +1,196 @@
+import time
+import struct
+import asyncio
+import logging
+from typing import (Any, AsyncIterator, BinaryIO, Callable, Dict, Iterator,
+                    Optional, Tuple)
+
+from ruuvitag_sensor.adapters import get_ble_adapter, throw_if_not_async_adapter  # type: ignore
+from ruuvitag_sensor.data_formats import DataFormats  # type: ignore
+from ruuvitag_sensor.decoder import get_decoder, parse_mac  # type: ignore
+
+Reading = Dict[str, Any]
+RawAdvertisement = Tuple[str, str]
+RawAdvertisementSource = Callable[[], AsyncIterator[RawAdvertisement]]
+
+
+def raw_ble_advertisements(
+        bt_device: str = "") -> AsyncIterator[RawAdvertisement]:
+    """
+    Raw advertisements from the asynchronous BLE adapter.
+
+    Args:
+        bt_device (str): Bluetooth adapter to scan on, the default if empty
+
+    Returns:
+        AsyncIterator: (MAC, raw data as hex) tuples for every RuuviTag heard
+    """
+    ble = get_ble_adapter()
+    throw_if_not_async_adapter(ble)
+    return ble.get_data([], bt_device)
+
+
+def decode(mac: str, raw: str) -> Optional[Tuple[str, Reading]]:
+    """
+    Decodes a raw advertisement the same way the RuuviTag library does.
+
+    Args:
+        mac (str): MAC the advertisement was heard from, empty if unknown
+        raw (str): Raw data as hex
+
+    Returns:
+        Optional[Tuple[str, Reading]]: MAC and reading, None if the advertisement
+            carries no measurements
+    """
+    data_format, data = DataFormats.convert_data(raw)
+    if data is None or data_format is None:
+        return None
+    decoded = get_decoder(data_format).decode_data(data)
+    if decoded is None:
+        return None
+    if not mac and decoded.get("mac"):
+        mac = parse_mac(data_format, decoded["mac"])
+    return mac, decoded
+
+
+class AdvertisementRecorder:
+    '''
+    Appends raw advertisements to a compact binary log. The log starts with a magic
+    and holds a record per advertisement: the monotonic timestamp, the MAC as six
+    bytes, the length of the raw data and the raw data.
+    '''
+    Magic = b"RUUVIREC\x01"
+    Record = struct.Struct("<d6sH")
+    FlushInterval = 1.0
+
+    def __init__(self, path: str, clock: Callable[[], float] = time.monotonic):
+        """
+        Args:
+            path (str): Log file, appended to if it exists
+            clock (Callable): Monotonic clock of the timestamps
+        """
+        self._clock = clock
+        self._stream: BinaryIO = open(path, "ab")
+        if self._stream.tell() == 0:
+            self._stream.write(self.Magic)
+        elif not self.__has_magic(path):
+            self._stream.close()
+            raise ValueError(
+                "{} is not an advertisement recording".format(path))
+        self._flushed = clock()
+        self.records = 0
+
+    def write(self, mac: str, raw: str) -> None:
+        """
+        Args:
+            mac (str): MAC the advertisement was heard from, empty if unknown
+            raw (str): Raw data as hex
+        """
+        try:
+            payload = bytes.fromhex(raw)
+            address = bytes.fromhex(mac.replace(":", "")) if mac else bytes(6)
+        except ValueError:
+            logging.debug("Not recording malformed advertisement {} {}".format(
+                mac, raw))
+            return
+        now = self._clock()
+        self._stream.write(
+            self.Record.pack(now, address, len(payload)) + payload)
+        self.records += 1
+        if now - self._flushed >= self.FlushInterval:
+            self._stream.flush()
+            self._flushed = now
+
+    def close(self) -> None:
+        self._stream.close()
+
+    @classmethod
+    def __has_magic(cls, path: str) -> bool:
+        with open(path, "rb") as stream:
+            return stream.read(len(cls.Magic)) == cls.Magic
+
+
+def read_recording(path: str) -> Iterator[Tuple[float, str, str]]:
+    """
+    Reads an advertisement log written by AdvertisementRecorder. A record torn by
+    a crash at the end of the log is ignored.
+
+    Args:
+        path (str): Log file
+
+    Returns:
+        Iterator[Tuple[float, str, str]]: Monotonic timestamp, MAC (empty if
+            unknown) and raw data as hex of every advertisement
+    """
+    record = AdvertisementRecorder.Record
+    with open(path, "rb") as stream:
+        if stream.read(len(
+                AdvertisementRecorder.Magic)) != AdvertisementRecorder.Magic:
+            raise ValueError(
+                "{} is not an advertisement recording".format(path))
+        while True:
+            header = stream.read(record.size)
+            if len(header) < record.size:
+                break
+            timestamp, address, length = record.unpack(header)
+            payload = stream.read(length)
+            if len(payload) < length:
+                break
+            mac = ":".join("{:02X}".format(b)
+                           for b in address) if any(address) else ""
+            yield timestamp, mac, payload.hex().upper()
+
+
+async def replayed_advertisements(path: str,
+                                  speed: float = 1.0
+                                  ) -> AsyncIterator[RawAdvertisement]:
+    """
+    Replays an advertisement log keeping the recorded gaps between the
+    advertisements, compressed by the speed.
+
+    Args:
+        path (str): Log file
+        speed (float): Multiple of real time
+
+    Returns:
+        AsyncIterator: (MAC, raw data as hex) tuples
+    """
+    start = time.monotonic()
+    first: Optional[float] = None
+    previous = 0.0
+    for timestamp, mac, raw in read_recording(path):
+        if first is None:
+            first = timestamp
+        # Recordings appended after a reboot restart the monotonic clock
+        if timestamp < previous:
+            first += timestamp - previous
+        previous = timestamp
+        delay = start + (timestamp - first) / speed - time.monotonic()
+        await asyncio.sleep(max(0.0, delay))
+        yield mac, raw
+
+
+def decoded_advertisements(
+    source: RawAdvertisementSource,
+    recorder: Optional[AdvertisementRecorder] = None
+) -> AsyncIterator[Tuple[str, Reading]]:
+    """
+    Decodes raw advertisements, recording them first if a recorder is given.
+
+    Args:
+        source (RawAdvertisementSource): Source of the raw advertisements
+        recorder (AdvertisementRecorder): Recorder of the raw advertisements
+
+    Returns:
+        AsyncIterator: (MAC, reading) tuples for every RuuviTag heard
+    """
+
+    async def decoded() -> AsyncIterator[Tuple[str, Reading]]:
+        async for mac, raw in source():
+            if recorder is not None:
+                recorder.write(mac, raw)
+            reading = decode(mac, raw)
+            if reading is not None:
+                yield reading
+
+    return decoded()
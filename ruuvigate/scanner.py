@@ -0,0 +1,239 @@
+import asyncio
+import logging
+from typing import (Any, AsyncIterator, Callable, Dict, Iterable, Optional,
+                    Sequence, Tuple, TypeVar)
+
+from ruuvitag_sensor.ruuvi import RuuviTagSensor  # type: ignore
+
+from ruuvigate.aggregate import TagWindow
+from ruuvigate.sequence import (SequenceKey, SequenceTracker, is_newer,
+                                sequence_modulo)
+
+Reading = Dict[str, Any]
+AdvertisementSource = Callable[[], AsyncIterator[Tuple[str, Reading]]]
+T = TypeVar("T")
+
+
+def ble_advertisements(
+        bt_device: str = "") -> AsyncIterator[Tuple[str, Reading]]:
+    """
+    Decoded RuuviTag advertisements from the asynchronous BLE adapter.
+
+    Args:
+        bt_device (str): Bluetooth adapter to scan on, the default if empty
+
+    Returns:
+        AsyncIterator: (MAC, reading) tuples for every RuuviTag heard
+    """
+    return RuuviTagSensor.get_data_async(None, bt_device)
+
+
+async def merge_sources(
+        sources: Sequence[Callable[[], AsyncIterator[T]]]) -> AsyncIterator[T]:
+    """
+    Consumes several sources concurrently, e.g. one per Bluetooth adapter. Ends
+    when all of them have ended, and fails as soon as one of them fails.
+
+    Args:
+        sources (Sequence[Callable]): Sources of the items
+
+    Returns:
+        AsyncIterator: Items of all the sources in the order they arrive
+    """
+    if len(sources) == 1:
+        async for item in sources[0]():
+            yield item
+        return
+
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    async def pump(source: Callable[[], AsyncIterator[T]]) -> None:
+        try:
+            async for item in source():
+                await queue.put(item)
+            await queue.put(done)
+        except Exception as ex:
+            await queue.put(ex)
+
+    pumps = [asyncio.create_task(pump(source)) for source in sources]
+    try:
+        running = len(pumps)
+        while running:
+            item = await queue.get()
+            if item is done:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        for task in pumps:
+            task.cancel()
+
+
+def is_preferred(candidate: Reading, current: Reading) -> bool:
+    """
+    Args:
+        candidate (Reading): Reading of a RuuviTag
+        current (Reading): Another reading of the same RuuviTag
+
+    Returns:
+        bool: True if the candidate is a newer measurement, or the same measurement
+            heard with a stronger signal
+    """
+    sequence, other = candidate.get(SequenceKey), current.get(SequenceKey)
+    if sequence is not None and other is not None and sequence != other:
+        return is_newer(sequence, other, sequence_modulo(candidate))
+    return (candidate.get("rssi") or -1000) > (current.get("rssi") or -1000)
+
+
+def merge_readings(scans: Iterable[Dict[str, Reading]]) -> Dict[str, Reading]:
+    """
+    Merges the scans of several Bluetooth adapters by MAC and measurement sequence
+    number.
+
+    Args:
+        scans (Iterable[Dict[str, Reading]]): Readings of each adapter by MAC
+
+    Returns:
+        Dict[str, Reading]: The newest measurement of every RuuviTag, of the
+            strongest signal if heard by several adapters
+    """
+    merged: Dict[str, Reading] = {}
+    for scan in scans:
+        for mac, reading in scan.items():
+            current = merged.get(mac)
+            if current is None or is_preferred(reading, current):
+                merged[mac] = reading
+    return merged
+
+
+class RuuviScanner:
+    '''
+    Consumes RuuviTag advertisements for the lifetime of the process and keeps the
+    latest reading of every heard RuuviTag in a table keyed by MAC. Optionally also
+    aggregates every reading of the publish window. Repeats of a measurement, e.g.
+    heard by several adapters, are dropped but the strongest copy is kept. Only
+    the readings of registered RuuviTags are kept if a registry is given.
+    '''
+    RestartDelay = 5
+
+    def __init__(self,
+                 source: AdvertisementSource = ble_advertisements,
+                 aggregate: bool = False,
+                 restart: bool = True,
+                 tracker: Optional[SequenceTracker] = None,
+                 registered: Optional[Callable[[str], bool]] = None):
+        """
+        Args:
+            source (AdvertisementSource): Source of the advertisements
+            aggregate (bool): Aggregate every reading of the publish window
+            restart (bool): Restart the source when it ends
+            tracker (SequenceTracker): Tracker of the measurement sequences
+            registered (Callable[[str], bool]): Tells if a MAC is registered, all
+                are if None
+        """
+        self._source = source
+        self._registered = registered
+        self._aggregate = aggregate
+        self._restart = restart
+        self._latest: Dict[str, Reading] = {}
+        self._windows: Dict[str, TagWindow] = {}
+        self.tracker = tracker if tracker is not None else SequenceTracker()
+
+    async def run(self) -> bool:
+        """
+        Scans until cancelled. The advertisement source is restarted if it fails,
+        and if it ends unless restarting is disabled.
+
+        Returns:
+            bool: True if the source ended, False if cancelled
+        """
+        logging.info("Starting continuous RuuviTag scanning")
+        while True:
+            try:
+                async for mac, reading in self._source():
+                    # Unregistered RuuviTags nearby aren't tracked either
+                    if self._registered is not None and not self._registered(
+                            mac):
+                        continue
+                    if self.__is_repeat(mac, reading):
+                        continue
+                    self._latest[mac] = reading
+                    if self._aggregate:
+                        window = self._windows.get(mac)
+                        if window is None:
+                            window = self._windows[mac] = TagWindow()
+                        window.add(reading)
+                if not self._restart:
+                    logging.info("RuuviTag advertisement source ended")
+                    return True
+                logging.warning("RuuviTag advertisement source ended")
+            except asyncio.CancelledError:
+                logging.info("Exiting RuuviTag scanner")
+                break
+            except Exception as ex:
+                logging.error("RuuviTag scanning failed: {} {}".format(
+                    type(ex).__name__, ex.args))
+            try:
+                await asyncio.sleep(self.RestartDelay)
+            except asyncio.CancelledError:
+                logging.info("Exiting RuuviTag scanner")
+                break
+        return False
+
+    def __is_repeat(self, mac: str, reading: Reading) -> bool:
+        if self.tracker.observe(mac, reading):
+            return False
+        latest = self._latest.get(mac)
+        if latest is not None and is_preferred(reading, latest):
+            self._latest[mac] = reading
+        return True
+
+    def snapshot(self,
+                 macs: Iterable[str],
+                 clear: bool = True) -> Dict[str, Reading]:
+        """
+        Takes the readings received since the previous snapshot.
+
+        Args:
+            macs (Iterable[str]): MACs of the RuuviTags to include
+            clear (bool): Drop the readings of the other RuuviTags too, otherwise
+                they are kept for a later snapshot unless no longer registered
+
+        Returns:
+            Dict[str, Reading]: The latest reading of each heard RuuviTag, with the
+                aggregates of the window if aggregating
+        """
+        if not clear:
+            return self.__take(macs)
+        latest, self._latest = self._latest, {}
+        if not self._aggregate:
+            return {mac: latest[mac] for mac in macs if mac in latest}
+        windows, self._windows = self._windows, {}
+        return {
+            mac: {
+                **latest[mac],
+                **windows[mac].summary()
+            }
+            for mac in macs if mac in latest
+        }
+
+    def __take(self, macs: Iterable[str]) -> Dict[str, Reading]:
+        readings = {}
+        for mac in macs:
+            reading = self._latest.pop(mac, None)
+            if reading is None:
+                continue
+            if self._aggregate:
+                reading = {**reading, **self._windows.pop(mac).summary()}
+            readings[mac] = reading
+        if self._registered is not None:
+            # Forget the RuuviTags removed from the registry meanwhile
+            for mac in [
+                    mac for mac in self._latest if not self._registered(mac)
+            ]:
+                del self._latest[mac]
+                self._windows.pop(mac, None)
+        return readings
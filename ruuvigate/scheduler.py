@@ -0,0 +1,148 @@
+import asyncio
+import heapq
+import logging
+import math
+import time
+from typing import Callable, Dict, List, Mapping, Optional, Tuple
+
+
+class TagScheduler:
+    '''
+    Schedules every RuuviTag at its own interval, or at the default interval if it
+    has none. The next tick of every RuuviTag is kept in a heap, and the RuuviTags
+    whose ticks fall within Window seconds of each other are due together, so they
+    are published in one message. All intervals count from the same origin on a
+    monotonic clock, so the ticks don't drift and RuuviTags whose intervals are
+    multiples of each other fall due on the same ticks.
+    '''
+    # Fraction of the interval a tick may be late without counting as an overrun
+    Tolerance = 0.1
+    # Seconds within which the ticks of several RuuviTags are coalesced
+    Window = 0.5
+
+    def __init__(self,
+                 interval: float,
+                 align: bool = False,
+                 clock: Callable[[], float] = time.monotonic,
+                 wallclock: Callable[[], float] = time.time):
+        """
+        Args:
+            interval (float): Default seconds between the ticks of a RuuviTag
+            align (bool): Fire on wall-clock multiples of the intervals
+            clock (Callable): Monotonic clock
+            wallclock (Callable): Wall clock used for the alignment
+        """
+        self._interval = interval
+        self._clock = clock
+        self._origin = clock() - wallclock() if align else clock()
+        # Next tick and interval of every RuuviTag, the heap may hold stale ticks
+        self._heap: List[Tuple[float, str]] = []
+        self._ticks: Dict[str, float] = {}
+        self._intervals: Dict[str, float] = {}
+        self._synced: Optional[Mapping[str, Optional[float]]] = None
+        self._last = self._origin
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+
+    @property
+    def interval(self) -> float:
+        return self._interval
+
+    def update(self, intervals: Mapping[str, Optional[float]]) -> None:
+        """
+        Schedules the RuuviTags in use. Added RuuviTags and those whose interval
+        changed fall due on the next tick of their interval, removed ones are
+        dropped. The same mapping as in the previous update isn't compared again.
+
+        Args:
+            intervals (Mapping[str, Optional[float]]): Interval of every RuuviTag
+                by MAC, None for the default interval
+        """
+        if intervals is self._synced:
+            return
+        self._synced = intervals
+        now = self._clock()
+        for mac in [mac for mac in self._ticks if mac not in intervals]:
+            del self._ticks[mac]
+            del self._intervals[mac]
+        for mac, interval in intervals.items():
+            interval = interval or self._interval
+            if self._intervals.get(mac) != interval:
+                self._intervals[mac] = interval
+                self.__schedule(mac, self.__next_tick(interval, now))
+        if len(self._heap) > 2 * len(self._ticks) + 16:
+            # Drop the stale ticks
+            self._heap = [(tick, mac) for mac, tick in self._ticks.items()]
+            heapq.heapify(self._heap)
+
+    def shortest(self) -> float:
+        """
+        Returns:
+            float: Shortest interval of the RuuviTags scheduled, the default
+                interval if none is
+        """
+        return min(self._intervals.values(), default=self._interval)
+
+    def remaining(self) -> float:
+        """
+        Returns:
+            float: Seconds until the next tick, zero if it is already due
+        """
+        return max(0.0, self.__deadline() - self._clock())
+
+    async def wait(self) -> List[str]:
+        """
+        Waits for the next tick. The RuuviTags whose ticks were missed are due
+        immediately, and skip their other ticks that were missed as well.
+
+        Returns:
+            List[str]: MACs of the RuuviTags due, in the order of their ticks
+        """
+        deadline = self.__deadline()
+        delay = deadline - self._clock()
+        if delay >= 0:
+            await asyncio.sleep(delay)
+        now = self._clock()
+        popped = []
+        while self._heap and self._heap[0][0] < max(deadline,
+                                                    now) + self.Window:
+            tick, mac = heapq.heappop(self._heap)
+            if self._ticks.get(mac) == tick:
+                popped.append((tick, mac))
+        skipped = 0
+        for tick, mac in popped:
+            interval = self._intervals[mac]
+            # The next tick after this one, or after now if this one is late
+            later = self.__next_tick(interval, max(now, tick + interval / 2))
+            skipped = max(skipped, round((later - tick) / interval) - 1)
+            self.__schedule(mac, later)
+        due = [mac for _, mac in popped]
+        self._last = deadline
+        if due and -delay > self.Tolerance * self._intervals[due[0]]:
+            self.overruns += 1
+            self.skipped += skipped
+            logging.warning(
+                "Cycle overran its deadline by {:.3f}s, skipped {} tick(s) ({} overruns, {} skipped in total)"
+                .format(-delay, skipped, self.overruns, self.skipped))
+        self.ticks += 1
+        return due
+
+    def __deadline(self) -> float:
+        while self._heap and self._ticks.get(
+                self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if self._heap:
+            return self._heap[0][0]
+        # Nothing scheduled, tick at the default interval
+        return self.__next_tick(
+            self._interval, max(self._last,
+                                self._clock() - self._interval / 2))
+
+    def __next_tick(self, interval: float, after: float) -> float:
+        return self._origin + (math.floor(
+            (after - self._origin) / interval) + 1) * interval
+
+    def __schedule(self, mac: str, tick: float) -> None:
+        self._ticks[mac] = tick
+        heapq.heappush(self._heap, (tick, mac))
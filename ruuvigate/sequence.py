@@ -0,0 +1,175 @@
+import logging
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+Reading = Dict[str, Any]
+
+SequenceKey = "measurement_sequence_number"
+# Measurement sequence numbers of data format 5 count from 0 to 65534, those of
+# data format 6 are a single byte
+DefaultModulo = 65535
+Modulos: Dict[Any, int] = {6: 1 << 8}
+# How far behind the latest measurement a late copy can arrive. Anything older is
+# taken for a RuuviTag that restarted counting.
+RepeatWindow = 16
+
+
+def sequence_modulo(reading: Reading) -> int:
+    return Modulos.get(reading.get("data_format"), DefaultModulo)
+
+
+def is_newer(sequence: int, other: int, modulo: int = DefaultModulo) -> bool:
+    """
+    Returns:
+        bool: True if the measurement sequence number follows the other one,
+            allowing for wraparound
+    """
+    return 0 < (sequence - other) % modulo < modulo // 2
+
+
+def is_repeat(sequence: int, latest: int, modulo: int = DefaultModulo) -> bool:
+    """
+    Returns:
+        bool: True if the measurement sequence number is the latest one or arrives
+            late behind it
+    """
+    return (latest - sequence) % modulo < min(RepeatWindow, modulo // 2)
+
+
+class TagSequence:
+    '''
+    Latest measurement sequence number of a RuuviTag and what happened to its most
+    recent advertisements
+    '''
+    __slots__ = ("latest", "events", "received", "lost", "duplicates")
+
+    def __init__(self, window: int):
+        self.latest: Optional[int] = None
+        # (lost, duplicate) per advertisement heard
+        self.events: Deque[Tuple[int, bool]] = deque(maxlen=window)
+        self.received = 0
+        self.lost = 0
+        self.duplicates = 0
+
+    def add(self, lost: int, duplicate: bool) -> None:
+        if len(self.events) == self.events.maxlen:
+            expired_lost, expired_duplicate = self.events[0]
+            self.lost -= expired_lost
+            if expired_duplicate:
+                self.duplicates -= 1
+            else:
+                self.received -= 1
+        self.events.append((lost, duplicate))
+        self.lost += lost
+        if duplicate:
+            self.duplicates += 1
+        else:
+            self.received += 1
+
+    def loss_ratio(self) -> float:
+        expected = self.received + self.lost
+        return self.lost / expected if expected else 0.0
+
+    def duplicate_ratio(self) -> float:
+        heard = self.received + self.duplicates
+        return self.duplicates / heard if heard else 0.0
+
+
+class SequenceTracker:
+    '''
+    Follows the measurement sequence numbers of every RuuviTag to drop repeated
+    advertisements and to keep rolling packet loss and duplicate ratios over the
+    most recent advertisements. Gaps in the sequence count as lost advertisements,
+    wraparound is allowed for and a RuuviTag that restarts counting starts over.
+    '''
+    Window = 100
+    LossKey = "packet_loss"
+    DuplicatesKey = "duplicates"
+
+    def __init__(self, window: int = Window, count_gaps: bool = True):
+        """
+        Args:
+            window (int): Number of the most recent advertisements of a RuuviTag the
+                ratios are kept over
+            count_gaps (bool): Count gaps as lost advertisements. Only meaningful if
+                every advertisement is observed, i.e. not when sampling one per
+                interval.
+        """
+        self._window = window
+        self._count_gaps = count_gaps
+        self._tags: Dict[str, TagSequence] = {}
+
+    def observe(self, mac: str, reading: Reading) -> bool:
+        """
+        Args:
+            mac (str): MAC of the RuuviTag
+            reading (Reading): Reading of the RuuviTag
+
+        Returns:
+            bool: False if the reading repeats a measurement already seen
+        """
+        sequence = reading.get(SequenceKey)
+        if sequence is None:
+            return True
+        tag = self._tags.get(mac)
+        if tag is None:
+            tag = self._tags[mac] = TagSequence(self._window)
+        latest, tag.latest = tag.latest, sequence
+        if latest is None:
+            tag.add(0, False)
+            return True
+        modulo = sequence_modulo(reading)
+        if is_repeat(sequence, latest, modulo):
+            tag.latest = latest
+            tag.add(0, True)
+            return False
+        if is_newer(sequence, latest, modulo):
+            gap = (sequence - latest) % modulo - 1
+            tag.add(gap if self._count_gaps else 0, False)
+        else:
+            logging.info(
+                "RuuviTag {} restarted its measurement sequence at {}".format(
+                    mac, sequence))
+            tag.add(0, False)
+        return True
+
+    def ratios(self, mac: str) -> Dict[str, float]:
+        """
+        Args:
+            mac (str): MAC of the RuuviTag
+
+        Returns:
+            Dict[str, float]: Rolling packet loss and duplicate ratios of the RuuviTag,
+                empty if the RuuviTag hasn't been heard
+        """
+        tag = self._tags.get(mac)
+        if tag is None:
+            return {}
+        return {
+            self.LossKey: round(tag.loss_ratio(), 4),
+            self.DuplicatesKey: round(tag.duplicate_ratio(), 4)
+        }
+
+    def stats(self, mac: str) -> Optional[Dict[str, Any]]:
+        """
+        Args:
+            mac (str): MAC of the RuuviTag
+
+        Returns:
+            Optional[Dict[str, Any]]: The rolling counts and ratios and the latest
+                sequence number of the RuuviTag, None if it hasn't been heard
+        """
+        tag = self._tags.get(mac)
+        if tag is None:
+            return None
+        return {
+            "Sequence": tag.latest,
+            "Received": tag.received,
+            "Lost": tag.lost,
+            "Duplicates": tag.duplicates,
+            "PacketLoss": round(tag.loss_ratio(), 4),
+            "DuplicateRatio": round(tag.duplicate_ratio(), 4)
+        }
+
+    def remove(self, mac: str) -> None:
+        self._tags.pop(mac, None)
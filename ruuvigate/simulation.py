@@ -0,0 +1,126 @@
+import math
+import time
+import random
+from array import array
+from typing import Any, Callable, Dict, List, Optional
+
+Reading = Dict[str, Any]
+
+
+def virtual_macs(count: int) -> List[str]:
+    """
+    Args:
+        count (int): Number of MACs
+
+    Returns:
+        List[str]: Distinct locally administered MACs for virtual RuuviTags
+    """
+    return [
+        "F2:00:{:02X}:{:02X}:{:02X}:{:02X}".format(*i.to_bytes(4, "big"))
+        for i in range(count)
+    ]
+
+
+class Simulator:
+    '''
+    Generates realistic RuuviTag readings for any number of virtual RuuviTags.
+    Temperature follows a diurnal cycle with correlated noise, relative humidity
+    falls as temperature rises, pressure drifts slowly, the battery discharges and
+    sequence numbers increase monotonically. Readings can be dropped to emulate
+    packet loss. The state of each RuuviTag is kept in flat arrays indexed by the
+    order the RuuviTags were first seen, and the same seed yields the same readings.
+    '''
+    Day = 24 * 60 * 60
+    SequenceModulo = 65535
+
+    def __init__(self,
+                 seed: Optional[int] = None,
+                 packet_loss: float = 0.0,
+                 clock: Callable[[], float] = time.time):
+        """
+        Args:
+            seed (int): Seed of the random numbers, random if None
+            packet_loss (float): Probability of a reading being lost
+            clock (Callable): Wall clock driving the diurnal cycle
+        """
+        self._random = random.Random(seed)
+        self._packet_loss = packet_loss
+        self._clock = clock
+        self._index: Dict[str, int] = {}
+        # Constant parameters per RuuviTag
+        self._base_temperature = array("d")
+        self._amplitude = array("d")
+        self._phase = array("d")
+        self._base_humidity = array("d")
+        self._base_rssi = array("d")
+        # Evolving state per RuuviTag
+        self._noise = array("d")
+        self._pressure = array("d")
+        self._battery = array("d")
+        self._sequence = array("L")
+        self._last = array("d")
+
+    def readings(self, macs: List[str]) -> Dict[str, Reading]:
+        """
+        Advances every given RuuviTag to the current time and reads it.
+
+        Args:
+            macs (List[str]): MACs of the virtual RuuviTags
+
+        Returns:
+            Dict[str, Reading]: Readings of the RuuviTags whose packet wasn't lost
+        """
+        now = self._clock()
+        rand = self._random.random
+        gauss = self._random.gauss
+        data = {}
+        for mac in macs:
+            i = self._index.get(mac)
+            if i is None:
+                i = self.__add_tag(mac, now)
+            elapsed = max(0.0, now - self._last[i])
+            self._last[i] = now
+            # Exponentially correlated noise and a random walk of the pressure
+            decay = math.exp(-elapsed / 600)
+            self._noise[i] = self._noise[i] * decay + gauss(
+                0, 0.3 * math.sqrt(1 - decay * decay))
+            self._pressure[i] = min(
+                1060.0,
+                max(950.0,
+                    self._pressure[i] + gauss(0, 0.02 * math.sqrt(elapsed))))
+            self._battery[i] = max(
+                2000.0, self._battery[i] - elapsed * 2e-5 + gauss(0, 0.5))
+            self._sequence[i] = (self._sequence[i] + 1) % self.SequenceModulo
+
+            if rand() < self._packet_loss:
+                continue
+            deviation = self._amplitude[i] * math.sin(
+                2 * math.pi * now / self.Day + self._phase[i]) + self._noise[i]
+            temperature = self._base_temperature[i] + deviation
+            humidity = self._base_humidity[i] - 2.5 * deviation + gauss(0, 0.3)
+            data[mac] = {
+                "data_format": 5,
+                "temperature": round(temperature, 2),
+                "humidity": round(min(100.0, max(0.0, humidity)), 2),
+                "pressure": round(self._pressure[i], 2),
+                "battery": int(self._battery[i]),
+                "measurement_sequence_number": self._sequence[i],
+                "rssi": int(self._base_rssi[i] + gauss(0, 2)),
+                "mac": mac.replace(":", "").lower()
+            }
+        return data
+
+    def __add_tag(self, mac: str, now: float) -> int:
+        uniform = self._random.uniform
+        self._index[mac] = len(self._index)
+        self._base_temperature.append(uniform(-20.0, 25.0))
+        self._amplitude.append(uniform(0.5, 4.0))
+        self._phase.append(uniform(0, 2 * math.pi))
+        self._base_humidity.append(uniform(30.0, 60.0))
+        self._base_rssi.append(uniform(-95.0, -45.0))
+        self._noise.append(0.0)
+        self._pressure.append(uniform(990.0, 1030.0))
+        self._battery.append(uniform(2600.0, 3100.0))
+        self._sequence.append(self._random.randrange(self.SequenceModulo))
+        self._last.append(now)
+        return self._index[mac]
@@ -0,0 +1,110 @@
+import os
+import sys
+import ctypes
+import ctypes.util
+import asyncio
+import logging
+from typing import AsyncIterator, Optional, Tuple
+
+Signature = Optional[Tuple[int, int, int]]
+
+# inotify(7) event masks
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+
+
+class FileWatcher:
+    '''
+    Watches a file for changes, with inotify on Linux and by polling elsewhere or
+    if inotify is unavailable. The directory of the file is watched, so that the
+    file being replaced by a rename is noticed too, and a change is reported only if
+    the modification time, size or inode of the file changed.
+    '''
+    PollInterval = 2.0
+    # Time for a writer to finish a burst of changes before the file is looked at
+    SettleDelay = 0.1
+
+    def __init__(self,
+                 path: str,
+                 poll_interval: float = PollInterval,
+                 use_inotify: bool = True):
+        """
+        Args:
+            path (str): File to watch
+            poll_interval (float): Seconds between the polls when polling
+            use_inotify (bool): Use inotify if available
+        """
+        self._path = os.path.abspath(path)
+        self._poll_interval = poll_interval
+        self._use_inotify = use_inotify and sys.platform.startswith("linux")
+
+    async def changes(self) -> AsyncIterator[None]:
+        """
+        Returns:
+            AsyncIterator[None]: Yields after every change of the file
+        """
+        fd = self.__open_inotify() if self._use_inotify else None
+        if fd is None:
+            logging.info("Polling {} for changes every {}s".format(
+                self._path, self._poll_interval))
+        loop = asyncio.get_running_loop()
+        readable = asyncio.Event()
+        if fd is not None:
+            loop.add_reader(fd, readable.set)
+        signature = self.__signature()
+        try:
+            while True:
+                if fd is not None:
+                    await readable.wait()
+                    await asyncio.sleep(self.SettleDelay)
+                    readable.clear()
+                    self.__drain(fd)
+                else:
+                    await asyncio.sleep(self._poll_interval)
+                current = self.__signature()
+                if current != signature:
+                    signature = current
+                    yield
+        finally:
+            if fd is not None:
+                loop.remove_reader(fd)
+                os.close(fd)
+
+    def __signature(self) -> Signature:
+        try:
+            stat = os.stat(self._path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def __open_inotify(self) -> Optional[int]:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                               use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            mask = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+                    | IN_DELETE)
+            if libc.inotify_add_watch(fd,
+                                      os.path.dirname(self._path).encode(),
+                                      mask) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            return fd
+        except (OSError, AttributeError) as ex:
+            logging.warning("inotify unavailable: {} {}".format(
+                type(ex).__name__, ex.args))
+            return None
+
+    @staticmethod
+    def __drain(fd: int) -> None:
+        # The events only wake the watcher, the file itself is looked at
+        try:
+            while os.read(fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
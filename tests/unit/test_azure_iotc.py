@@ -0,0 +1,278 @@
+from ruuvigate.clients.azure_iotc import AzureIOTC
+from ruuvigate.clients.diskqueue import DiskQueue
+from ruuvigate.batch import MeasurementBatch
+from azure.iot.device import MethodRequest
+import asyncio
+import gzip
+import json
+import pytest
+
+class FakeDeviceClient:
+    def __init__(self):
+        self.online = True
+        self.messages = []
+
+    async def send_message(self, msg):
+        if not self.online:
+            raise ConnectionError("offline")
+        data = msg.data
+        if msg.content_encoding == "gzip":
+            data = gzip.decompress(data)
+        self.messages.append(json.loads(data))
+
+    async def shutdown(self):
+        pass
+
+
+async def eventually(condition, timeout=5.0):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    assert condition()
+
+
+@pytest.mark.asyncio
+async def test_publish_survives_outage(tmp_path):
+    azure = AzureIOTC()
+    azure._client = FakeDeviceClient()
+    azure._queue = DiskQueue(str(tmp_path))
+    azure._options["RUUVIGATE_RETRY_MIN"] = 0.01
+    azure._options["RUUVIGATE_RETRY_MAX"] = 0.02
+    azure._client.online = False
+    await azure.publish_data({"Temperature1": 21.5})
+    await azure.publish_data({"Temperature1": 21.6})
+    await asyncio.sleep(0.1)
+    assert len(azure._queue) == 2
+    assert azure._client.messages == []
+    # Retried without new readings
+    azure._client.online = True
+    await eventually(lambda: len(azure._queue) == 0)
+    assert azure._client.messages == [{"Temperature1": 21.5},
+                                      {"Temperature1": 21.6}]
+    await azure.disconnect()
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compressed", [False, True])
+async def test_publish_batches(tmp_path, compressed):
+    azure = AzureIOTC()
+    azure._client = FakeDeviceClient()
+    azure._queue = DiskQueue(str(tmp_path))
+    azure._options["RUUVIGATE_BATCH_MAX_AGE"] = 3600
+    # Room for three readings per message
+    azure._options["RUUVIGATE_BATCH_MAX_BYTES"] = 240
+    azure._options["RUUVIGATE_BATCH_GZIP"] = compressed
+    for temperature in [21.5, 21.6, 21.7]:
+        await azure.publish_data({"Temperature1": temperature})
+    await asyncio.sleep(0.05)
+    assert azure._client.messages == []
+    await azure.publish_data({"Temperature1": 21.8})
+    await eventually(lambda: azure._client.messages)
+    assert len(azure._queue) == 1
+    assert len(azure._client.messages) == 1
+    assert [reading["Temperature1"] for reading in azure._client.messages[0]] == [21.5, 21.6, 21.7]
+    assert all("Timestamp" in reading for reading in azure._client.messages[0])
+    await azure.disconnect()
+
+@pytest.mark.asyncio
+async def test_publish_batch_on_max_age(tmp_path):
+    azure = AzureIOTC()
+    azure._client = FakeDeviceClient()
+    azure._queue = DiskQueue(str(tmp_path))
+    azure._options["RUUVIGATE_BATCH_MAX_AGE"] = 0.1
+    await azure.publish_data({"Temperature1": 21.5})
+    await azure.publish_data({"Temperature1": 21.6})
+    # Sent when the oldest reading is due, without new readings
+    await eventually(lambda: azure._client.messages)
+    assert [reading["Temperature1"] for reading in azure._client.messages[0]] == [21.5, 21.6]
+    assert len(azure._queue) == 0
+    await azure.disconnect()
+
+@pytest.mark.asyncio
+async def test_publish_batch_is_serialized_once(tmp_path):
+    azure = AzureIOTC()
+    azure._client = FakeDeviceClient()
+    azure._queue = DiskQueue(str(tmp_path))
+    azure._options["RUUVIGATE_BATCH_MAX_AGE"] = 3600
+    azure._options["RUUVIGATE_BATCH_MAX_BYTES"] = 150
+    for temperature in [21.5, None, 21.7]:
+        batch = MeasurementBatch(["temperature"], ["Temperature"])
+        batch.add("12:34:56:78:90:AB", 1, {"temperature": temperature})
+        await azure.publish_batch(batch)
+    await eventually(lambda: azure._client.messages)
+    # Queued as serialized by the batch
+    assert (await azure._queue.peek(1))[0][1] == b'{"Temperature1": 21.7}'
+    assert [{key: value for key, value in reading.items() if key != "Timestamp"}
+            for reading in azure._client.messages[0]] == [{"Temperature1": 21.5}, {}]
+    assert all(list(reading)[0] == "Timestamp" for reading in azure._client.messages[0])
+    await azure.disconnect()
+
+class FakeHubClient:
+    hubs = {}
+    reachable = set()
+
+    @classmethod
+    def create_from_symmetric_key(cls, symmetric_key, hostname, device_id):
+        client = cls()
+        client.hostname = hostname
+        client.device_id = device_id
+        client.sent = []
+        return client
+
+    async def connect(self):
+        if self.hostname not in self.reachable:
+            raise ConnectionError(self.hostname)
+
+    async def shutdown(self):
+        pass
+
+    async def send_message(self, msg):
+        self.sent.append(json.loads(msg.data))
+
+
+class FakeProvisioningClient:
+    registrations = 0
+    assigned_hub = "hub1.azure-devices.net"
+
+    @classmethod
+    def create_from_symmetric_key(cls, **_):
+        return cls()
+
+    async def register(self):
+        FakeProvisioningClient.registrations += 1
+        state = type("State", (), {"assigned_hub": self.assigned_hub, "device_id": "device"})
+        return type("Result", (), {"status": "assigned", "registration_state": state})
+
+
+@pytest.fixture
+def fake_azure(monkeypatch, tmp_path):
+    monkeypatch.setattr("ruuvigate.clients.azure_iotc.IoTHubDeviceClient", FakeHubClient)
+    monkeypatch.setattr("ruuvigate.clients.azure_iotc.ProvisioningDeviceClient", FakeProvisioningClient)
+    FakeProvisioningClient.registrations = 0
+    FakeProvisioningClient.assigned_hub = "hub1.azure-devices.net"
+    FakeHubClient.reachable = {"hub1.azure-devices.net", "hub2.azure-devices.net"}
+    config = tmp_path / "azure.yml"
+    config.write_text("\n".join([
+        "IOTHUB_DEVICE_DPS_ID_SCOPE: scope",
+        "IOTHUB_DEVICE_DPS_DEVICE_ID: device",
+        "IOTHUB_DEVICE_DPS_DEVICE_KEY: key",
+        "IOTHUB_DEVICE_DPS_ENDPOINT: dps",
+        "IOTHUB_DEVICE_DPS_MODEL_ID: model",
+        "RUUVIGATE_QUEUE_DIR: {}".format(tmp_path / "queue"),
+        "RUUVIGATE_PROVISIONING_CACHE: {}".format(tmp_path / "provisioning.json"),
+    ]))
+    return config
+
+
+async def connect(config):
+    azure = AzureIOTC()
+    await azure.connect(str(config))
+    hostname = azure._client.hostname
+    await azure.disconnect()
+    return hostname
+
+
+@pytest.mark.asyncio
+async def test_connect_uses_cached_provisioning(fake_azure):
+    assert await connect(fake_azure) == "hub1.azure-devices.net"
+    assert await connect(fake_azure) == "hub1.azure-devices.net"
+    assert FakeProvisioningClient.registrations == 1
+    # A changed configuration is provisioned again
+    fake_azure.write_text(fake_azure.read_text().replace("model", "model2"))
+    await connect(fake_azure)
+    assert FakeProvisioningClient.registrations == 2
+
+
+@pytest.mark.asyncio
+async def test_connect_provisions_again_if_cached_hub_fails(fake_azure):
+    await connect(fake_azure)
+    FakeHubClient.reachable.discard("hub1.azure-devices.net")
+    FakeProvisioningClient.assigned_hub = "hub2.azure-devices.net"
+    assert await connect(fake_azure) == "hub2.azure-devices.net"
+    assert await connect(fake_azure) == "hub2.azure-devices.net"
+    assert FakeProvisioningClient.registrations == 2
+
+
+@pytest.mark.asyncio
+async def test_connect_sends_queued_messages(fake_azure, tmp_path):
+    queue = DiskQueue(str(tmp_path / "queue"))
+    await queue.put(b'{"Temperature1": 21.5}')
+    queue.close()
+    azure = AzureIOTC()
+    await azure.connect(str(fake_azure))
+    await eventually(lambda: azure._client.sent)
+    assert azure._client.sent == [{"Temperature1": 21.5}]
+    await azure.disconnect()
+
+
+class FakeMethodClient:
+    def __init__(self):
+        self.requests = asyncio.Queue()
+        self.responses = {}
+
+    async def receive_method_request(self):
+        return await self.requests.get()
+
+    async def send_method_response(self, response):
+        self.responses[response.request_id] = (response.status, response.payload)
+
+
+@pytest.mark.asyncio
+async def test_methods_are_dispatched_concurrently():
+    azure = AzureIOTC()
+    azure._client = FakeMethodClient()
+    azure._options["RUUVIGATE_METHOD_TIMEOUT"] = 0.2
+    azure._options["RUUVIGATE_METHOD_CONCURRENCY"] = 3
+
+    async def echo(payload, cookie):
+        await asyncio.sleep(0.05)
+        return {"result": payload != "fail", "data": cookie}
+
+    async def stuck(payload, cookie):
+        await asyncio.sleep(10)
+
+    azure.register_method_handler("Echo", echo, "cookie")
+    azure.register_method_handler("Stuck", stuck)
+    dispatcher = asyncio.create_task(azure.execute_method_dispatcher())
+    for request_id, (name, payload) in enumerate([
+            ("RuuviGate_250*Stuck", None),
+            ("RuuviGate_250*Echo", "ok"),
+            ("Echo", "fail"),
+            ("RuuviGate_250*Unknown", None)]):
+        azure._client.requests.put_nowait(MethodRequest(str(request_id), name, payload))
+    await asyncio.sleep(0.1)
+    # The stuck handler doesn't hold up the others
+    assert azure._client.responses["1"] == (200, {"result": True, "data": "cookie"})
+    assert azure._client.responses["2"] == (400, {"result": False, "data": "cookie"})
+    assert azure._client.responses["3"][0] == 404
+    assert "0" not in azure._client.responses
+    await asyncio.sleep(0.15)
+    assert azure._client.responses["0"][0] == 504
+    dispatcher.cancel()
+    await dispatcher
+
+
+@pytest.mark.asyncio
+async def test_method_concurrency_is_limited():
+    azure = AzureIOTC()
+    azure._client = FakeMethodClient()
+    azure._options["RUUVIGATE_METHOD_CONCURRENCY"] = 2
+    active = []
+    peak = []
+
+    async def slow(payload, cookie):
+        active.append(payload)
+        peak.append(len(active))
+        await asyncio.sleep(0.02)
+        active.remove(payload)
+        return {"result": True, "data": None}
+
+    azure.register_method_handler("Slow", slow)
+    dispatcher = asyncio.create_task(azure.execute_method_dispatcher())
+    for request_id in range(6):
+        azure._client.requests.put_nowait(MethodRequest(str(request_id), "Slow", request_id))
+    await asyncio.sleep(0.2)
+    assert len(azure._client.responses) == 6
+    assert max(peak) == 2
+    dispatcher.cancel()
+    await dispatcher
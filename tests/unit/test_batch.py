@@ -0,0 +1,44 @@
+from ruuvigate.batch import MeasurementBatch
+import json
+import math
+import pytest
+
+KEYS = ("temperature", "humidity", "measurement_sequence_number", "packet_loss")
+COLUMNS = ("Temperature", "Humidity", "Sequence", "PacketLoss")
+
+
+def batch(schema):
+    batch = MeasurementBatch(KEYS, COLUMNS, schema)
+    batch.add("12:34:56:78:90:AB", 2, {"temperature": 21.5, "humidity": None,
+                                       "measurement_sequence_number": 7}, {"packet_loss": 0.25})
+    batch.add("12:34:56:78:90:AC", 1, {"temperature": float("nan"), "rssi": -60})
+    batch.add("12:34:56:78:90:AD", 3, {})
+    return batch
+
+
+def test_slots_schema():
+    slots = batch("slots")
+    assert len(slots) == 3
+    data = slots.to_dict()
+    assert math.isnan(data.pop("Temperature1"))
+    assert data == {"Temperature2": 21.5, "Sequence2": 7, "PacketLoss2": 0.25}
+    assert isinstance(data["Sequence2"], int)
+
+
+@pytest.mark.parametrize("schema", ["slots", "map"])
+def test_json_is_serialized_like_json_dumps(schema):
+    assert batch(schema).to_json() == json.dumps(batch(schema).to_dict()).encode()
+    empty = MeasurementBatch(KEYS, COLUMNS, schema)
+    assert empty.to_json() == json.dumps(empty.to_dict()).encode() == b"{}"
+
+
+def test_map_schema_and_rows():
+    rows = batch("map")
+    assert list(rows.to_dict()["Tags"]) == ["12:34:56:78:90:AB", "12:34:56:78:90:AC", "12:34:56:78:90:AD"]
+    tags = dict(rows.tags_json())
+    assert json.loads(tags["12:34:56:78:90:AB"]) == {"Temperature": 21.5, "Sequence": 7, "PacketLoss": 0.25}
+    assert tags["12:34:56:78:90:AD"] == b"{}"
+    assert [m for m in rows.measurements() if m[0].endswith("AB")] == [
+        ("12:34:56:78:90:AB", "Temperature", 21.5),
+        ("12:34:56:78:90:AB", "Sequence", 7.0),
+        ("12:34:56:78:90:AB", "PacketLoss", 0.25)]
@@ -0,0 +1,59 @@
+from ruuvigate.clients import client
+from ruuvigate.clients.client import FACTORIES, DataPublisherFactory, available_factories, tag_measurements
+from ruuvigate.clients.stdout import StdOut
+from importlib.metadata import EntryPoint
+import subprocess
+import sys
+import pytest
+
+
+def test_stdout_mode_doesnt_import_azure():
+    code = ("import sys\n"
+            "from ruuvigate.__main__ import available_factories\n"
+            "available_factories()['stdout']()\n"
+            "assert 'azure.iot.device' not in sys.modules\n"
+            "assert 'yaml' not in sys.modules\n")
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_factory_creates_publisher():
+    assert isinstance(FACTORIES["stdout"](), StdOut)
+    assert DataPublisherFactory("ruuvigate.clients.stdout:StdOut").load() is StdOut
+
+
+def test_factory_of_missing_publisher_fails_when_used():
+    factory = DataPublisherFactory("ruuvigate.clients.nonexisting:Publisher")
+    with pytest.raises(ImportError):
+        factory()
+    with pytest.raises(AttributeError):
+        DataPublisherFactory("ruuvigate.clients.stdout:Nonexisting")()
+
+
+def test_entry_points_add_publishers(monkeypatch):
+    def entry_points(group):
+        assert group == "ruuvigate.publishers"
+        return [
+            EntryPoint("custom", "ruuvigate.clients.stdout:StdOut", group),
+            EntryPoint("azure", "someplugin.azure:Azure", group),
+        ]
+    monkeypatch.setattr("importlib.metadata.entry_points", entry_points)
+    factories = available_factories()
+    assert isinstance(factories["custom"](), StdOut)
+    # Built-in publishers can't be replaced
+    assert factories["azure"] == FACTORIES["azure"]
+
+
+def test_failing_discovery_keeps_builtin_publishers(monkeypatch):
+    def entry_points(group):
+        raise RuntimeError("broken metadata")
+    monkeypatch.setattr(client, "entry_point_factories", entry_points)
+    assert available_factories() == FACTORIES
+
+
+def test_tag_measurements_of_both_schemas():
+    slot_mac = {1: "12:34:56:78:90:AB", 2: "12:34:56:78:90:AC"}.get
+    slots = {"Temperature1": 21.5, "Humidity1": 40.0, "Temperature2": 5.0, "Temperature3": 0.0, "Other": 1}
+    tags = {"Tags": {"12:34:56:78:90:AB": {"Temperature": 21.5, "Humidity": 40.0},
+                     "12:34:56:78:90:AC": {"Temperature": 5.0}}}
+    assert tag_measurements(slots, slot_mac) == tags["Tags"]
+    assert tag_measurements(tags, slot_mac) == tags["Tags"]
@@ -0,0 +1,67 @@
+from ruuvigate.deadband import DeadbandFilter, Threshold
+import pytest
+
+MAC_VALID1 = "12:34:56:78:90:AB"
+
+class FakeClock:
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+def reading(temperature: float, pressure: float, sequence: int) -> dict:
+    return {
+        "temperature": temperature,
+        "pressure": pressure,
+        "humidity": 40.0,
+        "measurement_sequence_number": sequence
+    }
+
+def test_suppresses_unchanged_values():
+    clock = FakeClock(0.0)
+    deadband = DeadbandFilter({
+        "temperature": Threshold(0.5),
+        "pressure": Threshold(0.01, relative=True)
+    }, heartbeat=600, clock=clock)
+    assert deadband.filter(MAC_VALID1, reading(20.0, 1000.0, 1)) == reading(20.0, 1000.0, 1)
+    clock.now = 60.0
+    # Humidity has no threshold and sequence is always forwarded
+    assert deadband.filter(MAC_VALID1, reading(20.4, 1009.0, 2)) == {
+        "humidity": 40.0, "measurement_sequence_number": 2
+    }
+    clock.now = 120.0
+    # Compared to the last forwarded values, not the last seen ones
+    assert deadband.filter(MAC_VALID1, reading(20.6, 1011.0, 3)) == {
+        "temperature": 20.6, "pressure": 1011.0, "humidity": 40.0,
+        "measurement_sequence_number": 3
+    }
+
+def test_heartbeat_forwards_everything():
+    clock = FakeClock(0.0)
+    deadband = DeadbandFilter({"temperature": Threshold(0.5)}, heartbeat=600, clock=clock)
+    deadband.filter(MAC_VALID1, reading(20.0, 1000.0, 1))
+    clock.now = 599.0
+    assert "temperature" not in deadband.filter(MAC_VALID1, reading(20.0, 1000.0, 2))
+    clock.now = 600.0
+    assert deadband.filter(MAC_VALID1, reading(20.0, 1000.0, 3)) == reading(20.0, 1000.0, 3)
+
+def test_removed_tag_starts_over():
+    clock = FakeClock(0.0)
+    deadband = DeadbandFilter({"temperature": Threshold(0.5)}, heartbeat=600, clock=clock)
+    deadband.filter(MAC_VALID1, reading(20.0, 1000.0, 1))
+    deadband.remove(MAC_VALID1)
+    deadband.remove(MAC_VALID1)
+    clock.now = 60.0
+    assert deadband.filter(MAC_VALID1, reading(20.0, 1000.0, 2)) == reading(20.0, 1000.0, 2)
+
+@pytest.mark.parametrize("spec, parsed", [
+    ("temperature=0.2", ("temperature", Threshold(0.2))),
+    ("Pressure=0.1%", ("pressure", Threshold(0.001, relative=True))),
+    ("battery = 20", ("battery", Threshold(20.0)))
+])
+def test_parse_threshold(spec: str, parsed: tuple):
+    metric, threshold = DeadbandFilter.parse_threshold(spec)
+    assert metric == parsed[0]
+    assert threshold.relative == parsed[1].relative
+    assert threshold.value == pytest.approx(parsed[1].value)
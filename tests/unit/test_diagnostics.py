@@ -0,0 +1,50 @@
+from ruuvigate.diagnostics import Diagnostics
+import subprocess
+import tracemalloc
+import asyncio
+import sys
+import pytest
+
+kept = []
+
+
+async def publish_ruuvi_data():
+    while True:
+        kept.append(bytearray(1000))
+        sum(range(10000))
+        await asyncio.sleep(0.001)
+
+
+def test_idle_diagnostics_import_nothing():
+    code = ("import sys\n"
+            "import ruuvigate.__main__\n"
+            "assert not {'cProfile', 'pstats', 'tracemalloc'} & set(sys.modules)\n")
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+@pytest.mark.asyncio
+async def test_collect():
+    diagnostics = Diagnostics()
+    publisher = asyncio.create_task(publish_ruuvi_data())
+    summary = await diagnostics.collect(0.2, top=3)
+    publisher.cancel()
+    assert summary["Duration"] >= 0.2
+    assert summary["Tasks"] >= 2
+    assert len(summary["Profile"]) == 3
+    assert summary["Coroutines"]["publish_ruuvi_data"]["Resumes"] > 10
+    assert summary["Coroutines"]["publish_ruuvi_data"]["Time"] > 0
+    assert summary["Memory"]["Traced"] >= 1000 * 10
+    assert any(line["Line"].startswith("test_diagnostics.py:") for line in summary["Memory"]["Top"])
+    assert not tracemalloc.is_tracing()
+    assert not diagnostics.running
+
+
+@pytest.mark.asyncio
+async def test_one_collection_at_a_time():
+    diagnostics = Diagnostics()
+    first = asyncio.create_task(diagnostics.collect(0.1))
+    await asyncio.sleep(0)
+    assert diagnostics.running
+    with pytest.raises(RuntimeError):
+        await diagnostics.collect(0.1)
+    await first
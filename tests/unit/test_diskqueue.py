@@ -0,0 +1,100 @@
+from ruuvigate.clients.diskqueue import DiskQueue
+import os
+import threading
+import pytest
+
+PAYLOADS = [b'{"Temperature1": 21.5}', b'{"Temperature1": 21.6}', b'{"Temperature1": 21.7}']
+
+@pytest.mark.asyncio
+async def test_fifo_and_ack(tmp_path):
+    queue = DiskQueue(str(tmp_path))
+    for payload in PAYLOADS:
+        await queue.put(payload)
+    assert len(queue) == 3
+    items = await queue.peek(2)
+    assert [payload for _, payload, _ in items] == PAYLOADS[:2]
+    await queue.ack(items[-1][2])
+    assert [payload for _, payload, _ in await queue.peek(10)] == PAYLOADS[2:]
+    assert queue.stats()["depth"] == 1
+    await queue.ack((await queue.peek(1))[-1][2])
+    assert len(queue) == 0
+    assert queue.stats()["oldest_age"] == 0.0
+
+@pytest.mark.asyncio
+async def test_survives_reopen(tmp_path):
+    queue = DiskQueue(str(tmp_path))
+    for payload in PAYLOADS:
+        await queue.put(payload)
+    await queue.ack((await queue.peek(1))[-1][2])
+    queue.close()
+    queue = DiskQueue(str(tmp_path))
+    assert [payload for _, payload, _ in await queue.peek(10)] == PAYLOADS[1:]
+    await queue.put(b"new")
+    assert [payload for _, payload, _ in await queue.peek(10)] == PAYLOADS[1:] + [b"new"]
+
+@pytest.mark.asyncio
+async def test_truncates_torn_write(tmp_path):
+    queue = DiskQueue(str(tmp_path))
+    for payload in PAYLOADS:
+        await queue.put(payload)
+    queue.close()
+    segment = os.path.join(str(tmp_path), "00000000.seg")
+    os.truncate(segment, os.path.getsize(segment) - 3)
+    queue = DiskQueue(str(tmp_path))
+    assert [payload for _, payload, _ in await queue.peek(10)] == PAYLOADS[:2]
+    await queue.put(PAYLOADS[2])
+    queue.close()
+    queue = DiskQueue(str(tmp_path))
+    assert [payload for _, payload, _ in await queue.peek(10)] == PAYLOADS
+
+@pytest.mark.asyncio
+async def test_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(DiskQueue, "SegmentBytes", 100)
+    queue = DiskQueue(str(tmp_path), max_bytes=250)
+    for i in range(20):
+        await queue.put(b"%02d" % i + b"x" * 30)
+    assert queue.stats()["bytes"] <= 250
+    payloads = [payload for _, payload, _ in await queue.peek(20)]
+    # Oldest payloads were dropped, the newest kept in order
+    assert payloads[-1].startswith(b"19")
+    assert payloads == sorted(payloads)
+    assert len(os.listdir(str(tmp_path))) <= 5
+
+@pytest.mark.asyncio
+async def test_syncs_off_the_event_loop(tmp_path, monkeypatch):
+    threads = []
+    monkeypatch.setattr(os, "fsync", lambda fd: threads.append(threading.current_thread()))
+    queue = DiskQueue(str(tmp_path))
+    await queue.put(PAYLOADS[0])
+    await queue.ack((await queue.peek(1))[-1][2])
+    assert len(threads) == 2
+    assert threading.main_thread() not in threads
+
+@pytest.mark.asyncio
+async def test_drops_off_the_event_loop(tmp_path, monkeypatch):
+    monkeypatch.setattr(DiskQueue, "SegmentBytes", 100)
+    threads = []
+    remove = os.remove
+    def record(path):
+        threads.append(threading.current_thread())
+        remove(path)
+    monkeypatch.setattr(os, "remove", record)
+    queue = DiskQueue(str(tmp_path), max_bytes=150)
+    for i in range(4):
+        await queue.put(b"%02d" % i + b"x" * 30)
+    assert threads
+    assert threading.main_thread() not in threads
+
+@pytest.mark.asyncio
+async def test_drop_during_send_keeps_unsent(tmp_path, monkeypatch):
+    monkeypatch.setattr(DiskQueue, "SegmentBytes", 100)
+    queue = DiskQueue(str(tmp_path), max_bytes=300)
+    # Two payloads per segment
+    for i in range(6):
+        await queue.put(b"%02d" % i + b"x" * 30)
+    sending = await queue.peek(1)
+    # Exceeds the bound and drops the segment being sent
+    await queue.put(b"06" + b"x" * 30)
+    await queue.ack(sending[-1][2])
+    payloads = [payload[:2] for _, payload, _ in await queue.peek(10)]
+    assert payloads == [b"02", b"03", b"04", b"05", b"06"]
@@ -0,0 +1,89 @@
+from ruuvigate.clients.fanout import FanOut
+from ruuvigate.batch import MeasurementBatch
+import asyncio
+import pytest
+
+
+class RecordingPublisher:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.published = []
+        self.methods = []
+
+    async def connect(self, config):
+        pass
+
+    def register_method_handler(self, method_name, handler, cookie=None):
+        self.methods.append(method_name)
+
+    async def execute_method_dispatcher(self):
+        pass
+
+    async def buffer_data(self, data):
+        pass
+
+    async def publish_data(self, data={}):
+        await asyncio.sleep(self.delay)
+        self.published.append(dict(data))
+
+
+@pytest.mark.asyncio
+async def test_slow_sink_doesnt_delay_others():
+    fast, slow = RecordingPublisher(), RecordingPublisher(delay=10)
+    fanout = FanOut({"fast": fast, "slow": slow})
+    await fanout.connect(None)
+    fanout.register_method_handler("GetRuuviTags", None)
+    await fanout.buffer_data({"Temperature1": 21.5})
+    await asyncio.wait_for(fanout.publish_data({"Humidity1": 40.0}), 0.1)
+    await asyncio.sleep(0.01)
+    assert fast.published == [{"Temperature1": 21.5, "Humidity1": 40.0}]
+    assert slow.published == []
+    assert fast.methods == slow.methods == ["GetRuuviTags"]
+    await fanout.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_full_queue_drops_oldest():
+    publisher = RecordingPublisher(delay=10)
+    fanout = FanOut({"sink": publisher}, maxsize=2)
+    for i in range(5):
+        await fanout.publish_data({"Sequence1": i})
+    sink = fanout.sinks[0]
+    assert sink.dropped == 3
+    assert [sink.queue.get_nowait()[1] for _ in range(2)] == [{"Sequence1": 3}, {"Sequence1": 4}]
+
+
+@pytest.mark.asyncio
+async def test_full_queue_blocks():
+    publisher = RecordingPublisher(delay=0.02)
+    fanout = FanOut({"sink": publisher}, maxsize=1, policies={"sink": "block"})
+    await fanout.connect(None)
+    for i in range(3):
+        await fanout.publish_data({"Sequence1": i})
+    await fanout.join()
+    assert publisher.published == [{"Sequence1": i} for i in range(3)]
+    await fanout.disconnect()
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        FanOut({"sink": RecordingPublisher()}, policies={"sink": "wait"})
+
+
+class BatchPublisher(RecordingPublisher):
+    async def publish_batch(self, batch):
+        self.published.append(batch.to_json())
+
+
+@pytest.mark.asyncio
+async def test_batches_are_serialized_by_sinks():
+    data, batches = RecordingPublisher(), BatchPublisher()
+    fanout = FanOut({"data": data, "batches": batches})
+    await fanout.connect(None)
+    batch = MeasurementBatch(["temperature"], ["Temperature"])
+    batch.add("12:34:56:78:90:AB", 1, {"temperature": 21.5})
+    await fanout.publish_batch(batch)
+    await fanout.join()
+    assert data.published == [{"Temperature1": 21.5}]
+    assert batches.published == [b'{"Temperature1": 21.5}']
+    await fanout.disconnect()
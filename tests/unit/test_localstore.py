@@ -0,0 +1,81 @@
+from ruuvigate.clients.localstore import LocalStore
+from ruuvigate.batch import MeasurementBatch
+import sqlite3
+import pytest
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+async def connected_store(tmp_path, clock):
+    config = tmp_path / "config.yml"
+    config.write_text("RUUVIGATE_HISTORY_FILE: {}\n".format(tmp_path / "history.sqlite"))
+    store = LocalStore(clock)
+    store.slot_mac = {1: "12:34:56:78:90:AB", 2: "12:34:56:78:90:AC"}.get
+    await store.connect(str(config))
+    return store
+
+
+@pytest.mark.asyncio
+async def test_history_is_downsampled(tmp_path):
+    clock = Clock(1000.0)
+    store = await connected_store(tmp_path, clock)
+    for i in range(10):
+        clock.now = 1000.0 + i * 10
+        await store.buffer_data({"Temperature1": 20.0 + i, "Temperature2": 5.0})
+        await store.publish_data({"Humidity1": 40.0, "Temperature3": 1.0})
+    history = await store.history("12:34:56:78:90:AB", 1000.0, 1100.0, points=2)
+    assert history["Bucket"] == 50.0
+    assert history["Series"]["Temperature"] == [[1000.0, 22.0, 20.0, 24.0],
+                                                [1050.0, 27.0, 25.0, 29.0]]
+    assert history["Series"]["Humidity"] == [[1000.0, 40.0, 40.0, 40.0],
+                                             [1050.0, 40.0, 40.0, 40.0]]
+    history = await store.history("12:34:56:78:90:AC", 1000.0, 1100.0, metrics=["Humidity"])
+    assert history["Series"] == {}
+    await store.disconnect()
+    db = sqlite3.connect(str(tmp_path / "history.sqlite"))
+    assert db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert db.execute("SELECT COUNT(*) FROM readings").fetchone()[0] == 30
+
+
+@pytest.mark.asyncio
+async def test_stores_measurements_keyed_by_mac(tmp_path):
+    clock = Clock(1000.0)
+    store = await connected_store(tmp_path, clock)
+    await store.publish_data({"Tags": {"12:34:56:78:90:FF": {"Temperature": 20.0, "Sequence": None}}})
+    batch = MeasurementBatch(["temperature", "humidity"], ["Temperature", "Humidity"])
+    batch.add("12:34:56:78:90:FF", 9, {"temperature": 22.0})
+    await store.publish_batch(batch)
+    history = await store.history("12:34:56:78:90:FF", 1000.0, 1100.0, points=1)
+    assert history["Series"] == {"Temperature": [[1000.0, 21.0, 20.0, 22.0]]}
+    await store.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_inserts_are_batched(tmp_path):
+    store = await connected_store(tmp_path, Clock(1000.0))
+    await store.publish_data({"Temperature1": 20.0})
+    await store.publish_data({"Temperature1": 21.0})
+    db = sqlite3.connect(str(tmp_path / "history.sqlite"))
+    assert db.execute("SELECT COUNT(*) FROM readings").fetchone()[0] == 0
+    await store.disconnect()
+    assert db.execute("SELECT COUNT(*) FROM readings").fetchone()[0] == 2
+
+
+@pytest.mark.asyncio
+async def test_expired_measurements_are_compacted(tmp_path):
+    clock = Clock(1000.0)
+    store = await connected_store(tmp_path, clock)
+    await store.publish_data({"Temperature1": 20.0})
+    clock.now += 31 * 86400
+    await store.publish_data({"Temperature1": 21.0})
+    await store.flush()
+    assert await store.compact() == 1
+    history = await store.history("12:34:56:78:90:AB", 0, clock.now + 1, points=1)
+    assert history["Series"]["Temperature"][0][1:] == [21.0, 21.0, 21.0]
+    await store.disconnect()
@@ -0,0 +1,47 @@
+from ruuvigate.metrics import Counter, Gauge, Histogram, Registry, serve_metrics
+import ruuvigate.metrics
+import asyncio
+import pytest
+
+def test_exposition():
+    registry = Registry()
+    counter = Counter("requests_total", "Requests", ["method"], registry=registry)
+    gauge = Gauge("depth", "Depth", registry=registry)
+    histogram = Histogram("latency_seconds", "Latency", buckets=(0.1, 1.0), registry=registry)
+    counter.inc("GetRuuviTags")
+    counter.inc("GetRuuviTags")
+    counter.inc('Add"Tag')
+    gauge.set(3)
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    lines = registry.exposition().splitlines()
+    assert "# TYPE requests_total counter" in lines
+    assert 'requests_total{method="GetRuuviTags"} 2.0' in lines
+    assert 'requests_total{method="Add\\"Tag"} 1.0' in lines
+    assert "depth 3.0" in lines
+    assert 'latency_seconds_bucket{le="0.1"} 1.0' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 2.0' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 3.0' in lines
+    assert "latency_seconds_sum 5.55" in lines
+    assert "latency_seconds_count 3.0" in lines
+
+def test_function_values():
+    registry = Registry()
+    gauge = Gauge("age_seconds", "Age", ["mac"], registry=registry)
+    gauge.set_function(lambda: {("12:34:56:78:90:AB", ): 4.0})
+    assert 'age_seconds{mac="12:34:56:78:90:AB"} 4.0' in registry.exposition().splitlines()
+
+@pytest.mark.asyncio
+async def test_serve_metrics():
+    ruuvigate.metrics.TAGS_CONFIGURED.set(5)
+    server = asyncio.create_task(serve_metrics("127.0.0.1", 18965))
+    await asyncio.sleep(0.1)
+    reader, writer = await asyncio.open_connection("127.0.0.1", 18965)
+    writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    response = (await reader.read()).decode()
+    writer.close()
+    server.cancel()
+    await server
+    assert response.startswith("HTTP/1.1 200 OK")
+    assert "ruuvigate_tags_configured 5.0" in response.splitlines()
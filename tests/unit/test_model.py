@@ -0,0 +1,38 @@
+from ruuvigate.model import COMMANDS_PATH, MEASUREMENTS, device_model, main
+from ruuvigate.__main__ import RuuviTags
+import json
+import os
+import pytest
+
+
+def test_measurements_match_telemetry():
+    assert tuple(name for name, *_ in MEASUREMENTS) == RuuviTags.Telemetry
+
+
+def test_slots_model():
+    interface, = device_model("slots", slots=20)
+    names = [content["name"] for content in interface["contents"]]
+    assert len(names) == 20 * (len(RuuviTags.Telemetry) + 1) + 1
+    assert "Temperature20" in names and "MAC20" in names
+    assert "PacketLoss20" in names and "Duplicates20" in names
+    assert len(set(content["@id"] for content in interface["contents"])) == len(names)
+
+
+def test_map_model():
+    commands = {"@id": "dtmi:ruuvimonitor:RuuviGate_250;1"}
+    interface, included = device_model("map", commands=commands)
+    tags, component = interface["contents"]
+    assert included == commands
+    assert component["schema"] == commands["@id"]
+    assert tags["name"] == "Tags"
+    fields = tags["schema"]["mapValue"]["schema"]["fields"]
+    assert [field["name"] for field in fields] == list(RuuviTags.Telemetry)
+    with pytest.raises(ValueError):
+        device_model("columns")
+
+
+@pytest.mark.parametrize("schema, model", [("map", "RuuviGateMap.json"), ("slots", "RuuviGate.json")])
+def test_generated_model_is_current(tmp_path, schema, model):
+    main(["--schema", schema, "-o", str(tmp_path / "model.json")])
+    committed = os.path.join(os.path.dirname(COMMANDS_PATH), model)
+    assert json.loads((tmp_path / "model.json").read_text()) == json.loads(open(committed).read())
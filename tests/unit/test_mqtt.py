@@ -0,0 +1,266 @@
+from ruuvigate.clients.mqtt import MqttPublisher
+from ruuvigate.batch import MeasurementBatch
+import asyncio
+import struct
+import json
+import pytest
+import pytest_asyncio
+
+
+class MiniBroker:
+    '''
+    Just enough of an MQTT 3.1.1 broker: connects, subscriptions, QoS 0 delivery to
+    subscribers and QoS 1 acknowledgements that can be held back
+    '''
+
+    def __init__(self):
+        self.published = []
+        self.acking = True
+        self.held = []
+        self.sessions = {}
+        self.connects = []
+        self.writers = []
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.drop_connections()
+        self.server.close()
+        await self.server.wait_closed()
+
+    def drop_connections(self):
+        for writer in self.writers:
+            writer.close()
+        self.writers = []
+
+    def release_acks(self):
+        self.acking = True
+        for writer, packet_id in self.held:
+            if not writer.is_closing():
+                writer.write(bytes([0x40, 2]) + struct.pack(">H", packet_id))
+        self.held = []
+
+    def deliver(self, topic, payload):
+        packet = self.packet(0x30, self.string(topic) + payload)
+        for writer, subscriptions in list(self.sessions.values()):
+            if not writer.is_closing() and any(self.matches(f, topic) for f in subscriptions):
+                writer.write(packet)
+
+    @staticmethod
+    def matches(topic_filter, topic):
+        filters, levels = topic_filter.split("/"), topic.split("/")
+        if len(filters) != len(levels):
+            return False
+        return all(f in ("+", level) for f, level in zip(filters, levels))
+
+    @staticmethod
+    def string(value):
+        return struct.pack(">H", len(value)) + value.encode()
+
+    @staticmethod
+    def packet(header, body):
+        length, remaining = b"", len(body)
+        while True:
+            byte, remaining = remaining % 128, remaining // 128
+            length += bytes([byte | (0x80 if remaining else 0)])
+            if not remaining:
+                return bytes([header]) + length + body
+
+    async def serve(self, reader, writer):
+        self.writers.append(writer)
+        client_id = None
+        try:
+            while True:
+                header = (await reader.readexactly(1))[0]
+                length, shift = 0, 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length)
+                kind = header >> 4
+                if kind == 1:
+                    name_length = struct.unpack(">H", body[:2])[0]
+                    flags = body[2 + name_length + 1]
+                    id_length = struct.unpack(">H", body[2 + name_length + 4:2 + name_length + 6])[0]
+                    start = 2 + name_length + 6
+                    client_id = body[start:start + id_length].decode()
+                    clean = bool(flags & 0x02)
+                    present = client_id in self.sessions and not clean
+                    subscriptions = self.sessions[client_id][1] if present else set()
+                    self.sessions[client_id] = (writer, subscriptions)
+                    self.connects.append((client_id, clean))
+                    writer.write(bytes([0x20, 2, int(present), 0]))
+                elif kind == 3:
+                    qos = (header >> 1) & 0x03
+                    topic_length = struct.unpack(">H", body[:2])[0]
+                    topic = body[2:2 + topic_length].decode()
+                    offset = 2 + topic_length
+                    if qos:
+                        packet_id = struct.unpack(">H", body[offset:offset + 2])[0]
+                        offset += 2
+                    payload = body[offset:]
+                    if qos and not self.acking:
+                        self.held.append((writer, packet_id))
+                        self.published.append((topic, payload))
+                        continue
+                    self.published.append((topic, payload))
+                    if qos:
+                        writer.write(bytes([0x40, 2]) + struct.pack(">H", packet_id))
+                elif kind == 8:
+                    packet_id = body[:2]
+                    offset, granted = 2, b""
+                    while offset < len(body):
+                        topic_length = struct.unpack(">H", body[offset:offset + 2])[0]
+                        topic = body[offset + 2:offset + 2 + topic_length].decode()
+                        self.sessions[client_id][1].add(topic)
+                        granted += bytes([body[offset + 2 + topic_length]])
+                        offset += 3 + topic_length
+                    writer.write(self.packet(0x90, packet_id + granted))
+                elif kind == 12:
+                    writer.write(bytes([0xD0, 0]))
+                elif kind == 14:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def telemetry(broker, topic):
+    return [json.loads(payload) for t, payload in broker.published if t == topic]
+
+
+async def eventually(condition, timeout=5.0):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    assert condition()
+
+
+@pytest_asyncio.fixture
+async def broker():
+    broker = MiniBroker()
+    await broker.start()
+    yield broker
+    await broker.stop()
+
+
+async def connected_publisher(broker, tmp_path, **options):
+    config = tmp_path / "mqtt.yml"
+    config.write_text("\n".join("{}: {}".format(key, json.dumps(value)) for key, value in {
+        "MQTT_HOST": "127.0.0.1",
+        "MQTT_PORT": broker.port,
+        "MQTT_CLIENT_ID": "gateway",
+        "MQTT_RECONNECT_MIN": 0.1,
+        "MQTT_RECONNECT_MAX": 0.2,
+        **options
+    }.items()))
+    publisher = MqttPublisher()
+    publisher.slot_mac = {1: "12:34:56:78:90:AB", 2: "12:34:56:78:90:AC"}.get
+    await publisher.connect(str(config))
+    await eventually(lambda: any(topic.endswith("/status") for topic, _ in broker.published))
+    return publisher
+
+
+@pytest.mark.asyncio
+async def test_publishes_telemetry(broker, tmp_path):
+    publisher = await connected_publisher(broker, tmp_path)
+    await publisher.buffer_data({"Temperature1": 21.5})
+    await publisher.publish_data({"Temperature2": 22.5})
+    await eventually(lambda: telemetry(broker, "gateway/telemetry"))
+    assert telemetry(broker, "gateway/telemetry") == [{"Temperature1": 21.5, "Temperature2": 22.5}]
+    await eventually(lambda: publisher.unacked == 0)
+    assert ("gateway", False) in broker.connects
+    await publisher.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_publishes_per_tag_topics(broker, tmp_path):
+    publisher = await connected_publisher(broker, tmp_path, MQTT_PER_TAG_TOPICS=True, MQTT_TOPIC_PREFIX="site")
+    await publisher.publish_data({"Temperature1": 21.5, "Humidity1": 40.0, "Temperature2": 22.5, "Temperature3": 0.0})
+    await eventually(lambda: telemetry(broker, "site/tags/1234567890AC"))
+    assert telemetry(broker, "site/tags/1234567890AB") == [{"Temperature": 21.5, "Humidity": 40.0}]
+    assert telemetry(broker, "site/tags/1234567890AC") == [{"Temperature": 22.5}]
+    await publisher.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_publishes_batches(broker, tmp_path):
+    publisher = await connected_publisher(broker, tmp_path, MQTT_PER_TAG_TOPICS=True)
+    batch = MeasurementBatch(["temperature", "humidity"], ["Temperature", "Humidity"])
+    batch.add("12:34:56:78:90:AB", 1, {"temperature": 21.5, "humidity": 40.0})
+    batch.add("12:34:56:78:90:AC", 2, {"temperature": 22.5})
+    await publisher.publish_batch(batch)
+    await eventually(lambda: telemetry(broker, "gateway/tags/1234567890AC"))
+    assert telemetry(broker, "gateway/tags/1234567890AB") == [{"Temperature": 21.5, "Humidity": 40.0}]
+    assert telemetry(broker, "gateway/tags/1234567890AC") == [{"Temperature": 22.5}]
+    await publisher.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_inflight_window(broker, tmp_path):
+    publisher = await connected_publisher(broker, tmp_path, MQTT_INFLIGHT=5)
+    broker.acking = False
+    for i in range(20):
+        await publisher.publish_data({"Sequence1": i})
+    await eventually(lambda: len(telemetry(broker, "gateway/telemetry")) == 5)
+    await asyncio.sleep(0.1)
+    # Nothing beyond the window is sent before acknowledgements
+    assert len(telemetry(broker, "gateway/telemetry")) == 5
+    assert publisher.unacked == 20
+    broker.release_acks()
+    await eventually(lambda: publisher.unacked == 0)
+    assert [m["Sequence1"] for m in telemetry(broker, "gateway/telemetry")] == list(range(20))
+    await publisher.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_unacknowledged_publishes_are_resent_after_reconnect(broker, tmp_path):
+    publisher = await connected_publisher(broker, tmp_path)
+    broker.acking = False
+    await publisher.publish_data({"Sequence1": 1})
+    await eventually(lambda: telemetry(broker, "gateway/telemetry"))
+    broker.held = []
+    broker.acking = True
+    broker.drop_connections()
+    await eventually(lambda: publisher.unacked == 0)
+    assert len(broker.connects) == 2
+    assert telemetry(broker, "gateway/telemetry") == [{"Sequence1": 1}, {"Sequence1": 1}]
+    await publisher.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_command_topics(broker, tmp_path):
+    publisher = await connected_publisher(broker, tmp_path)
+
+    async def get_ruuvitags(payload, cookie):
+        return {"result": True, "data": cookie}
+
+    publisher.register_method_handler("GetRuuviTags", get_ruuvitags, ["12:34:56:78:90:AB"])
+    dispatcher = asyncio.create_task(publisher.execute_method_dispatcher())
+    await eventually(lambda: broker.sessions["gateway"][1])
+    broker.deliver("gateway/commands/GetRuuviTags", b"")
+    broker.deliver("gateway/commands/Unknown", b'"12:34:56:78:90:AB"')
+    await eventually(lambda: len(telemetry(broker, "gateway/responses/Unknown")) == 1)
+    assert telemetry(broker, "gateway/responses/GetRuuviTags") == [
+        {"status": 200, "result": True, "data": ["12:34:56:78:90:AB"]}]
+    assert telemetry(broker, "gateway/responses/Unknown")[0]["status"] == 404
+    dispatcher.cancel()
+    await dispatcher
+    await publisher.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_unreachable_broker(tmp_path):
+    broker = MiniBroker()
+    await broker.start()
+    await broker.stop()
+    with pytest.raises(ConnectionError):
+        await connected_publisher(broker, tmp_path, MQTT_CONNECT_TIMEOUT=0.3)
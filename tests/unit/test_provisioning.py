@@ -0,0 +1,30 @@
+from ruuvigate.clients.provisioning import ProvisioningCache
+import os
+
+
+def test_cache_is_keyed_by_configuration(tmp_path):
+    path = str(tmp_path / "cache" / "provisioning.json")
+    params = ["SCOPE", "ID"]
+    key = ProvisioningCache.key({"SCOPE": "a", "ID": "b", "OTHER": 1}, params)
+    assert key == ProvisioningCache.key({"ID": "b", "SCOPE": "a", "OTHER": 2}, params)
+    cache = ProvisioningCache(path)
+    assert cache.load(key) is None
+    cache.store(key, "hub.azure-devices.net", "device")
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert cache.load(key) == ("hub.azure-devices.net", "device")
+    assert cache.load(ProvisioningCache.key({"SCOPE": "c", "ID": "b"}, params)) is None
+    cache.clear()
+    assert cache.load(key) is None
+
+
+def test_unreadable_cache_is_ignored(tmp_path):
+    path = tmp_path / "provisioning.json"
+    path.write_text("{not json")
+    assert ProvisioningCache(str(path)).load("key") is None
+
+
+def test_disabled_cache_stores_nothing(tmp_path):
+    cache = ProvisioningCache("")
+    cache.store("key", "hub", "device")
+    assert cache.load("key") is None
+    assert os.listdir(tmp_path) == []
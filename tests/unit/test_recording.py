@@ -0,0 +1,108 @@
+from ruuvigate.recording import (AdvertisementRecorder, decode, decoded_advertisements,
+                                 read_recording, replayed_advertisements)
+from ruuvigate.scanner import RuuviScanner
+import functools
+import asyncio
+import pytest
+
+MAC_VALID1 = "12:34:56:78:90:AB"
+MAC_VALID2 = "CB:B8:33:4C:88:4F"
+# Data format 5 as formatted by the Bleak adapter, followed by the RSSI
+RAW_DF5 = "1C1BFF99040512FC5394C37C0004FFFC040CAC364200CDCBB8334C884FC4"
+
+
+class FakeClock:
+
+    def __init__(self, now: float = 100.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def record(path, advertisements, clock=None):
+    recorder = AdvertisementRecorder(str(path), clock or FakeClock())
+    for mac, raw in advertisements:
+        recorder.write(mac, raw)
+    recorder.close()
+
+
+def test_decode():
+    mac, reading = decode(MAC_VALID1, RAW_DF5)
+    assert mac == MAC_VALID1
+    assert reading["temperature"] == 24.3
+    assert reading["measurement_sequence_number"] == 205
+    assert reading["rssi"] == -60
+
+def test_decode_mac_from_payload():
+    assert decode("", RAW_DF5)[0] == MAC_VALID2
+
+def test_decode_not_ruuvitag():
+    assert decode(MAC_VALID1, "0201061AFF4C000215") is None
+
+def test_recording_round_trip(tmp_path):
+    clock = FakeClock()
+    recorder = AdvertisementRecorder(str(tmp_path / "log"), clock)
+    recorder.write(MAC_VALID1, RAW_DF5)
+    clock.now += 1.5
+    recorder.write("", RAW_DF5.lower())
+    recorder.write(MAC_VALID1, "not hex")
+    assert recorder.records == 2
+    recorder.close()
+    assert list(read_recording(str(tmp_path / "log"))) == [
+        (100.0, MAC_VALID1, RAW_DF5),
+        (101.5, "", RAW_DF5)
+    ]
+
+def test_recording_appends(tmp_path):
+    record(tmp_path / "log", [(MAC_VALID1, RAW_DF5)])
+    record(tmp_path / "log", [(MAC_VALID2, RAW_DF5)])
+    assert [mac for _, mac, _ in read_recording(str(tmp_path / "log"))] == [MAC_VALID1, MAC_VALID2]
+
+def test_recording_ignores_torn_tail(tmp_path):
+    record(tmp_path / "log", [(MAC_VALID1, RAW_DF5), (MAC_VALID2, RAW_DF5)])
+    with open(tmp_path / "log", "r+b") as stream:
+        stream.truncate(stream.seek(0, 2) - 3)
+    assert [mac for _, mac, _ in read_recording(str(tmp_path / "log"))] == [MAC_VALID1]
+
+def test_recording_rejects_other_files(tmp_path):
+    (tmp_path / "log").write_text("FF:FF:FF:FF:FF:FF\n")
+    with pytest.raises(ValueError):
+        AdvertisementRecorder(str(tmp_path / "log"))
+    with pytest.raises(ValueError):
+        list(read_recording(str(tmp_path / "log")))
+
+@pytest.mark.asyncio
+async def test_replay_compresses_time(tmp_path):
+    clock = FakeClock()
+    recorder = AdvertisementRecorder(str(tmp_path / "log"), clock)
+    for _ in range(3):
+        recorder.write(MAC_VALID1, RAW_DF5)
+        clock.now += 10.0
+    recorder.close()
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    replayed = [mac async for mac, _ in replayed_advertisements(str(tmp_path / "log"), 200.0)]
+    assert replayed == [MAC_VALID1] * 3
+    assert 0.09 <= loop.time() - start < 0.5
+
+@pytest.mark.asyncio
+async def test_replay_through_scanner(tmp_path):
+    record(tmp_path / "log", [(MAC_VALID1, RAW_DF5), (MAC_VALID2, RAW_DF5)])
+    replayed = functools.partial(replayed_advertisements, str(tmp_path / "log"))
+    scanner = RuuviScanner(functools.partial(decoded_advertisements, replayed), restart=False)
+    assert await scanner.run()
+    snapshot = scanner.snapshot([MAC_VALID1, MAC_VALID2])
+    assert snapshot[MAC_VALID1]["temperature"] == 24.3
+    assert snapshot[MAC_VALID2]["humidity"] == 53.49
+
+@pytest.mark.asyncio
+async def test_decoded_advertisements_records(tmp_path):
+    async def source():
+        yield MAC_VALID1, RAW_DF5
+        yield MAC_VALID2, "0201061AFF4C000215"
+    recorder = AdvertisementRecorder(str(tmp_path / "log"), FakeClock())
+    decoded = [mac async for mac, _ in decoded_advertisements(source, recorder)]
+    recorder.close()
+    assert decoded == [MAC_VALID1]
+    assert [mac for _, mac, _ in read_recording(str(tmp_path / "log"))] == [MAC_VALID1, MAC_VALID2]
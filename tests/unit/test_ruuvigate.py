@@ -1,4 +1,6 @@
 import ruuvigate
+import argparse
+import asyncio
 import pytest
 import os
 
@@ -31,7 +33,21 @@ if os.path.exists(TAGS_NONEXISTING_PATH):
     ['-c', THIS_FILE_PATH, '-i', '4'],
     ['-c', THIS_FILE_PATH, '-i', '3', '-l', 'WARNING'],
     ['-c', THIS_FILE_PATH, '-i', '2', '-l', 'WARNING'],
-    ['-c', THIS_FILE_PATH, '-i', '1', '-l', 'WARNING', '--simulate']
+    ['-c', THIS_FILE_PATH, '-i', '1', '-l', 'WARNING', '--simulate'],
+    # deadbands
+    ['-m', 'stdout', '--deadband', 'temperature=0.2'],
+    ['-m', 'stdout', '--deadband', 'temperature=0.2', '--deadband', 'pressure=0.1%', '--heartbeat', '60'],
+    # recording
+    ['-m', 'stdout', '--continuous', '--record', TAGS_NONEXISTING_PATH],
+    ['-m', 'stdout', '--continuous', '--replay', TAGS_EMPTY_PATH, '--speed', '60'],
+    ['-m', 'stdout', '--continuous', '--sequence-stats'],
+    # several modes
+    ['-m', 'azure', 'stdout', '-c', THIS_FILE_PATH],
+    ['-m', 'stdout', 'sqlite'],
+    ['-m', 'azure', 'stdout', '-c', THIS_FILE_PATH, '--sink-queue', '10', '--sink-policy', 'stdout=block'],
+    # telemetry schemas
+    ['-m', 'stdout', '--schema', 'slots'],
+    ['-m', 'stdout', '--schema', 'map']
 ])
 def test_valid_cmd_args(monkeypatch, args):
     monkeypatch.setattr('sys.argv', COMMON_VALID_CMD_ARGS + args)
@@ -44,7 +60,23 @@ def test_valid_cmd_args(monkeypatch, args):
     ['-c', TAGS_NONEXISTING_PATH],
     ['-c', THIS_FILE_PATH, '-i', '0'],
     ['-c', THIS_FILE_PATH, '-i', '-123456789'],
-    ['-c', THIS_FILE_PATH, '-l', 'ILLEGALLEVEL']
+    ['-c', THIS_FILE_PATH, '-l', 'ILLEGALLEVEL'],
+    ['-m', 'stdout', '--deadband', 'sequence=1'],
+    ['-m', 'stdout', '--schema', 'columns'],
+    ['-m', 'stdout', '--deadband', 'temperature'],
+    ['-m', 'stdout', '--deadband', 'temperature=-1'],
+    ['-m', 'stdout', '--heartbeat', '0'],
+    ['-m', 'stdout', '--record', TAGS_NONEXISTING_PATH],
+    ['-m', 'stdout', '--replay', TAGS_EMPTY_PATH],
+    ['-m', 'stdout', '--continuous', '--replay', TAGS_NONEXISTING_PATH],
+    ['-m', 'stdout', '--continuous', '--replay', TAGS_EMPTY_PATH, '--simulate'],
+    ['-m', 'stdout', '--continuous', '--record', TAGS_NONEXISTING_PATH, '--simulate'],
+    ['-m', 'stdout', '--continuous', '--replay', TAGS_EMPTY_PATH, '--speed', '0'],
+    ['-m', 'stdout', '--sequence-stats'],
+    ['-m', 'azure', 'stdout'],
+    ['-m', 'stdout', '--sink-queue', '0'],
+    ['-m', 'stdout', '--sink-policy', 'stdout=wait'],
+    ['-m', 'stdout', '--sink-policy', 'azure=block']
 ])
 def test_invalid_cmd_args(monkeypatch, capsys, args):
     monkeypatch.setattr('sys.argv', COMMON_VALID_CMD_ARGS + args)
@@ -53,3 +85,190 @@ def test_invalid_cmd_args(monkeypatch, capsys, args):
     assert excinfo.value.code != 0
     captured = capsys.readouterr()
     assert 'usage' in captured.err
+
+@pytest.mark.asyncio
+async def test_scan_on_several_adapters(monkeypatch):
+    mac = "12:34:56:78:90:AB"
+    scans = {
+        "hci0": {mac: {"measurement_sequence_number": 1, "rssi": -90}},
+        "hci1": {mac: {"measurement_sequence_number": 1, "rssi": -60}}
+    }
+    monkeypatch.setattr(ruuvigate.__main__.RuuviTagSensor, "get_data_for_sensors",
+                        lambda macs, duration, adapter: scans[adapter])
+    data = await ruuvigate.__main__.get_ruuvi_data([mac], 0, None, ["hci0", "hci1"])
+    assert data == {mac: {"measurement_sequence_number": 1, "rssi": -60}}
+
+@pytest.mark.asyncio
+async def test_get_sequence_stats(tmp_path):
+    path = tmp_path / "tags.yml"
+    path.write_text("12:34:56:78:90:ab\n12:34:56:78:90:AC\n")
+    tags = ruuvigate.__main__.RuuviTags(str(path))
+    tracker = ruuvigate.__main__.SequenceTracker()
+    tracker.observe("12:34:56:78:90:AB", {"measurement_sequence_number": 1})
+    response = await ruuvigate.__main__.get_sequence_stats(None, tags, tracker)
+    assert response["result"]
+    assert response["data"]["12:34:56:78:90:ab"]["Received"] == 1
+    assert response["data"]["12:34:56:78:90:AC"] is None
+    response = await ruuvigate.__main__.get_sequence_stats("12:34:56:78:90:AD", tags, tracker)
+    assert not response["result"]
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("payload", [
+    "12:34:56:78:90:AB, 12:34:56:78:90:AC",
+    ["12:34:56:78:90:AB", "12:34:56:78:90:AC"]
+])
+async def test_add_and_remove_ruuvitags(tmp_path, payload):
+    tags = ruuvigate.__main__.RuuviTags(str(tmp_path / "tags.yml"))
+    response = await ruuvigate.__main__.add_ruuvitags(payload, tags)
+    assert response == {"result": True, "data": {
+        "Added": ["12:34:56:78:90:AB", "12:34:56:78:90:AC"], "Existing": []}}
+    response = await ruuvigate.__main__.remove_ruuvitags(["12:34:56:78:90:AB", "12:34:56:78:90:AD"], tags)
+    assert response == {"result": True, "data": {
+        "Removed": ["12:34:56:78:90:AB"], "Missing": ["12:34:56:78:90:AD"]}}
+
+@pytest.mark.asyncio
+async def test_remove_ruuvitags_forgets_state(tmp_path):
+    path = tmp_path / "tags.yml"
+    path.write_text("12:34:56:78:90:AB\n12:34:56:78:90:AC\n")
+    tags = ruuvigate.__main__.RuuviTags(str(path))
+    tracker = ruuvigate.__main__.SequenceTracker()
+    deadband = ruuvigate.__main__.DeadbandFilter({}, heartbeat=600)
+    for mac in ["12:34:56:78:90:AB", "12:34:56:78:90:AC"]:
+        tracker.observe(mac, {"measurement_sequence_number": 1})
+        deadband.filter(mac, {"temperature": 21.5})
+    await ruuvigate.__main__.remove_ruuvitag("12:34:56:78:90:ab", tags, tracker, deadband)
+    await ruuvigate.__main__.remove_ruuvitags(["12:34:56:78:90:AC"], tags, tracker, deadband)
+    assert tracker.stats("12:34:56:78:90:AB") is None
+    assert tracker.stats("12:34:56:78:90:AC") is None
+    assert deadband._forwarded == {}
+    assert deadband._full == {}
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("payload", [None, "", [], [1, 2], "12:34:56:78:90:AB,not a MAC"])
+async def test_add_ruuvitags_invalid(tmp_path, payload):
+    tags = ruuvigate.__main__.RuuviTags(str(tmp_path / "tags.yml"))
+    assert not (await ruuvigate.__main__.add_ruuvitags(payload, tags))["result"]
+    assert len(tags) == 0
+
+@pytest.mark.asyncio
+async def test_get_history(tmp_path):
+    class Store:
+        async def history(self, mac, start, end, points, metrics):
+            return {"Bucket": (end - start) / points, "Series": {"Mac": mac}}
+
+    tags = ruuvigate.__main__.RuuviTags(str(tmp_path / "tags.yml"))
+    request = {"MAC": "12:34:56:78:90:ab", "Start": "2024-01-01T00:00:00Z", "End": 1704070800, "Points": 60}
+    response = await ruuvigate.__main__.get_history(request, tags, [Store()])
+    assert response == {"result": True, "data": {
+        "MAC": "12:34:56:78:90:ab", "Bucket": 60.0, "Series": {"Mac": "12:34:56:78:90:AB"}}}
+    response = await ruuvigate.__main__.get_history("12:34:56:78:90:AB", tags, [Store()])
+    assert response["data"]["Bucket"] == 864.0
+    assert not (await ruuvigate.__main__.get_history("nonsense", tags, [Store()]))["result"]
+    assert not (await ruuvigate.__main__.get_history({**request, "Start": 1704070800}, tags, [Store()]))["result"]
+    assert not (await ruuvigate.__main__.get_history(request, tags, []))["result"]
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("metrics, expected", [
+    (None, None), ("Temperature", ["Temperature"]), (["Temperature", "Humidity"], ["Temperature", "Humidity"])])
+async def test_get_history_metrics(tmp_path, metrics, expected):
+    class Store:
+        async def history(self, mac, start, end, points, metrics):
+            return {"Metrics": metrics}
+
+    tags = ruuvigate.__main__.RuuviTags(str(tmp_path / "tags.yml"))
+    response = await ruuvigate.__main__.get_history({"MAC": "12:34:56:78:90:AB", "Metrics": metrics}, tags, [Store()])
+    assert response["data"]["Metrics"] == expected
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("metrics", [1, {"Temperature": True}, ["Temperature", 1]])
+async def test_get_history_invalid_metrics(tmp_path, metrics):
+    class Store:
+        async def history(self, mac, start, end, points, metrics):
+            raise AssertionError("Queried with invalid metrics")
+
+    tags = ruuvigate.__main__.RuuviTags(str(tmp_path / "tags.yml"))
+    response = await ruuvigate.__main__.get_history({"MAC": "12:34:56:78:90:AB", "Metrics": metrics}, tags, [Store()])
+    assert not response["result"]
+
+def test_slot_mac(tmp_path):
+    path = tmp_path / "tags.yml"
+    path.write_text("12:34:56:78:90:ab\n\n12:34:56:78:90:AC\n")
+    tags = ruuvigate.__main__.RuuviTags(str(path))
+    assert [tags.slot_mac(n) for n in range(5)] == [None, "12:34:56:78:90:AB", None, "12:34:56:78:90:AC", None]
+    assert "12:34:56:78:90:ac" in tags
+    assert "12:34:56:78:90:AD" not in tags
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("schema, expected", [
+    ("slots", {"Temperature2": 21.5, "Humidity2": 40.0, "Temperature1": 5.0}),
+    ("map", {"Tags": {"12:34:56:78:90:AB": {"Temperature": 21.5, "Humidity": 40.0},
+                      "12:34:56:78:90:AC": {"Temperature": 5.0}}}),
+])
+async def test_send_ruuvi_data_schemas(tmp_path, schema, expected):
+    class Publisher:
+        def __init__(self):
+            self.published = {}
+        async def buffer_data(self, data):
+            self.published.update(data)
+        async def publish_data(self, data={}):
+            self.published.update(data)
+
+    path = tmp_path / "tags.yml"
+    path.write_text("12:34:56:78:90:AC\n12:34:56:78:90:ab\n")
+    tags = ruuvigate.__main__.RuuviTags(str(path))
+    publisher = Publisher()
+    data = {"12:34:56:78:90:AB": {"temperature": 21.5, "humidity": 40.0},
+            "12:34:56:78:90:AC": {"temperature": 5.0},
+            "12:34:56:78:90:AD": {"temperature": 0.0}}
+    await ruuvigate.__main__.send_ruuvi_data(publisher, tags, data, schema=schema)
+    assert publisher.published == expected
+
+@pytest.mark.asyncio
+async def test_get_diagnostics(tmp_path):
+    class Diagnostics:
+        running = False
+        async def collect(self, duration, top):
+            return {"Duration": duration, "Top": top}
+
+    tags = ruuvigate.__main__.RuuviTags(str(tmp_path / "tags.yml"))
+    get_diagnostics = ruuvigate.__main__.get_diagnostics
+    assert (await get_diagnostics(None, tags, Diagnostics()))["data"] == {"Duration": 5.0, "Top": 10}
+    assert (await get_diagnostics({"Duration": 1, "Top": 3}, tags, Diagnostics()))["data"] == {"Duration": 1.0, "Top": 3}
+    assert not (await get_diagnostics(60, tags, Diagnostics()))["result"]
+    assert not (await get_diagnostics("nonsense", tags, Diagnostics()))["result"]
+    Diagnostics.running = True
+    assert not (await get_diagnostics(None, tags, Diagnostics()))["result"]
+
+@pytest.mark.asyncio
+async def test_set_publish_interval(tmp_path):
+    path = tmp_path / "tags.yml"
+    path.write_text("12:34:56:78:90:AB\n")
+    tags = ruuvigate.__main__.RuuviTags(str(path))
+    set_publish_interval = ruuvigate.__main__.set_publish_interval
+    response = await set_publish_interval({"MAC": "12:34:56:78:90:ab", "Interval": 10}, tags)
+    assert response == {"result": True, "data": "RuuviTag 12:34:56:78:90:ab published every 10s"}
+    assert tags.get_interval("12:34:56:78:90:AB") == 10
+    assert (await set_publish_interval("12:34:56:78:90:AB", tags))["result"]
+    assert tags.get_interval("12:34:56:78:90:AB") is None
+    for request in [{"MAC": "12:34:56:78:90:AB", "Interval": 0}, {"MAC": "12:34:56:78:90:AB", "Interval": "10"},
+                    {"MAC": "12:34:56:78:90:AC", "Interval": 10}, {"Interval": 10}, "nonsense"]:
+        assert not (await set_publish_interval(request, tags))["result"]
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("interval, own, duration", [(60, "", 2.0), (1, "", 1.0), (60, " 1", 1.0)])
+async def test_due_tick_gets_minimum_scan(tmp_path, monkeypatch, interval, own, duration):
+    path = tmp_path / "tags.yml"
+    path.write_text("12:34:56:78:90:AB" + own + "\n")
+    tags = ruuvigate.__main__.RuuviTags(str(path))
+    durations = []
+
+    async def get_ruuvi_data(macs, duration, simulator, adapters):
+        durations.append(duration)
+        raise asyncio.CancelledError()
+
+    # The tick is already due, e.g. after an overrun
+    monkeypatch.setattr(ruuvigate.__main__.TagScheduler, "remaining", lambda self: 0.0)
+    monkeypatch.setattr(ruuvigate.__main__, "get_ruuvi_data", get_ruuvi_data)
+    args = argparse.Namespace(interval=interval, align=False, adapters=None, sequence_stats=False, schema="slots")
+    await ruuvigate.__main__.publish_ruuvi_data(args, None, tags)
+    assert durations == [duration]
@@ -1,6 +1,7 @@
 from ruuvigate.__main__ import RuuviTags
 import asyncio
 import pytest
+import time
 import os
 
 TAGS_EMPTY_PATH = os.path.dirname(__file__) + "/TAGS_EMPTY.yml"
@@ -10,6 +11,7 @@ TAGS_PATH = os.path.dirname(__file__) + "/TAGS.yml"
 MAC_VALID1 = "12:34:56:78:90:AB"
 MAC_VALID2 = "12:34:56:78:90:AC"
 MAC_VALID3 = "aa:34:ab:78:90:ac"
+MAC_VALID4 = "12:34:56:78:90:AD"
 MAC_MALFORMED1 = "12:34:5X:78:90:AB"
 MAC_MALFORMED2 = "12:34:56:78:90:A"
 MAC_MALFORMED3 = "12:34:56:78:90:AB:12"
@@ -31,8 +33,8 @@ async def test_open_empty():
 ])
 async def test_open_non_empty(content: list):
     open(TAGS_PATH, "w").writelines(content)
-    # Strip the newlines from test input list
-    content = [line.rstrip() for line in content]
+    # Strip the newlines from test input list, duplicates are ignored
+    content = list(dict.fromkeys(line.rstrip() for line in content))
     assert content == await RuuviTags(TAGS_PATH).get_macs()
 
 @pytest.mark.asyncio
@@ -117,3 +119,229 @@ async def test_add_malformed_mac(macs: list):
                 await tags.add_mac(mac)
         else:
             await tags.add_mac(mac)
+
+@pytest.mark.asyncio
+async def test_slots_are_stable():
+    open(TAGS_EMPTY_PATH, "w")
+    tags = RuuviTags(TAGS_EMPTY_PATH)
+    for mac in [MAC_VALID1, MAC_VALID2, MAC_VALID3]:
+        assert await tags.add_mac(mac)
+    assert await tags.remove_mac(MAC_VALID2)
+    assert tags.slot_number(MAC_VALID1) == 1
+    assert tags.slot_number(MAC_VALID2) is None
+    assert tags.slot_number(MAC_VALID3) == 3
+    await tags.flush()
+    # The slots survive a reload
+    reloaded = RuuviTags(TAGS_EMPTY_PATH)
+    assert reloaded.slot_number(MAC_VALID3) == 3
+    # The lowest free slot is reused
+    assert await reloaded.add_mac(MAC_VALID2)
+    assert reloaded.slot_number(MAC_VALID2) == 2
+    assert [MAC_VALID1, MAC_VALID2, MAC_VALID3] == await reloaded.get_macs()
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mac, alias", [
+    (MAC_VALID1, MAC_VALID1.lower()),
+    (MAC_VALID3, MAC_VALID3.upper()),
+    (MAC_VALID3, MAC_VALID3.replace(":", "-")),
+    (MAC_VALID3, MAC_VALID3.replace(":", ""))
+])
+async def test_normalized_macs(mac: str, alias: str):
+    open(TAGS_EMPTY_PATH, "w")
+    tags = RuuviTags(TAGS_EMPTY_PATH)
+    assert await tags.add_mac(mac)
+    assert not await tags.add_mac(alias)
+    assert tags.slot_number(alias) == tags.slot_number(mac)
+    assert [RuuviTags.normalize_mac(mac)] == await tags.get_normalized_macs()
+    assert await tags.remove_mac(alias)
+    assert len(await tags.get_macs()) == 0
+
+@pytest.mark.asyncio
+async def test_add_and_remove_macs_in_one_transaction():
+    open(TAGS_EMPTY_PATH, "w")
+    tags = RuuviTags(TAGS_EMPTY_PATH)
+    assert await tags.add_macs([MAC_VALID1, MAC_VALID2]) == [MAC_VALID1, MAC_VALID2]
+    assert await tags.add_macs([MAC_VALID2, MAC_VALID3, MAC_VALID3]) == [MAC_VALID3]
+    with pytest.raises(ValueError):
+        await tags.add_macs(["12:34:56:78:90:AD", MAC_MALFORMED1])
+    with pytest.raises(ValueError):
+        await tags.remove_macs([MAC_VALID1, MAC_MALFORMED1])
+    assert [MAC_VALID1, MAC_VALID2, MAC_VALID3] == await tags.get_macs()
+    assert await tags.remove_macs([MAC_VALID1, MAC_VALID3, "12:34:56:78:90:AD"]) == [MAC_VALID1, MAC_VALID3]
+    assert [MAC_VALID2] == await tags.get_macs()
+
+@pytest.mark.asyncio
+async def test_writes_are_coalesced(monkeypatch):
+    open(TAGS_EMPTY_PATH, "w")
+    tags = RuuviTags(TAGS_EMPTY_PATH)
+    monkeypatch.setattr(RuuviTags, "PersistDelay", 0.01)
+    replaced = []
+    monkeypatch.setattr(os, "replace", lambda src, dst: replaced.append(dst) or os.rename(src, dst))
+    for mac in [MAC_VALID1, MAC_VALID2, MAC_VALID3]:
+        assert await tags.add_mac(mac)
+    assert await tags.remove_mac(MAC_VALID2)
+    # Nothing is written before the delay
+    assert open(TAGS_EMPTY_PATH).read() == ""
+    await asyncio.sleep(0.1)
+    assert replaced == [TAGS_EMPTY_PATH]
+    assert open(TAGS_EMPTY_PATH).read() == MAC_VALID1 + "\n\n" + MAC_VALID3 + "\n"
+    assert not os.path.exists(TAGS_EMPTY_PATH + ".tmp")
+
+@pytest.mark.asyncio
+async def test_flush_writes_pending_changes():
+    open(TAGS_EMPTY_PATH, "w")
+    tags = RuuviTags(TAGS_EMPTY_PATH)
+    assert await tags.add_mac(MAC_VALID1)
+    await tags.flush()
+    assert open(TAGS_EMPTY_PATH).read() == MAC_VALID1 + "\n"
+
+@pytest.mark.asyncio
+async def test_flush_has_single_writer(monkeypatch):
+    open(TAGS_EMPTY_PATH, "w")
+    tags = RuuviTags(TAGS_EMPTY_PATH)
+    monkeypatch.setattr(RuuviTags, "PersistDelay", 0.01)
+    writing = []
+    overlapped = []
+    write = RuuviTags._RuuviTags__write_atomically
+    def slow_write(path, content):
+        overlapped.append(bool(writing))
+        writing.append(content)
+        time.sleep(0.1)
+        write(path, content)
+        writing.remove(content)
+    monkeypatch.setattr(RuuviTags, "_RuuviTags__write_atomically", staticmethod(slow_write))
+    assert await tags.add_mac(MAC_VALID1)
+    # The timer-driven write is in flight when flushing
+    await asyncio.sleep(0.03)
+    assert await tags.add_mac(MAC_VALID2)
+    flush = asyncio.create_task(tags.flush())
+    # The write of the flush is in flight, the changes meanwhile wait for it
+    await asyncio.sleep(0.12)
+    assert await tags.add_mac(MAC_VALID3)
+    assert tags._persist_timer is None
+    await flush
+    await tags.flush()
+    assert overlapped == [False, False, False]
+    assert open(TAGS_EMPTY_PATH).read() == MAC_VALID1 + "\n" + MAC_VALID2 + "\n" + MAC_VALID3 + "\n"
+
+@pytest.mark.asyncio
+async def test_reload_applies_changes():
+    open(TAGS_PATH, "w").write(MAC_VALID1 + "\n" + MAC_VALID2 + "\n")
+    tags = RuuviTags(TAGS_PATH)
+    open(TAGS_PATH, "w").write(MAC_VALID1 + "\n\n" + MAC_VALID3 + "\n")
+    assert await tags.reload() == ([MAC_VALID3], [MAC_VALID2])
+    assert [MAC_VALID1, MAC_VALID3] == await tags.get_macs()
+    # The added RuuviTag takes the slot of its line
+    assert tags.slot_number(MAC_VALID3) == 3
+    assert tags.slot_number(MAC_VALID2) is None
+    # Unchanged content is not applied again
+    assert await tags.reload() == ([], [])
+
+@pytest.mark.asyncio
+async def test_reload_keeps_registry_on_malformed_file():
+    open(TAGS_PATH, "w").write(MAC_VALID1 + "\n")
+    tags = RuuviTags(TAGS_PATH)
+    open(TAGS_PATH, "w").write(MAC_VALID2 + "\n" + MAC_MALFORMED1 + "\n")
+    assert await tags.reload() == ([], [])
+    assert [MAC_VALID1] == await tags.get_macs()
+
+@pytest.mark.asyncio
+async def test_reload_ignores_own_writes():
+    open(TAGS_PATH, "w")
+    tags = RuuviTags(TAGS_PATH)
+    assert await tags.add_mac(MAC_VALID1)
+    await tags.flush()
+    assert await tags.reload() == ([], [])
+    assert [MAC_VALID1] == await tags.get_macs()
+
+@pytest.mark.asyncio
+async def test_reload_keeps_slots_in_use():
+    open(TAGS_PATH, "w").write(MAC_VALID1 + "\n" + MAC_VALID2 + "\n")
+    tags = RuuviTags(TAGS_PATH)
+    # The RuuviTags in use keep their slots, so the line of the added one is taken
+    open(TAGS_PATH, "w").write(MAC_VALID2 + "\n" + MAC_VALID3 + "\n" + MAC_VALID1 + "\n")
+    assert await tags.reload() == ([MAC_VALID3], [])
+    assert tags.slot_number(MAC_VALID1) == 1
+    assert tags.slot_number(MAC_VALID3) == 3
+    # The file is rewritten to keep the slots over a restart
+    await tags.flush()
+    assert open(TAGS_PATH).read() == MAC_VALID1 + "\n" + MAC_VALID2 + "\n" + MAC_VALID3 + "\n"
+    assert RuuviTags(TAGS_PATH).slot_number(MAC_VALID3) == 3
+
+@pytest.mark.asyncio
+async def test_reload_not_rewritten_when_slots_match():
+    open(TAGS_PATH, "w").write(MAC_VALID1 + "\n")
+    tags = RuuviTags(TAGS_PATH)
+    open(TAGS_PATH, "w").write(MAC_VALID1 + "\n" + MAC_VALID2.lower() + "\n")
+    assert await tags.reload() == ([MAC_VALID2.lower()], [])
+    await tags.flush()
+    assert open(TAGS_PATH).read() == MAC_VALID1 + "\n" + MAC_VALID2.lower() + "\n"
+
+@pytest.mark.asyncio
+async def test_reload_during_write_keeps_additions():
+    open(TAGS_PATH, "w").write(MAC_VALID1 + "\n")
+    tags = RuuviTags(TAGS_PATH)
+    assert await tags.add_mac(MAC_VALID2)
+    flush = asyncio.create_task(tags.flush())
+    # The write is in flight and not on disk yet
+    await asyncio.sleep(0)
+    assert await tags.reload() == ([], [])
+    await flush
+    assert [MAC_VALID1, MAC_VALID2] == await tags.get_macs()
+
+@pytest.mark.asyncio
+async def test_reload_keeps_pending_changes():
+    open(TAGS_PATH, "w").write(MAC_VALID1 + "\n" + MAC_VALID2 + " 60\n")
+    tags = RuuviTags(TAGS_PATH)
+    # Changed in the registry and not written yet
+    assert await tags.add_mac(MAC_VALID3)
+    assert await tags.remove_mac(MAC_VALID1)
+    open(TAGS_PATH, "w").write(MAC_VALID1 + "\n" + MAC_VALID2 + " 10\n" + MAC_VALID4 + "\n")
+    assert await tags.reload() == ([MAC_VALID4], [])
+    assert sorted(await tags.get_macs()) == [MAC_VALID2, MAC_VALID4, MAC_VALID3]
+    assert tags.get_interval(MAC_VALID2) == 10
+    await tags.flush()
+    assert RuuviTags(TAGS_PATH).get_interval(MAC_VALID2) == 10
+    assert sorted(await RuuviTags(TAGS_PATH).get_macs()) == [MAC_VALID2, MAC_VALID4, MAC_VALID3]
+
+@pytest.mark.asyncio
+async def test_publish_intervals():
+    open(TAGS_PATH, "w").write(MAC_VALID1 + " 10\n\n" + MAC_VALID2 + "\n")
+    tags = RuuviTags(TAGS_PATH)
+    assert [MAC_VALID1, MAC_VALID2] == await tags.get_macs()
+    intervals = await tags.get_intervals()
+    assert intervals == {MAC_VALID1: 10, MAC_VALID2: None}
+    # The same dict until something changes
+    assert await tags.get_intervals() is intervals
+    assert await tags.set_interval(MAC_VALID2.lower(), 900)
+    assert not await tags.set_interval(MAC_VALID3, 900)
+    with pytest.raises(ValueError):
+        await tags.set_interval(MAC_VALID1, 0)
+    assert await tags.set_interval(MAC_VALID1, None)
+    assert await tags.get_intervals() == {MAC_VALID1: None, MAC_VALID2: 900}
+    await tags.flush()
+    assert open(TAGS_PATH).read() == MAC_VALID1 + "\n\n" + MAC_VALID2 + " 900\n"
+    # Removed RuuviTags lose their interval
+    assert await tags.remove_mac(MAC_VALID2)
+    assert await tags.add_mac(MAC_VALID2)
+    assert tags.get_interval(MAC_VALID2) is None
+
+@pytest.mark.asyncio
+async def test_reload_applies_intervals():
+    open(TAGS_PATH, "w").write(MAC_VALID1 + "\n" + MAC_VALID2 + " 60\n")
+    tags = RuuviTags(TAGS_PATH)
+    open(TAGS_PATH, "w").write(MAC_VALID1 + " 10\n" + MAC_VALID2 + "\n")
+    assert await tags.reload() == ([], [])
+    assert await tags.get_intervals() == {MAC_VALID1: 10, MAC_VALID2: None}
+
+@pytest.mark.parametrize("line", [
+    MAC_VALID1 + " 0",
+    MAC_VALID1 + " -10",
+    MAC_VALID1 + " 1.5",
+    MAC_VALID1 + " 10 20",
+    MAC_VALID1 + " ten",
+])
+def test_open_malformed_interval(line: str):
+    open(TAGS_MALFORMED_PATH, "w").write(line + "\n")
+    with pytest.raises(ValueError):
+        RuuviTags(TAGS_MALFORMED_PATH)
@@ -0,0 +1,176 @@
+from ruuvigate.scanner import RuuviScanner, merge_readings, merge_sources
+import asyncio
+import pytest
+
+MAC_VALID1 = "12:34:56:78:90:AB"
+MAC_VALID2 = "12:34:56:78:90:AC"
+MAC_VALID3 = "aa:34:ab:78:90:ac"
+
+def source_of(advertisements: list):
+    async def source():
+        for advertisement in advertisements:
+            yield advertisement
+    return source
+
+@pytest.mark.asyncio
+async def test_snapshot_keeps_latest_reading():
+    scanner = RuuviScanner(source_of([
+        (MAC_VALID1, {"temperature": 1}),
+        (MAC_VALID2, {"temperature": 2}),
+        (MAC_VALID1, {"temperature": 3})
+    ]))
+    task = asyncio.create_task(scanner.run())
+    await asyncio.sleep(0)
+    task.cancel()
+    await task
+    assert scanner.snapshot([MAC_VALID1, MAC_VALID2]) == {
+        MAC_VALID1: {"temperature": 3},
+        MAC_VALID2: {"temperature": 2}
+    }
+
+@pytest.mark.asyncio
+async def test_snapshot_filters_and_clears():
+    scanner = RuuviScanner(source_of([
+        (MAC_VALID1, {"temperature": 1}),
+        (MAC_VALID3, {"temperature": 2})
+    ]))
+    task = asyncio.create_task(scanner.run())
+    await asyncio.sleep(0)
+    task.cancel()
+    await task
+    assert scanner.snapshot([MAC_VALID1, MAC_VALID2]) == {
+        MAC_VALID1: {"temperature": 1}
+    }
+    assert scanner.snapshot([MAC_VALID1, MAC_VALID3]) == {}
+
+@pytest.mark.asyncio
+async def test_snapshot_aggregates_window():
+    scanner = RuuviScanner(source_of([
+        (MAC_VALID1, {"temperature": 20.0, "humidity": None, "measurement_sequence_number": 1}),
+        (MAC_VALID1, {"temperature": 22.0, "humidity": None, "measurement_sequence_number": 2}),
+        (MAC_VALID1, {"temperature": 21.0, "humidity": None, "measurement_sequence_number": 3})
+    ]), aggregate=True)
+    task = asyncio.create_task(scanner.run())
+    await asyncio.sleep(0)
+    task.cancel()
+    await task
+    assert scanner.snapshot([MAC_VALID1]) == {
+        MAC_VALID1: {
+            "temperature": 21.0,
+            "humidity": None,
+            "measurement_sequence_number": 3,
+            "samples": 3,
+            "temperature_min": 20.0,
+            "temperature_max": 22.0,
+            "temperature_mean": 21.0
+        }
+    }
+    assert scanner.snapshot([MAC_VALID1]) == {}
+
+@pytest.mark.asyncio
+async def test_repeats_keep_strongest_copy():
+    scanner = RuuviScanner(source_of([
+        (MAC_VALID1, {"measurement_sequence_number": 7, "rssi": -80}),
+        (MAC_VALID1, {"measurement_sequence_number": 7, "rssi": -60}),
+        (MAC_VALID1, {"measurement_sequence_number": 7, "rssi": -70})
+    ]), aggregate=True)
+    task = asyncio.create_task(scanner.run())
+    await asyncio.sleep(0)
+    task.cancel()
+    await task
+    snapshot = scanner.snapshot([MAC_VALID1])
+    assert snapshot[MAC_VALID1]["rssi"] == -60
+    assert snapshot[MAC_VALID1]["samples"] == 1
+
+@pytest.mark.asyncio
+async def test_repeats_are_not_published_twice():
+    scanner = RuuviScanner(source_of([
+        (MAC_VALID1, {"measurement_sequence_number": 65534, "rssi": -80}),
+        (MAC_VALID1, {"measurement_sequence_number": 0, "rssi": -80}),
+        (MAC_VALID1, {"measurement_sequence_number": 65534, "rssi": -50})
+    ]), restart=False)
+    assert await scanner.run()
+    assert scanner.snapshot([MAC_VALID1]) == {
+        MAC_VALID1: {"measurement_sequence_number": 0, "rssi": -80}
+    }
+
+@pytest.mark.asyncio
+async def test_restarted_sequence_is_accepted():
+    scanner = RuuviScanner(source_of([
+        (MAC_VALID1, {"measurement_sequence_number": 1000}),
+        (MAC_VALID1, {"measurement_sequence_number": 3})
+    ]), restart=False)
+    assert await scanner.run()
+    assert scanner.snapshot([MAC_VALID1]) == {
+        MAC_VALID1: {"measurement_sequence_number": 3}
+    }
+
+def test_merge_readings():
+    assert merge_readings([
+        {
+            MAC_VALID1: {"measurement_sequence_number": 5, "rssi": -90},
+            MAC_VALID2: {"measurement_sequence_number": 9, "rssi": -90}
+        },
+        {
+            MAC_VALID1: {"measurement_sequence_number": 5, "rssi": -70},
+            MAC_VALID2: {"measurement_sequence_number": 8, "rssi": -50},
+            MAC_VALID3: {"rssi": -60}
+        }
+    ]) == {
+        MAC_VALID1: {"measurement_sequence_number": 5, "rssi": -70},
+        MAC_VALID2: {"measurement_sequence_number": 9, "rssi": -90},
+        MAC_VALID3: {"rssi": -60}
+    }
+
+@pytest.mark.asyncio
+async def test_merge_sources():
+    merged = [item async for item in merge_sources([
+        source_of([(MAC_VALID1, {}), (MAC_VALID1, {})]),
+        source_of([(MAC_VALID2, {})])
+    ])]
+    assert sorted(mac for mac, _ in merged) == [MAC_VALID1, MAC_VALID1, MAC_VALID2]
+
+@pytest.mark.asyncio
+async def test_merge_sources_fails_with_source():
+    async def failing():
+        raise OSError("adapter gone")
+        yield
+    with pytest.raises(OSError):
+        [item async for item in merge_sources([source_of([(MAC_VALID1, {})]), failing])]
+
+@pytest.mark.asyncio
+async def test_snapshot_keeps_readings_of_others():
+    scanner = RuuviScanner(source_of([
+        (MAC_VALID1, {"temperature": 1}),
+        (MAC_VALID2, {"temperature": 2})
+    ]), aggregate=True)
+    task = asyncio.create_task(scanner.run())
+    await asyncio.sleep(0)
+    task.cancel()
+    await task
+    assert scanner.snapshot([MAC_VALID1], clear=False) == {
+        MAC_VALID1: {"temperature": 1, "samples": 1, "temperature_min": 1,
+                     "temperature_max": 1, "temperature_mean": 1}
+    }
+    assert scanner.snapshot([MAC_VALID1, MAC_VALID2], clear=False)[MAC_VALID2]["temperature"] == 2
+    assert scanner.snapshot([MAC_VALID1, MAC_VALID2]) == {}
+
+@pytest.mark.asyncio
+async def test_keeps_only_registered():
+    registry = {MAC_VALID1, MAC_VALID2}
+    scanner = RuuviScanner(source_of([
+        (MAC_VALID1, {"temperature": 1, "measurement_sequence_number": 1}),
+        (MAC_VALID2, {"temperature": 2, "measurement_sequence_number": 1}),
+        (MAC_VALID3, {"temperature": 3, "measurement_sequence_number": 1})
+    ]), aggregate=True, registered=registry.__contains__)
+    task = asyncio.create_task(scanner.run())
+    await asyncio.sleep(0)
+    task.cancel()
+    await task
+    assert set(scanner._latest) == set(scanner._windows) == {MAC_VALID1, MAC_VALID2}
+    assert scanner.tracker.stats(MAC_VALID1) is not None
+    assert scanner.tracker.stats(MAC_VALID3) is None
+    # Removed from the registry while its reading waits for a later snapshot
+    registry.discard(MAC_VALID2)
+    assert list(scanner.snapshot([MAC_VALID1], clear=False)) == [MAC_VALID1]
+    assert scanner._latest == scanner._windows == {}
@@ -0,0 +1,97 @@
+from ruuvigate.scheduler import TagScheduler
+import pytest
+
+class FakeClock:
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.mark.parametrize("wallclock, remaining", [
+    (960.0, 60.0),
+    (975.0, 45.0),
+    (1019.5, 0.5)
+])
+def test_align_to_wallclock(wallclock: float, remaining: float):
+    scheduler = TagScheduler(60,
+                             align=True,
+                             clock=FakeClock(5.0),
+                             wallclock=lambda: wallclock)
+    scheduler.update({"A": None})
+    assert scheduler.remaining() == pytest.approx(remaining)
+
+@pytest.mark.asyncio
+async def test_tags_fall_due_at_their_intervals():
+    clock = FakeClock(0.0)
+    scheduler = TagScheduler(60, clock=clock)
+    scheduler.update({"A": 10, "B": None, "C": 30})
+    due = []
+    for _ in range(6):
+        clock.now += scheduler.remaining()
+        due.append((clock.now, await scheduler.wait()))
+    # Tags due on the same tick are coalesced
+    assert due == [(10, ["A"]), (20, ["A"]), (30, ["A", "C"]), (40, ["A"]),
+                   (50, ["A"]), (60, ["A", "B", "C"])]
+    assert scheduler.overruns == 0
+
+@pytest.mark.asyncio
+async def test_tags_within_window_are_coalesced():
+    clock = FakeClock(0.0)
+    scheduler = TagScheduler(10, clock=clock)
+    scheduler.update({"A": None})
+    clock.now = 7.8
+    scheduler.update({"A": None, "B": None, "C": 3})
+    clock.now = 9.0
+    assert await scheduler.wait() == ["C"]
+    clock.now = 10.0
+    # B was added on the grid of the interval, so it falls due with A
+    assert await scheduler.wait() == ["A", "B"]
+
+@pytest.mark.asyncio
+async def test_changed_intervals_are_rescheduled():
+    clock = FakeClock(0.0)
+    scheduler = TagScheduler(900, clock=clock)
+    intervals = {"A": None, "B": None}
+    scheduler.update(intervals)
+    clock.now = 25.0
+    # The same mapping isn't compared again
+    intervals["A"] = 10
+    scheduler.update(intervals)
+    assert scheduler.remaining() == 875
+    scheduler.update({"A": 10})
+    assert scheduler.remaining() == 5
+    clock.now = 30.0
+    assert await scheduler.wait() == ["A"]
+    scheduler.update({})
+    # Nothing scheduled, ticks at the default interval
+    assert scheduler.remaining() == 870
+    clock.now = 900.0
+    assert await scheduler.wait() == []
+
+@pytest.mark.asyncio
+async def test_late_tags_skip_missed_ticks():
+    clock = FakeClock(0.0)
+    scheduler = TagScheduler(10, clock=clock)
+    scheduler.update({"A": None, "B": 30})
+    clock.now = 45.0
+    assert await scheduler.wait() == ["A", "B"]
+    assert scheduler.overruns == 1
+    assert scheduler.skipped == 3
+    # Back on the original grid
+    assert scheduler.remaining() == 5
+    clock.now = 50.0
+    assert await scheduler.wait() == ["A"]
+    clock.now = 60.0
+    assert await scheduler.wait() == ["A", "B"]
+
+def test_shortest_interval():
+    scheduler = TagScheduler(60, clock=FakeClock(0.0))
+    assert scheduler.shortest() == 60
+    scheduler.update({"A": None, "B": 10})
+    assert scheduler.shortest() == 10
+
+def test_tags_align_to_wallclock():
+    scheduler = TagScheduler(60, align=True, clock=FakeClock(5.0), wallclock=lambda: 975.0)
+    scheduler.update({"A": None, "B": 10})
+    assert scheduler.remaining() == pytest.approx(5.0)
@@ -0,0 +1,79 @@
+from ruuvigate.sequence import SequenceTracker, is_newer, is_repeat
+import pytest
+
+MAC_VALID1 = "12:34:56:78:90:AB"
+MAC_VALID2 = "12:34:56:78:90:AC"
+
+
+def reading(sequence, data_format=5):
+    return {"data_format": data_format, "measurement_sequence_number": sequence}
+
+
+def observe_all(tracker, mac, sequences, data_format=5):
+    return [tracker.observe(mac, reading(sequence, data_format)) for sequence in sequences]
+
+
+@pytest.mark.parametrize("sequence, other, newer", [
+    (1, 0, True),
+    (0, 1, False),
+    (0, 0, False),
+    (0, 65534, True),
+    (65534, 0, False),
+    (30000, 100, True),
+    (100, 40000, True)
+])
+def test_is_newer(sequence, other, newer):
+    assert is_newer(sequence, other) == newer
+
+def test_is_repeat():
+    assert is_repeat(5, 5)
+    assert is_repeat(65534, 3)
+    assert not is_repeat(6, 5)
+    assert not is_repeat(0, 1000)
+
+def test_drops_repeats():
+    tracker = SequenceTracker()
+    assert observe_all(tracker, MAC_VALID1, [10, 10, 11, 10, 12]) == [True, False, True, False, True]
+    assert observe_all(tracker, MAC_VALID2, [10]) == [True]
+    assert tracker.stats(MAC_VALID1)["Duplicates"] == 2
+    assert tracker.stats(MAC_VALID1)["Sequence"] == 12
+
+def test_counts_gaps_across_wraparound():
+    tracker = SequenceTracker()
+    observe_all(tracker, MAC_VALID1, [65532, 65534, 1])
+    stats = tracker.stats(MAC_VALID1)
+    assert stats["Received"] == 3
+    assert stats["Lost"] == 2
+    assert stats["PacketLoss"] == 0.4
+    assert tracker.ratios(MAC_VALID1) == {"packet_loss": 0.4, "duplicates": 0.0}
+
+def test_single_byte_sequence_wraps():
+    tracker = SequenceTracker()
+    assert observe_all(tracker, MAC_VALID1, [254, 255, 0, 0], data_format=6) == [True, True, True, False]
+    assert tracker.stats(MAC_VALID1)["Lost"] == 0
+
+def test_restart_is_not_loss():
+    tracker = SequenceTracker()
+    assert observe_all(tracker, MAC_VALID1, [5000, 3, 4]) == [True, True, True]
+    assert tracker.stats(MAC_VALID1)["Lost"] == 0
+
+def test_ratios_roll():
+    tracker = SequenceTracker(window=4)
+    observe_all(tracker, MAC_VALID1, [0, 0, 0, 1])
+    assert tracker.ratios(MAC_VALID1)["duplicates"] == 0.5
+    observe_all(tracker, MAC_VALID1, [2, 3, 4, 10])
+    assert tracker.ratios(MAC_VALID1) == {"packet_loss": 0.5556, "duplicates": 0.0}
+
+def test_gaps_not_counted_when_sampling():
+    tracker = SequenceTracker(count_gaps=False)
+    assert observe_all(tracker, MAC_VALID1, [0, 5, 5, 10]) == [True, True, False, True]
+    assert tracker.stats(MAC_VALID1)["Lost"] == 0
+
+def test_unknown_and_removed():
+    tracker = SequenceTracker()
+    assert tracker.observe(MAC_VALID1, {"temperature": 1.0})
+    assert tracker.stats(MAC_VALID1) is None
+    assert tracker.ratios(MAC_VALID1) == {}
+    observe_all(tracker, MAC_VALID1, [1])
+    tracker.remove(MAC_VALID1)
+    assert tracker.stats(MAC_VALID1) is None
@@ -0,0 +1,37 @@
+from ruuvigate.simulation import Simulator, virtual_macs
+import pytest
+
+class FakeClock:
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+def test_virtual_macs_are_distinct():
+    macs = virtual_macs(10000)
+    assert len(set(macs)) == 10000
+    assert macs[258] == "F2:00:00:00:01:02"
+
+def test_deterministic_with_seed():
+    macs = virtual_macs(50)
+    first = Simulator(seed=1, clock=FakeClock(1000.0))
+    second = Simulator(seed=1, clock=FakeClock(1000.0))
+    assert first.readings(macs) == second.readings(macs)
+
+def test_sequence_numbers_increase():
+    clock = FakeClock(1000.0)
+    simulator = Simulator(seed=2, clock=clock)
+    macs = virtual_macs(10)
+    previous = simulator.readings(macs)
+    clock.now += 60
+    current = simulator.readings(macs)
+    for mac in macs:
+        assert (current[mac]["measurement_sequence_number"] -
+                previous[mac]["measurement_sequence_number"]) % Simulator.SequenceModulo == 1
+        assert 0 <= current[mac]["humidity"] <= 100
+
+def test_packet_loss():
+    simulator = Simulator(seed=3, packet_loss=0.25, clock=FakeClock(1000.0))
+    readings = simulator.readings(virtual_macs(10000))
+    assert 7000 < len(readings) < 8000
@@ -0,0 +1,44 @@
+from ruuvigate.watch import FileWatcher
+import asyncio
+import sys
+import os
+import pytest
+
+
+async def next_change(watcher_changes, timeout=2.0):
+    await asyncio.wait_for(watcher_changes.__anext__(), timeout)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("use_inotify", [
+    False,
+    pytest.param(True, marks=pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux only"))
+])
+async def test_detects_changes(tmp_path, use_inotify):
+    path = tmp_path / "tags.yml"
+    path.write_text("12:34:56:78:90:AB\n")
+    changes = FileWatcher(str(path), poll_interval=0.01, use_inotify=use_inotify).changes()
+    pending = asyncio.ensure_future(next_change(changes))
+    await asyncio.sleep(0.05)
+    # Written in place
+    path.write_text("12:34:56:78:90:AB\n12:34:56:78:90:AC\n")
+    await pending
+    pending = asyncio.ensure_future(next_change(changes))
+    await asyncio.sleep(0.05)
+    # Replaced by a rename
+    (tmp_path / "tags.yml.new").write_text("12:34:56:78:90:AC\n")
+    os.replace(tmp_path / "tags.yml.new", path)
+    await pending
+    await changes.aclose()
+
+@pytest.mark.asyncio
+async def test_ignores_other_files(tmp_path):
+    path = tmp_path / "tags.yml"
+    path.write_text("12:34:56:78:90:AB\n")
+    changes = FileWatcher(str(path), poll_interval=0.01).changes()
+    pending = asyncio.ensure_future(next_change(changes, timeout=0.3))
+    await asyncio.sleep(0.05)
+    (tmp_path / "other.yml").write_text("something else\n")
+    with pytest.raises(asyncio.TimeoutError):
+        await pending
+    await changes.aclose()